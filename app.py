@@ -1,15 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify, stream_with_context
-from models import mongo_db, Song, User, Artist
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, Response, jsonify, stream_with_context, \
+    session, g
+from models import mongo_db, user_cache, Song, User, Artist, Album, AlbumUpload, BlobStore, PlaylistItems, normalize_key, \
+    backfill_normalized_keys
+from media import parse_range_header, iter_file, MultipartRanges, file_validators, cache_headers, is_not_modified, range_allowed, \
+    pick_variant
+from audio_cache import audio_cache
+from search_index import search_index
+from discover import discover_pool
+from page_cache import page_cache
+from play_buffer import play_buffer
+from trending import trending, WINDOWS as TRENDING_WINDOWS, DIMENSIONS as TRENDING_DIMENSIONS
+from thumbnails import THUMBNAIL_WIDTHS, create_thumbnails, backfill_thumbnails
+from indexes import INDEXES, apply_indexes
 from config import Config
 from werkzeug.security import generate_password_hash, check_password_hash
+from markupsafe import Markup
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from bson import ObjectId
 from functools import wraps
 from urllib.parse import unquote, quote
+from tempfile import SpooledTemporaryFile
+import click
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from uuid import uuid4
+from datetime import datetime, timedelta
 import re
+import random
+import time
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Keep small uploads in memory and spill anything larger to a temp file, so
+        # parsing a multi-GB album upload never holds whole files in RAM
+        return SpooledTemporaryFile(max_size=app.config['UPLOAD_SPOOL_MAX_BYTES'], mode='rb+')
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.request_class = UploadRequest
 
 # Add URL quote filter for templates
 @app.template_filter('urlencode')
@@ -22,13 +49,33 @@ def get_artist_data_filter(artist_name):
 
 
 mongo_db.init_app(app)
+audio_cache.init_app(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get(user_id)
+    # The profile kept in the session seeds this worker's user cache without a lookup
+    profile = session.get('user_profile')
+    if not (profile and profile.get('_id') == user_id and user_cache.is_fresh(profile)):
+        profile = None
+    user = User.get_cached(user_id, profile)
+    if user and (profile is None or profile['loaded_at'] != user.loaded_at):
+        remember_profile(user)
+    return user
+
+def remember_profile(user):
+    # Keeps the time the profile was read, so passing it around never extends its life
+    session['user_profile'] = user.profile()
+
+def skip_user_loading(f):
+    """For public routes that never need the user (media): current_user stays anonymous."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g._login_user = login_manager.anonymous_user()
+        return f(*args, **kwargs)
+    return decorated_function
 
 def admin_required(f):
     @wraps(f)
@@ -45,22 +92,127 @@ def allowed_files(filename):
 def allowed_image_files(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_IMAGE_EXTENSIONS']
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    flash(f'Upload is too large. The maximum request size is {limit_mb} MB.', 'error')
+    return redirect(request.referrer or url_for('index'))
+
+def store_image(image, image_type):
+    """Stores an uploaded image in GridFS along with its resized variants."""
+    image_data = image.read()
+    metadata = {'content_type': image.content_type, 'type': image_type}
+    file_id, created = BlobStore.put(image_data, image.filename, metadata)
+    if created:
+        create_thumbnails(file_id, image_data)
+    return file_id
+
+@app.template_global()
+def image_srcset(endpoint, file_id):
+    """Builds a srcset of the resized variants served by an image route."""
+    return ', '.join(f"{url_for(endpoint, file_id=file_id, w=width)} {width}w" for width in THUMBNAIL_WIDTHS)
+
+def viewer_role():
+    """Which variant of a cached fragment the current user sees."""
+    if not current_user.is_authenticated:
+        return 'anonymous'
+    return 'admin' if current_user.is_admin else 'user'
+
+def not_modified_response(etag, last_modified):
+    """Returns a 304 response if the client's cached copy of a GridFS file is still valid."""
+    if is_not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since'),
+                       etag, last_modified):
+        response = Response(status=304)
+        response.headers.update(cache_headers(etag, last_modified))
+        return response
+    return None
+
 
 @app.route('/')
 def index():
-    # Get recently uploaded albums for featured section
-    albums = Song.get_recent_albums(limit=4)
-    # Get random songs for discover section
-    discover_songs = Song.get_random_songs(limit=15)
-    liked_song_ids = current_user.get_liked_song_ids() if current_user.is_authenticated else []
-    return render_template('index.html', albums=albums, discover_songs=discover_songs, liked_song_ids=liked_song_ids)
+    # Featured albums only change with the catalog, so their markup is cached
+    albums_html = page_cache.get_or_set('home_albums', viewer_role(), lambda: render_template(
+        'home_albums.html', albums=Song.get_recent_albums(limit=4)
+    ))
+    # First page of a freshly seeded Discover feed; /api/discover serves the rest
+    discover_seed = random.getrandbits(32)
+    discover_songs, discover_cursor = discover_pool.page(discover_seed, limit=15)
+    trending_songs = trending_chart('songs', 'day', 5)
+    if current_user.is_authenticated:
+        liked_song_ids = current_user.get_liked_among([song['id'] for song in discover_songs] +
+                                                      [song.id for song, _ in trending_songs])
+    else:
+        liked_song_ids = set()
+    return render_template('index.html', albums_html=Markup(albums_html), discover_songs=discover_songs,
+                           trending_songs=[song for song, _ in trending_songs], liked_song_ids=liked_song_ids,
+                           discover_seed=discover_seed, discover_cursor=discover_cursor)
+
+def trending_chart(dimension, window, limit):
+    """[(item, score)] from the in-memory trending charts; songs are loaded, deleted ones skipped."""
+    chart = trending.top(dimension, window, limit)
+    if dimension != 'songs':
+        return chart
+    songs = Song.loader().load_many(song_id for song_id, _ in chart)
+    return [(song, score) for song, (_, score) in zip(songs, chart) if song]
+
+@app.route('/api/trending', methods=['GET'])
+def trending_charts():
+    """Top songs, artists or genres (?type=) for the last hour, day or week (?window=)."""
+    dimension = request.args.get('type', 'songs')
+    window = request.args.get('window', 'day')
+    if dimension not in TRENDING_DIMENSIONS or window not in TRENDING_WINDOWS:
+        return jsonify({'success': False, 'message': 'Unknown chart'}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    chart = trending_chart(dimension, window, limit)
+    if dimension == 'songs':
+        items = [{'score': score, 'song': {'id': song.id, 'title': song.title, 'artist': song.artist,
+                                           'album': song.album, 'genre': song.genre,
+                                           'album_art_id': song.album_art_id, 'file_id': song.file_id}}
+                 for song, score in chart]
+    else:
+        items = [{'score': score, 'name': name} for name, score in chart]
+    return jsonify({'success': True, 'type': dimension, 'window': window, 'items': items})
+
+@app.route('/api/discover', methods=['GET'])
+def discover():
+    """Next page of a Discover feed, served from the in-memory pool."""
+    seed = request.args.get('seed', 0, type=int)
+    limit = min(max(request.args.get('limit', 15, type=int), 1), 60)
+    songs, next_cursor = discover_pool.page(seed, request.args.get('cursor'), limit)
+    if current_user.is_authenticated:
+        liked_song_ids = current_user.get_liked_among([song['id'] for song in songs])
+    else:
+        liked_song_ids = set()
+    html = render_template('discover_songs.html', songs=songs, liked_song_ids=liked_song_ids)
+    songs_data = [{**song, 'liked': song['id'] in liked_song_ids} for song in songs]
+    return jsonify({'success': True, 'songs': songs_data, 'html': html, 'next_cursor': next_cursor})
 
 @app.route('/search', methods=['GET', 'POST'])
 def search():
-    query = request.form.get('query', '')
-    songs = Song.search(query) if query else []
-    liked_song_ids = current_user.get_liked_song_ids() if current_user.is_authenticated else []
-    return render_template('search.html', songs=songs, query=query, liked_song_ids=liked_song_ids)
+    query = request.values.get('query', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 24
+    songs, total = Song.search(query, page, per_page) if query else ([], 0)
+    liked_song_ids = current_user.get_liked_among([song.id for song in songs]) if current_user.is_authenticated else set()
+    return render_template('search.html', songs=songs, query=query, liked_song_ids=liked_song_ids,
+                           page=page, per_page=per_page, total=total, has_next=page * per_page < total)
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest():
+    """Typeahead completions for the search box."""
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    suggestions = []
+    for kind, item, label, artist in search_index.suggest(query, limit) if query else []:
+        if kind == 'artist':
+            url = url_for('artist_page', artist_name=quote(label, safe=''))
+        else:
+            url = url_for('search', query=label)
+        suggestions.append({'type': kind, 'label': label, 'artist': artist, 'url': url})
+    response = jsonify({'success': True, 'suggestions': suggestions})
+    # Short prefixes change rarely relative to how often they are typed
+    response.headers['Cache-Control'] = f"public, max-age={60 if len(query) <= 2 else 10}"
+    return response
 
 
 @app.route('/like/<song_id>', methods=['POST'])
@@ -141,6 +293,30 @@ def remove_from_playlist():
         print(f"Error removing from playlist: {e}")
         return jsonify({'success': False, 'message': 'Error removing song from playlist'}), 500
 
+@app.route('/playlist/reorder', methods=['POST'])
+@login_required
+def reorder_playlist():
+    """Moves a song to just after `after_song_id` (to the top when it is missing)."""
+    try:
+        data = request.get_json()
+        playlist_id = data.get('playlist_id')
+        song_id = data.get('song_id')
+        after_song_id = data.get('after_song_id') or None
+        
+        if not playlist_id or not song_id:
+            return jsonify({'success': False, 'message': 'Missing playlist or song ID'}), 400
+        
+        success = current_user.move_song_in_playlist(playlist_id, song_id, after_song_id)
+        
+        if success:
+            return jsonify({'success': True, 'message': 'Playlist reordered'})
+        else:
+            return jsonify({'success': False, 'message': 'Failed to reorder playlist'}), 400
+            
+    except Exception as e:
+        print(f"Error reordering playlist: {e}")
+        return jsonify({'success': False, 'message': 'Error reordering playlist'}), 500
+
 @app.route('/playlist/delete', methods=['POST'])
 @login_required
 def delete_playlist():
@@ -186,6 +362,7 @@ def track_song_play():
         success = current_user.add_to_recently_played(song_id)
         
         if success:
+            trending.record_play(song_id)
             return jsonify({'success': True, 'message': 'Song play tracked'})
         else:
             return jsonify({'success': False, 'message': 'Failed to track song play'}), 400
@@ -218,68 +395,77 @@ def get_recently_played():
         print(f"Error getting recently played: {e}")
         return jsonify({'success': False, 'message': 'Error fetching recently played songs'}), 500
 
+@app.route('/api/history')
+@login_required
+def get_listening_history():
+    """One page of the user's listening history, newest first."""
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    plays, next_cursor = current_user.get_listening_history(request.args.get('cursor'), limit)
+    return jsonify({'success': True, 'next_cursor': next_cursor, 'plays': [{
+        'played_at': played_at.isoformat() + 'Z',
+        'song': {'id': song.id, 'title': song.title, 'artist': song.artist, 'album': song.album,
+                 'album_art_id': song.album_art_id, 'file_id': song.file_id}
+    } for song, played_at in plays]})
+
+@app.route('/api/history/top')
+@login_required
+def get_top_tracks():
+    """The user's most played songs between ?from= and ?to= (YYYY-MM-DD, default the last 30 days)."""
+    try:
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d') if request.args.get('to') else datetime.utcnow()
+        start = datetime.strptime(request.args['from'], '%Y-%m-%d') if request.args.get('from') \
+            else end - timedelta(days=29)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Dates must look like YYYY-MM-DD'}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    return jsonify({'success': True, 'tracks': [{
+        'plays': plays,
+        'song': {'id': song.id, 'title': song.title, 'artist': song.artist, 'album': song.album,
+                 'album_art_id': song.album_art_id, 'file_id': song.file_id}
+    } for song, plays in current_user.get_top_tracks(start, end, limit)]})
+
+def build_album_details(album_name, artist_name):
+    """The album popup's payload, or None if the album has no tracks."""
+    # Track ids come from the album's read model, songs from one batched lookup
+    album = Album.get_tracks(album_name, artist_name)
+    if not album:
+        return None
+    album_doc, album_songs = album
+    album_art_id = str(album_doc['album_art_id']) if album_doc.get('album_art_id') else None
+    
+    # Prepare response data
+    songs_data = []
+    for song in album_songs:
+        songs_data.append({
+            'id': song.id,
+            'title': song.title,
+            'artist': song.artist,
+            'album': song.album,
+            'genre': song.genre,
+            'album_art_id': song.album_art_id,
+            'file_id': song.file_id
+        })
+    
+    # The description is stored on the same album document
+    description = album_doc.get('description') or ''
+    return {
+        'name': album_name,
+        'artist': artist_name,
+        'album_art_id': album_art_id,
+        'song_count': len(album_songs),
+        'songs': songs_data,
+        'description': description,
+        'has_description': bool(description.strip())
+    }
+
 @app.route('/api/album/<album_name>/<artist_name>', methods=['GET'])
 def get_album_details(album_name, artist_name):
     """Get album details with all songs for the popup."""
     try:
-        # Find all songs in the specified album by the artist
-        album_songs = []
-        query = {
-            'album': album_name,
-            'artist': {'$regex': f'^{re.escape(artist_name)}$', '$options': 'i'}
-        }
-        
-        songs_cursor = mongo_db.songs_collection.find(query).sort('upload_date', 1)
-        
-        album_art_id = None
-        for song_doc in songs_cursor:
-            song = Song(
-                title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                artist_description=song_doc.get('artist_description')
-            )
-            song.id = str(song_doc['_id'])
-            song.upload_date = song_doc.get('upload_date')
-            album_songs.append(song)
-            
-            # Get album art from first song that has it
-            if not album_art_id and song_doc.get('album_art_id'):
-                album_art_id = str(song_doc['album_art_id'])
-        
-        if not album_songs:
+        album_data = page_cache.get_or_set('album', (album_name, artist_name),
+                                           lambda: build_album_details(album_name, artist_name))
+        if album_data is None:
             return jsonify({'success': False, 'message': 'Album not found'}), 404
-        
-        # Prepare response data
-        songs_data = []
-        for song in album_songs:
-            songs_data.append({
-                'id': song.id,
-                'title': song.title,
-                'artist': song.artist,
-                'album': song.album,
-                'genre': song.genre,
-                'album_art_id': song.album_art_id,
-                'file_id': song.file_id
-            })
-        
-        album_data = {
-            'name': album_name,
-            'artist': artist_name,
-            'album_art_id': album_art_id,
-            'song_count': len(album_songs),
-            'songs': songs_data
-        }
-        
-        # Get album info (description) if available
-        album_info = Artist.get_album_info(album_name, artist_name)
-        if album_info:
-            album_data['description'] = album_info.get('description', '')
-            album_data['has_description'] = bool(album_info.get('description', '').strip())
-        else:
-            album_data['description'] = ''
-            album_data['has_description'] = False
-        
         return jsonify({'success': True, 'album': album_data})
     except Exception as e:
         print(f"Error getting album details: {e}")
@@ -316,8 +502,8 @@ def save_album_info(album_name, artist_name):
 @app.route('/library')
 @login_required
 def library():
-    # Get all user playlists including Liked Songs
-    all_playlists = current_user.get_all_playlists()
+    # Playlist summaries only; songs are fetched page by page as a playlist is opened
+    all_playlists = current_user.get_playlist_summaries()
     
     # Ensure Liked Songs is first
     liked_songs_playlist = None
@@ -331,19 +517,45 @@ def library():
     
     # If no liked songs playlist exists, create it
     if not liked_songs_playlist:
-        liked_song_ids = current_user.get_liked_song_ids()
-        liked_songs = Song.get_songs_by_ids(liked_song_ids)
+        liked_playlist_doc = current_user.get_liked_songs_playlist()
         liked_songs_playlist = {
+            'id': str(liked_playlist_doc['_id']),
             'name': 'Liked Songs',
-            'song_count': len(liked_songs),
-            'songs': liked_songs
+            'song_count': 0,
+            'cover_art_ids': []
         }
     
     # Arrange playlists with Liked Songs first
     playlists = [liked_songs_playlist] + other_playlists
+    return render_template('library.html', playlists=playlists)
+
+@app.route('/api/playlist/<playlist_id>/songs', methods=['GET'])
+@login_required
+def get_playlist_songs(playlist_id):
+    """One page of a playlist's songs; `cursor` is the value of next_cursor from the previous page."""
+    cursor = request.args.get('cursor') or None
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    page = current_user.get_playlist_songs(playlist_id, cursor, limit)
+    if page is None:
+        return jsonify({'success': False, 'message': 'Playlist not found'}), 404
     
-    liked_song_ids = current_user.get_liked_song_ids()
-    return render_template('library.html', playlists=playlists, liked_song_ids=liked_song_ids)
+    playlist_name, songs, next_cursor = page
+    if playlist_name == 'Liked Songs':
+        liked_song_ids = {song.id for song in songs}
+    else:
+        liked_song_ids = current_user.get_liked_among([song.id for song in songs])
+    
+    songs_data = [{
+        'id': song.id,
+        'title': song.title,
+        'artist': song.artist,
+        'album': song.album,
+        'album_art_id': song.album_art_id,
+        'file_id': song.file_id,
+        'liked': song.id in liked_song_ids
+    } for song in songs]
+    html = render_template('playlist_songs.html', songs=songs, liked_song_ids=liked_song_ids)
+    return jsonify({'success': True, 'songs': songs_data, 'html': html, 'next_cursor': next_cursor})
     
 @app.route('/api/song/<song_id>/playlists', methods=['GET'])
 @login_required
@@ -356,6 +568,17 @@ def get_song_playlists(song_id):
         print(f"Error getting song's playlists: {e}")
         return jsonify({'success': False, 'message': 'An error occurred while fetching song playlists'}), 500
 
+@app.route('/api/song/<song_id>/similar', methods=['GET'])
+def get_similar_songs(song_id):
+    """Songs that share playlists with this one ("more like this", radio)."""
+    if not ObjectId.is_valid(song_id):
+        return jsonify({'success': False, 'message': 'Invalid song ID'}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+    return jsonify({'success': True, 'songs': [{
+        'id': song.id, 'title': song.title, 'artist': song.artist, 'album': song.album, 'genre': song.genre,
+        'album_art_id': song.album_art_id, 'file_id': song.file_id, 'score': score
+    } for song, score in Song.get_similar(song_id, limit)]})
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -367,6 +590,7 @@ def login():
         if user_data and check_password_hash(user_data['password'], password):
             user = User(user_data)
             login_user(user)
+            remember_profile(user)
             flash('Logged in successfully!', 'success')
             if user.is_admin:
                 return redirect(url_for('upload'))
@@ -400,6 +624,8 @@ def register():
 @app.route('/logout')
 @login_required
 def logout():
+    User.forget(current_user.id)
+    session.pop('user_profile', None)
     logout_user()
     flash('You have been logged out.', 'info')
     return redirect(url_for('login'))
@@ -417,17 +643,14 @@ def upload():
         artist_description = request.form.get('artist_description', '')
         
         if file and allowed_files(file.filename):
-            # Store the audio file
-            file_data = file.read()
+            # Stream the audio file into GridFS chunk by chunk
             metadata = {'title': title, 'artist': artist, 'genre': genre, 'album': album, 'content_type': file.content_type}
-            file_id = Song.store_file(file_data, file.filename, metadata)
+            file_id = Song.store_file(file.stream, file.filename, metadata)
             
             # Store album art if provided
             album_art_id = None
             if album_art and album_art.filename and allowed_image_files(album_art.filename):
-                album_art_data = album_art.read()
-                album_art_metadata = {'content_type': album_art.content_type, 'type': 'album_art'}
-                album_art_id = Song.store_file(album_art_data, album_art.filename, album_art_metadata)
+                album_art_id = store_image(album_art, 'album_art')
             
             # Create and save song
             song = Song(title=title, artist=artist, genre=genre, album=album, 
@@ -480,47 +703,75 @@ def upload_album():
         # Store album art once if provided
         album_art_id = None
         if album_art and album_art.filename and allowed_image_files(album_art.filename):
-            album_art_data = album_art.read()
-            album_art_metadata = {'content_type': album_art.content_type, 'type': 'album_art'}
-            album_art_id = Song.store_file(album_art_data, album_art.filename, album_art_metadata)
+            album_art_id = store_image(album_art, 'album_art')
         
-        # Process each song
-        uploaded_count = 0
+        # Progress is reported under a client-generated id so the page can poll it
+        upload_id = request.form.get('upload_id', '')
+        if not re.fullmatch(r'[A-Za-z0-9-]{8,64}', upload_id):
+            upload_id = uuid4().hex
+        AlbumUpload.start(upload_id, [file.filename for file in valid_files])
+
+        def store_track(i, file, song_title):
+            metadata = {
+                'title': song_title, 
+                'artist': artist, 
+                'genre': genre, 
+                'album': album, 
+                'content_type': file.content_type
+            }
+            # Stream the audio file into GridFS chunk by chunk
+            file_id = Song.store_file(file.stream, file.filename, metadata)
+            AlbumUpload.set_track_status(upload_id, i, 'stored')
+            return Song(
+                title=song_title, 
+                artist=artist, 
+                genre=genre, 
+                album=album,
+                file_id=file_id, 
+                filename=file.filename, 
+                album_art_id=album_art_id,
+                artist_description=artist_description
+            )
+
+        # Write the audio files to GridFS concurrently
+        songs = {}
         failed_uploads = []
-        
-        for i, file in enumerate(valid_files):
-            try:
+        with ThreadPoolExecutor(max_workers=app.config['ALBUM_UPLOAD_WORKERS']) as executor:
+            futures = {}
+            for i, file in enumerate(valid_files):
                 # Get individual song title or use filename
                 song_title = request.form.get(f'title_{i}') or file.filename.rsplit('.', 1)[0]
-                
-                # Store the audio file
-                file_data = file.read()
-                metadata = {
-                    'title': song_title, 
-                    'artist': artist, 
-                    'genre': genre, 
-                    'album': album, 
-                    'content_type': file.content_type
-                }
-                file_id = Song.store_file(file_data, file.filename, metadata)
-                
-                # Create and save song
-                song = Song(
-                    title=song_title, 
-                    artist=artist, 
-                    genre=genre, 
-                    album=album,
-                    file_id=file_id, 
-                    filename=file.filename, 
-                    album_art_id=album_art_id,
-                    artist_description=artist_description
-                )
-                song.save()
+                futures[executor.submit(store_track, i, file, song_title)] = i
+            for future in as_completed(futures):
+                i = futures[future]
+                filename = valid_files[i].filename
+                try:
+                    songs[i] = future.result()
+                except Exception as e:
+                    failed_uploads.append(f'{filename}: {str(e)}')
+                    AlbumUpload.set_track_status(upload_id, i, 'failed', str(e))
+                    print(f"Error uploading {filename}: {e}")
+
+        # Then save all song documents in a single insert, keeping track order
+        indexes = sorted(songs)
+        inserted_ids = Song.save_many([songs[i] for i in indexes])
+        uploaded_count = 0
+        for i, inserted_id in zip(indexes, inserted_ids):
+            if inserted_id:
                 uploaded_count += 1
-                
-            except Exception as e:
-                failed_uploads.append(f'{file.filename}: {str(e)}')
-                print(f"Error uploading {file.filename}: {e}")
+                AlbumUpload.set_track_status(upload_id, i, 'saved')
+            else:
+                failed_uploads.append(f'{valid_files[i].filename}: could not save song')
+                AlbumUpload.set_track_status(upload_id, i, 'failed', 'Could not save song')
+                BlobStore.release(songs[i].file_id)
+        AlbumUpload.finish(upload_id)
+
+        # The album art was stored once but is referenced by every saved track
+        if album_art_id:
+            if uploaded_count:
+                BlobStore.add_ref(album_art_id, uploaded_count - 1)
+            else:
+                BlobStore.release(album_art_id)
         
         # Provide feedback
         if uploaded_count > 0:
@@ -533,6 +784,15 @@ def upload_album():
     
     return render_template('upload_album.html')
 
+@app.route('/api/upload_album/<upload_id>/progress', methods=['GET'])
+@admin_required
+def upload_album_progress(upload_id):
+    """Per-track progress of an album upload that is being processed."""
+    progress = AlbumUpload.get(upload_id)
+    if not progress:
+        return jsonify({'success': False, 'message': 'Upload not started'}), 404
+    return jsonify({'success': True, 'progress': progress})
+
 @app.route('/edit/<song_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_song(song_id):
@@ -560,18 +820,16 @@ def edit_song(song_id):
         
         # Handle album art update if provided
         if album_art and album_art.filename and allowed_image_files(album_art.filename):
-            # Delete old album art if it exists
+            # Store new album art first so re-uploading the same image reuses its blob
+            new_album_art_id = store_image(album_art, 'album_art')
+            update_data['album_art_id'] = new_album_art_id
+
+            # Release old album art; it is only deleted once no other song uses it
             if song.album_art_id:
                 try:
-                    mongo_db.fs.delete(ObjectId(song.album_art_id))
+                    BlobStore.release(song.album_art_id)
                 except Exception as e:
                     print(f"Error deleting old album art: {e}")
-            
-            # Store new album art
-            album_art_data = album_art.read()
-            album_art_metadata = {'content_type': album_art.content_type, 'type': 'album_art'}
-            new_album_art_id = Song.store_file(album_art_data, album_art.filename, album_art_metadata)
-            update_data['album_art_id'] = new_album_art_id
         
         # Update the song in database
         if Song.update(song_id, update_data):
@@ -592,68 +850,111 @@ def delete_song(song_id):
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/stream/<file_id>')
+@skip_user_loading
 def stream_audio(file_id):
+    range_header = request.headers.get('Range')
+
+    # Hot tracks are served straight from the local disk cache. Multi-range requests
+    # are rare and fall through to GridFS, which builds the multipart body.
+    if not range_header or ',' not in range_header:
+        cached = audio_cache.get(file_id)
+        if cached:
+            etag, last_modified = file_validators(file_id, cached[2])
+            response = not_modified_response(etag, last_modified) or \
+                audio_cache.send(file_id, cached, etag, last_modified)
+            response.headers.update(cache_headers(etag, last_modified))
+            return response
+
     try:
+        # Only the files document is fetched here; chunks are read while streaming
         grid_fs_file = Song.get_file(file_id)
     except Exception as e:
         app.logger.error(f"Error finding file_id {file_id}: {e}")
         return "File not found", 404
 
+    etag, last_modified = file_validators(file_id, grid_fs_file.upload_date)
+    response = not_modified_response(etag, last_modified)
+    if response:
+        return response
+
+    audio_cache.fill_async(file_id, lambda: Song.get_file(file_id))
+
+    # A stale If-Range means the client's partial copy is outdated: send the whole file
+    if not range_allowed(request.headers.get('If-Range'), etag, last_modified):
+        range_header = None
+
     file_size = grid_fs_file.length
-    range_header = request.headers.get('Range', None)
-    
-    if not range_header:
+    content_type = grid_fs_file.content_type
+    ranges = parse_range_header(range_header, file_size)
+
+    if ranges is None:
         # If no range header, stream the entire file in chunks.
         # It's important to set 'Accept-Ranges' to 'bytes' to let the browser know
         # that it can request parts of the file in the future.
-        def generate():
-            chunk_size = 1024 * 1024 # 1MB chunks
-            while True:
-                chunk = grid_fs_file.read(chunk_size)
-                if not chunk:
-                    break
-                yield chunk
-
-        response = Response(stream_with_context(generate()), mimetype=grid_fs_file.content_type)
+        response = Response(stream_with_context(iter_file(grid_fs_file)), mimetype=content_type)
         response.headers['Content-Length'] = str(file_size)
         response.headers['Accept-Ranges'] = 'bytes'
+        response.headers.update(cache_headers(etag, last_modified))
         return response
 
-    # Handle the range request.
-    byte1, byte2 = 0, None
-    m = re.search(r'bytes=(\d+)-(\d*)', range_header)
-    if not m:
-        return "Invalid Range header", 416
-    
-    groups = m.groups()
-    byte1 = int(groups[0])
-    if groups[1]:
-        byte2 = int(groups[1])
-    
-    length = file_size - byte1
-    if byte2 is not None:
-        length = byte2 - byte1 + 1
-    
-    # Read the requested chunk from the GridFS file.
-    grid_fs_file.seek(byte1)
-    data_chunk = grid_fs_file.read(length)
-
-    # Create a 206 Partial Content response.
-    response = Response(data_chunk, 206, mimetype=grid_fs_file.content_type, direct_passthrough=True)
-    response.headers.add('Content-Range', f'bytes {byte1}-{byte1 + len(data_chunk) - 1}/{file_size}')
-    response.headers.add('Accept-Ranges', 'bytes')
-    response.headers.add('Content-Length', str(len(data_chunk)))
-    
+    if not ranges:
+        response = Response('Requested range not satisfiable', 416)
+        response.headers['Content-Range'] = f'bytes */{file_size}'
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    if len(ranges) == 1:
+        # Stream the requested span lazily so memory stays bounded by the chunk size.
+        start, end = ranges[0]
+        response = Response(stream_with_context(iter_file(grid_fs_file, start, end)), 206,
+                            mimetype=content_type, direct_passthrough=True)
+        response.headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        response.headers['Content-Length'] = str(end - start + 1)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers.update(cache_headers(etag, last_modified))
+        return response
+
+    body = MultipartRanges(ranges, content_type, file_size)
+    response = Response(stream_with_context(body.iter_file(grid_fs_file)), 206, content_type=body.content_type,
+                        direct_passthrough=True)
+    response.headers['Content-Length'] = str(body.content_length)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers.update(cache_headers(etag, last_modified))
+    return response
+
+def image_response(get_file, file_id):
+    """Serves a GridFS image, or its closest resized variant when `?w=` is given."""
+    grid_fs_file = get_file(file_id)
+    width = request.args.get('w', type=int)
+    served_id = file_id
+    immutable = True
+    if width:
+        accepts_webp = 'image/webp' in request.headers.get('Accept', '')
+        variant_id = pick_variant(grid_fs_file.metadata, width, accepts_webp)
+        if variant_id:
+            served_id = str(variant_id)
+            grid_fs_file = get_file(served_id)
+        elif 'variants' not in (grid_fs_file.metadata or {}):
+            # Not backfilled yet: the URL will later resolve to a variant, so don't pin it
+            immutable = False
+
+    etag, last_modified = file_validators(served_id, grid_fs_file.upload_date)
+    response = not_modified_response(etag, last_modified)
+    if not response:
+        content_type = grid_fs_file.metadata.get('content_type', 'image/jpeg')
+        response = Response(grid_fs_file.read(), mimetype=content_type)
+        response.headers.update(cache_headers(etag, last_modified))
+    if not immutable:
+        response.headers['Cache-Control'] = 'max-age=3600'
+    if width:
+        response.vary.add('Accept')
     return response
 
 @app.route('/album_art/<file_id>')
+@skip_user_loading
 def serve_album_art(file_id):
     try:
-        grid_fs_file = Song.get_file(file_id)
-        content_type = grid_fs_file.metadata.get('content_type', 'image/jpeg')
-        response = Response(grid_fs_file.read(), mimetype=content_type)
-        response.headers['Cache-Control'] = 'max-age=3600'  # Cache for 1 hour
-        return response
+        return image_response(Song.get_file, file_id)
     except Exception as e:
         # Return a 404 for missing album art
         return '', 404
@@ -662,15 +963,24 @@ def serve_album_art(file_id):
 def artist_page(artist_name):
     # URL decode the artist name to handle special characters
     decoded_artist_name = unquote(artist_name)
-    artist_info = Song.get_artist_info(decoded_artist_name)
-    if not artist_info:
+    
+    def render_artist_content():
+        artist_info = Song.get_artist_info(decoded_artist_name)
+        if not artist_info:
+            return None
+        return render_template('artist_content.html',
+                               artist=artist_info,
+                               artist_data=Artist.get_by_name(decoded_artist_name))
+    
+    # Everything but the viewer's likes is shared, so the body is cached per artist and role
+    artist_content = page_cache.get_or_set('artist', (normalize_key(decoded_artist_name), viewer_role()),
+                                           render_artist_content)
+    if artist_content is None:
         flash('Artist not found.', 'error')
         return redirect(url_for('search'))
     
     liked_song_ids = current_user.get_liked_song_ids() if current_user.is_authenticated else []
-    return render_template('artist.html', 
-                         artist=artist_info, 
-                         liked_song_ids=liked_song_ids)
+    return render_template('artist.html', artist_content=Markup(artist_content), liked_song_ids=liked_song_ids)
 
 @app.route('/artist/<artist_name>/update', methods=['POST'])
 @admin_required
@@ -699,18 +1009,16 @@ def update_artist_info(artist_name):
             
             # Handle photo update if provided
             if photo and photo.filename and allowed_image_files(photo.filename):
-                # Delete old photo if it exists
+                # Store new photo first so re-uploading the same image reuses its blob
+                new_photo_id = store_image(photo, 'artist_photo')
+                update_data['photo_id'] = new_photo_id
+
+                # Release old photo if it exists
                 if existing_artist.photo_id:
                     try:
-                        mongo_db.fs.delete(ObjectId(existing_artist.photo_id))
+                        BlobStore.release(existing_artist.photo_id)
                     except Exception as e:
                         print(f"Error deleting old artist photo: {e}")
-                
-                # Store new photo
-                photo_data = photo.read()
-                photo_metadata = {'content_type': photo.content_type, 'type': 'artist_photo'}
-                new_photo_id = Artist.store_file(photo_data, photo.filename, photo_metadata)
-                update_data['photo_id'] = new_photo_id
             
             # Update artist in database
             if Artist.update(existing_artist.id, update_data):
@@ -722,9 +1030,7 @@ def update_artist_info(artist_name):
             # Create new artist record
             photo_id = None
             if photo and photo.filename and allowed_image_files(photo.filename):
-                photo_data = photo.read()
-                photo_metadata = {'content_type': photo.content_type, 'type': 'artist_photo'}
-                photo_id = Artist.store_file(photo_data, photo.filename, photo_metadata)
+                photo_id = store_image(photo, 'artist_photo')
             
             # Create and save artist
             artist = Artist(name=name, description=description, photo_id=photo_id)
@@ -735,11 +1041,26 @@ def update_artist_info(artist_name):
         print(f"Error updating artist info: {e}")
         return jsonify({'success': False, 'message': 'An error occurred while updating artist information.'})
 
+@app.route('/admin/cache-stats')
+@admin_required
+def admin_cache_stats():
+    """Hit/miss counts of this worker's page cache."""
+    return jsonify({'success': True, 'stats': page_cache.stats()})
+
+@app.route('/admin/play-buffer-stats')
+@admin_required
+def admin_play_buffer_stats():
+    """Queue depth, flush sizes and latency of this worker's play buffer."""
+    return jsonify({'success': True, 'stats': play_buffer.stats()})
+
 @app.route('/admin/artists')
 @admin_required
 def admin_artists():
-    artists = Artist.get_all()
-    return render_template('admin_artists.html', artists=artists)
+    page = max(request.args.get('page', 1, type=int), 1)
+    artists, total = Artist.get_page(page)
+    Artist.prefetch_counts(artists)
+    return render_template('admin_artists.html', artists=artists, page=page, total=total,
+                           has_next=page * Artist.PER_PAGE < total, per_page=Artist.PER_PAGE)
 
 @app.route('/admin/artist/new', methods=['GET', 'POST'])
 @admin_required
@@ -762,9 +1083,7 @@ def admin_create_artist():
         # Store artist photo if provided
         photo_id = None
         if photo and photo.filename and allowed_image_files(photo.filename):
-            photo_data = photo.read()
-            photo_metadata = {'content_type': photo.content_type, 'type': 'artist_photo'}
-            photo_id = Artist.store_file(photo_data, photo.filename, photo_metadata)
+            photo_id = store_image(photo, 'artist_photo')
         
         # Create and save artist
         artist = Artist(name=name.strip(), description=description, photo_id=photo_id)
@@ -804,18 +1123,16 @@ def admin_edit_artist(artist_id):
         
         # Handle photo update if provided
         if photo and photo.filename and allowed_image_files(photo.filename):
-            # Delete old photo if it exists
+            # Store new photo first so re-uploading the same image reuses its blob
+            new_photo_id = store_image(photo, 'artist_photo')
+            update_data['photo_id'] = new_photo_id
+
+            # Release old photo if it exists
             if artist.photo_id:
                 try:
-                    mongo_db.fs.delete(ObjectId(artist.photo_id))
+                    BlobStore.release(artist.photo_id)
                 except Exception as e:
                     print(f"Error deleting old artist photo: {e}")
-            
-            # Store new photo
-            photo_data = photo.read()
-            photo_metadata = {'content_type': photo.content_type, 'type': 'artist_photo'}
-            new_photo_id = Artist.store_file(photo_data, photo.filename, photo_metadata)
-            update_data['photo_id'] = new_photo_id
         
         # Update artist in database
         if Artist.update(artist_id, update_data):
@@ -842,16 +1159,89 @@ def admin_delete_artist(artist_id):
     return redirect(url_for('admin_artists'))
 
 @app.route('/artist_photo/<file_id>')
+@skip_user_loading
 def serve_artist_photo(file_id):
     try:
-        grid_fs_file = Artist.get_file(file_id)
-        content_type = grid_fs_file.metadata.get('content_type', 'image/jpeg')
-        response = Response(grid_fs_file.read(), mimetype=content_type)
-        response.headers['Cache-Control'] = 'max-age=3600'  # Cache for 1 hour
-        return response
+        return image_response(Artist.get_file, file_id)
     except Exception as e:
         # Return a 404 for missing artist photos
         return '', 404
 
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    """Create every index in the index plan (safe to run repeatedly)."""
+    for collection, names in apply_indexes(mongo_db.db).items():
+        print(f"{collection}: {', '.join(names)}")
+
+@app.cli.command('rebuild-blob-refs')
+@click.option('--hash', 'compute_hashes', is_flag=True, help='Also hash files uploaded before deduplication.')
+def rebuild_blob_refs_command(compute_hashes):
+    """Recount GridFS file references from songs and artists."""
+    count = BlobStore.rebuild(compute_hashes)
+    print(f"Recorded references for {count} files.")
+
+@app.cli.command('backfill-keys')
+def backfill_keys_command():
+    """Add normalized artist/album keys to songs, artists and albums saved before they existed."""
+    print(f"Updated {backfill_normalized_keys()} documents")
+
+@app.cli.command('rebuild-albums')
+def rebuild_albums_command():
+    """Recompute the albums read model from the songs collection."""
+    backfill_normalized_keys()
+    print(f"Rebuilt {Album.rebuild()} albums.")
+    # Duplicates are merged now, so the unique albums index can be created
+    apply_indexes(mongo_db.db, {'albums': INDEXES['albums']})
+
+@app.cli.command('reconcile-artist-stats')
+def reconcile_artist_stats_command():
+    """Recompute every artist's song/album counters (run nightly, e.g. from cron)."""
+    print(f"Corrected stats for {Artist.reconcile_stats()} artists.")
+
+@app.cli.command('flush-plays')
+def flush_plays_command():
+    """Write plays left in PLAY_SPOOL_PATH by a worker that did not shut down cleanly."""
+    print(f"Recovered {play_buffer.recover()} plays from spool files.")
+    print(f"Wrote {play_buffer.flush()} plays.")
+
+@app.cli.command('migrate-playlist-items')
+def migrate_playlist_items_command():
+    """Move songs embedded in playlist documents to the playlist_items collection (also run on startup)."""
+    playlists, items = PlaylistItems.migrate()
+    print(f"Migrated {items} songs from {playlists} playlists.")
+
+@app.cli.command('build-similar')
+@click.option('--incremental', is_flag=True, help='Only score songs uploaded since the last full build.')
+def build_similar_command(incremental):
+    """Build "more like this" lists from playlist co-occurrence (full run nightly, incremental hourly)."""
+    # numpy and scipy are only needed by this offline job, not by the web workers
+    from similarity import METRICS, build_similar, refresh_similar
+    metric = app.config['SIMILAR_METRIC'] if app.config['SIMILAR_METRIC'] in METRICS else 'cosine'
+    options = dict(top_k=app.config['SIMILAR_TOP_K'], metric=metric, min_count=app.config['SIMILAR_MIN_COUNT'],
+                   max_length=app.config['SIMILAR_MAX_PLAYLIST_LENGTH'])
+    started = time.perf_counter()
+    if incremental:
+        print(f"Scored {refresh_similar(**options)} new songs in {time.perf_counter() - started:.1f} s.")
+    else:
+        print(f"Built neighbours for {build_similar(**options)} songs in {time.perf_counter() - started:.1f} s.")
+
+@app.cli.command('set-role')
+@click.argument('email')
+@click.argument('role', type=click.Choice(['user', 'admin']))
+def set_role_command(email, role):
+    """Change a user's role (running workers apply it within ROLE_CHANGE_CHECK_SECONDS)."""
+    user_data = mongo_db.users_collection.find_one({'email': email}, {'_id': 1})
+    if not user_data:
+        print(f"No user with email {email}.")
+        return
+    User.set_role(user_data['_id'], role)
+    print(f"{email} is now {role}.")
+
+@app.cli.command('backfill-thumbnails')
+def backfill_thumbnails_command():
+    """Generate resized variants for existing album art and artist photos."""
+    count = backfill_thumbnails()
+    print(f"Created thumbnails for {count} images.")
+
 if __name__ == '__main__':
     app.run(debug=True, port=8000)
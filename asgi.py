@@ -0,0 +1,19 @@
+"""Single ASGI entry point: media routes go to the async GridFS server, everything
+else to the Flask app.
+
+    uvicorn asgi:app --workers 2
+"""
+from a2wsgi import WSGIMiddleware
+from app import app as flask_app
+from async_media import app as media_app
+
+flask_asgi = WSGIMiddleware(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await media_app(scope, receive, send)
+    elif scope['type'] == 'http' and media_app.handles(scope['path']):
+        await media_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
@@ -0,0 +1,196 @@
+"""ASGI server for GridFS media (/stream, /album_art, /artist_photo).
+
+Built on pymongo's AsyncMongoClient so one process can hold thousands of slow listeners
+open without tying up a sync worker per connection. Range handling mirrors
+`app.stream_audio`. Run it on its own (`uvicorn async_media:app`) behind the same proxy
+as the Flask app, or use `asgi.py` to serve both from one process.
+"""
+import re
+from urllib.parse import parse_qs
+from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs import AsyncGridFSBucket
+from gridfs.errors import NoFile
+from pymongo import AsyncMongoClient
+from config import Config
+from media import STREAM_CHUNK_SIZE, parse_range_header, MultipartRanges, file_validators, cache_headers, \
+    is_not_modified, range_allowed, pick_variant
+
+MEDIA_ROUTES = re.compile(r'^/(stream|album_art|artist_photo)/([^/]+)$')
+
+
+class AsyncMediaServer:
+    def __init__(self, config=Config):
+        self.config = config
+        self.client = None
+        self.bucket = None
+
+    def _connect(self):
+        if self.client is None:
+            self.client = AsyncMongoClient(
+                self.config.MONGO_URI,
+                serverSelectionTimeoutMS=30000,
+                connectTimeoutMS=30000,
+                socketTimeoutMS=30000
+            )
+            self.bucket = AsyncGridFSBucket(self.client[self.config.MONGO_DB_NAME])
+        return self.bucket
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+            self.bucket = None
+
+    def handles(self, path):
+        return MEDIA_ROUTES.match(path) is not None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        m = MEDIA_ROUTES.match(scope['path'])
+        if not m or scope['method'] not in ('GET', 'HEAD'):
+            await _send_empty(send, 404)
+            return
+
+        kind, file_id = m.groups()
+        headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        try:
+            grid_out = await self._connect().open_download_stream(ObjectId(file_id))
+            width = None
+            immutable = True
+            if kind != 'stream':
+                # Serve a resized variant for ?w=, as app.image_response does
+                width = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('w', [''])[0]
+                width = int(width) if width.isdigit() else None
+                variant_id = width and pick_variant(grid_out.metadata, width, 'image/webp' in headers.get('accept', ''))
+                if variant_id:
+                    file_id = str(variant_id)
+                    grid_out = await self._connect().open_download_stream(variant_id)
+                elif width and 'variants' not in (grid_out.metadata or {}):
+                    immutable = False
+        except (InvalidId, NoFile):
+            await _send_empty(send, 404)
+            return
+
+        etag, last_modified = file_validators(file_id, grid_out.upload_date)
+        validators = [(name.lower().encode(), value.encode('latin-1'))
+                      for name, value in cache_headers(etag, last_modified).items()]
+        if not immutable:
+            validators = [(name, b'max-age=3600' if name == b'cache-control' else value)
+                          for name, value in validators]
+        if width:
+            validators.append((b'vary', b'Accept'))
+        if is_not_modified(headers.get('if-none-match'), headers.get('if-modified-since'), etag, last_modified):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': validators})
+            await _finish(send)
+            return
+
+        head_only = scope['method'] == 'HEAD'
+        if kind == 'stream':
+            range_header = headers.get('range')
+            if not range_allowed(headers.get('if-range'), etag, last_modified):
+                range_header = None
+            await self._send_audio(grid_out, range_header, validators, send, head_only)
+        else:
+            await self._send_image(grid_out, validators, send, head_only)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _send_audio(self, grid_out, range_header, validators, send, head_only):
+        file_size = grid_out.length
+        content_type = grid_out.content_type or 'application/octet-stream'
+        ranges = parse_range_header(range_header, file_size)
+
+        if ranges is None:
+            await _start(send, 200, content_type, file_size, validators)
+            if not head_only:
+                await _send_range(send, grid_out, 0, file_size - 1)
+            await _finish(send)
+            return
+
+        if not ranges:
+            await send({
+                'type': 'http.response.start',
+                'status': 416,
+                'headers': [
+                    (b'content-range', f'bytes */{file_size}'.encode()),
+                    (b'accept-ranges', b'bytes'),
+                    (b'content-length', b'0'),
+                ],
+            })
+            await _finish(send)
+            return
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            await _start(send, 206, content_type, end - start + 1,
+                         [(b'content-range', f'bytes {start}-{end}/{file_size}'.encode())] + validators)
+            if not head_only:
+                await _send_range(send, grid_out, start, end)
+            await _finish(send)
+            return
+
+        body = MultipartRanges(ranges, content_type, file_size)
+        await _start(send, 206, body.content_type, body.content_length, validators)
+        if not head_only:
+            for header, start, end in body.parts:
+                await send({'type': 'http.response.body', 'body': header, 'more_body': True})
+                await _send_range(send, grid_out, start, end)
+            await send({'type': 'http.response.body', 'body': body.closing, 'more_body': True})
+        await _finish(send)
+
+    async def _send_image(self, grid_out, validators, send, head_only):
+        content_type = (grid_out.metadata or {}).get('content_type', 'image/jpeg')
+        await _start(send, 200, content_type, grid_out.length, validators, accept_ranges=False)
+        if not head_only:
+            await _send_range(send, grid_out, 0, grid_out.length - 1)
+        await _finish(send)
+
+
+async def _start(send, status, content_type, content_length, extra_headers=(), accept_ranges=True):
+    headers = [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'content-length', str(content_length).encode()),
+    ]
+    if accept_ranges:
+        headers.append((b'accept-ranges', b'bytes'))
+    headers.extend(extra_headers)
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+
+
+async def _send_range(send, grid_out, start, end):
+    """Sends bytes `start`..`end` (inclusive), holding at most one chunk in memory."""
+    await grid_out.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        chunk = await grid_out.read(min(STREAM_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+
+async def _finish(send):
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _send_empty(send, status):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-length', b'0')]})
+    await _finish(send)
+
+
+app = AsyncMediaServer()
@@ -0,0 +1,191 @@
+"""Local on-disk cache of hot GridFS audio files.
+
+GridFS files never change once written, so cached copies are keyed by file id and only
+need removing when the file itself is deleted. Entries are evicted least-recently-used
+first (a hit bumps the file's mtime) once the cache grows past its size limit.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from bson import ObjectId
+from flask import Response, send_file
+
+# A fill lock older than this is assumed to belong to a crashed worker.
+STALE_LOCK_SECONDS = 600
+# The running size total only counts this worker's fills, so the directory is rescanned
+# this often to pick up other workers' (and when the total says the cache is full).
+RESCAN_SECONDS = 300
+# Eviction frees space down to this fraction of max_bytes, leaving room for further fills
+# before the next scan.
+EVICT_TO_FRACTION = 0.9
+
+
+class AudioCache:
+    def __init__(self):
+        self.directory = None
+        self.max_bytes = 0
+        self.accel_prefix = None
+        self._evict_lock = threading.Lock()
+        self._size = None      # Running total of cached bytes; None until the first scan
+        self._scanned_at = 0.0
+
+    def init_app(self, app):
+        self.directory = app.config.get('AUDIO_CACHE_DIR')
+        self.max_bytes = app.config.get('AUDIO_CACHE_MAX_BYTES', 0)
+        self.accel_prefix = app.config.get('AUDIO_CACHE_ACCEL_PREFIX')
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.max_bytes > 0
+
+    def _relative_path(self, file_id):
+        # Shard by the last two hex digits to keep directories small
+        return os.path.join(file_id[-2:], file_id)
+
+    def _path(self, file_id):
+        return os.path.join(self.directory, self._relative_path(file_id))
+
+    def get(self, file_id):
+        """Returns (path, content_type, upload_date) for a cached file, or None on a miss."""
+        if not self.enabled or not ObjectId.is_valid(file_id):
+            return None
+        path = self._path(file_id)
+        try:
+            with open(path + '.meta') as f:
+                meta = json.load(f)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):
+            return None
+        upload_date = datetime.fromtimestamp(meta['upload_date'], timezone.utc)
+        return path, meta['content_type'], upload_date
+
+    def send(self, file_id, entry, etag, last_modified):
+        """Builds a response for a cache hit without copying bytes through Python."""
+        path, content_type, _ = entry
+        if self.accel_prefix:
+            # Let nginx serve the file (and handle Range) from its internal location
+            response = Response(mimetype=content_type)
+            response.headers['X-Accel-Redirect'] = self.accel_prefix.rstrip('/') + '/' + \
+                self._relative_path(file_id).replace(os.sep, '/')
+            return response
+        # Werkzeug applies If-None-Match, If-Modified-Since, If-Range and Range itself
+        return send_file(path, mimetype=content_type, conditional=True, etag=etag,
+                         last_modified=last_modified)
+
+    def fill_async(self, file_id, open_file):
+        """Copies a file into the cache in the background.
+
+        `open_file` returns a fresh readable GridFS file. Only one worker fills a given id
+        at a time; anyone else who misses meanwhile keeps streaming from GridFS.
+        """
+        if not self.enabled or not ObjectId.is_valid(file_id):
+            return
+        path = self._path(file_id)
+        if os.path.exists(path) or not self._acquire_fill_lock(path):
+            return
+        thread = threading.Thread(target=self._fill, args=(file_id, path, open_file), daemon=True)
+        thread.start()
+
+    def _acquire_fill_lock(self, path):
+        lock_path = path + '.lock'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            if time.time() - os.path.getmtime(lock_path) > STALE_LOCK_SECONDS:
+                os.remove(lock_path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _fill(self, file_id, path, open_file):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            grid_fs_file = open_file()
+            if grid_fs_file.length > self.max_bytes:
+                return
+            with open(tmp_path, 'wb') as f:
+                while True:
+                    chunk = grid_fs_file.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            with open(tmp_path + '.meta', 'w') as f:
+                json.dump({
+                    'content_type': grid_fs_file.content_type,
+                    'upload_date': grid_fs_file.upload_date.replace(tzinfo=timezone.utc).timestamp(),
+                }, f)
+            # Publish the data before its metadata so readers never see a partial file
+            os.replace(tmp_path, path)
+            os.replace(tmp_path + '.meta', path + '.meta')
+            self._evict(grid_fs_file.length)
+        except Exception as e:
+            print(f"Error caching audio file {file_id}: {e}")
+        finally:
+            for leftover in (tmp_path, tmp_path + '.meta', path + '.lock'):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+
+    def _evict(self, added):
+        """Counts `added` bytes and, once the cache is over max_bytes, removes least recently
+        used entries until it fits. Only then (or every RESCAN_SECONDS) is the directory walked."""
+        with self._evict_lock:
+            if self._size is not None and time.monotonic() - self._scanned_at < RESCAN_SECONDS:
+                self._size += added
+                if self._size <= self.max_bytes:
+                    return
+            entries = []
+            total = 0
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if not ObjectId.is_valid(name):
+                        continue
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+                    total += stat.st_size
+
+            entries.sort()
+            target = self.max_bytes if total <= self.max_bytes else self.max_bytes * EVICT_TO_FRACTION
+            for _, size, name in entries:
+                if total <= target:
+                    break
+                self._remove(self._path(name))
+                total -= size
+            self._size = total
+            self._scanned_at = time.monotonic()
+
+    def discard(self, file_id):
+        """Drops a file from the cache, e.g. after it is deleted from GridFS."""
+        if not self.enabled or not ObjectId.is_valid(str(file_id)):
+            return
+        path = self._path(str(file_id))
+        with self._evict_lock:
+            try:
+                size = os.path.getsize(path)
+                if self._size is not None:
+                    self._size -= size
+            except OSError:
+                pass
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        for name in (path + '.meta', path):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
+audio_cache = AudioCache()
@@ -0,0 +1,89 @@
+"""Measures how many slow listeners a /stream endpoint can hold open at once.
+
+Each simulated listener requests a track and then reads it at roughly real-time
+bitrate, like a browser <audio> element. A listener counts as served if it receives
+its first body bytes within --timeout seconds. Run it against both deployments:
+
+    gunicorn app:app --workers 4                # sync path
+    python benchmarks/concurrent_listeners.py http://127.0.0.1:8000 <file_id>
+
+    uvicorn asgi:app --port 8001 --workers 1    # async path
+    python benchmarks/concurrent_listeners.py http://127.0.0.1:8001 <file_id>
+
+Only the standard library is used so it can run from any machine.
+"""
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def listen(host, port, path, read_rate, duration, timeout):
+    """Returns seconds to first body byte, or None if the listener was not served."""
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\nRange: bytes=0-\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        await writer.drain()
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        first = await asyncio.wait_for(reader.read(1), timeout)
+        if not first:
+            return None
+        first_byte = time.perf_counter() - started
+
+        # Keep the connection busy at listening speed for the rest of the run
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            if not await reader.read(read_rate):
+                break
+            await asyncio.sleep(1)
+        return first_byte
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return None
+    finally:
+        writer.close()
+
+
+async def run(url, file_id, listeners, read_rate, duration, timeout, ramp):
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    path = f'{parts.path.rstrip("/")}/stream/{file_id}'
+
+    tasks = []
+    for _ in range(listeners):
+        tasks.append(asyncio.create_task(listen(host, port, path, read_rate, duration, timeout)))
+        if ramp:
+            await asyncio.sleep(ramp)
+    results = await asyncio.gather(*tasks)
+
+    served = sorted(r for r in results if r is not None)
+    print(f'target:    {url}')
+    print(f'listeners: {listeners}')
+    print(f'served:    {len(served)} ({100 * len(served) / listeners:.1f}%)')
+    if served:
+        p50 = served[len(served) // 2]
+        p99 = served[min(len(served) - 1, int(len(served) * 0.99))]
+        print(f'first byte p50: {p50 * 1000:.0f} ms, p99: {p99 * 1000:.0f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('url', help='Base URL of the server, e.g. http://127.0.0.1:8000')
+    parser.add_argument('file_id', help='GridFS id of an audio file to stream')
+    parser.add_argument('--listeners', type=int, default=1000)
+    parser.add_argument('--read-rate', type=int, default=40 * 1024,
+                        help='Bytes read per second per listener (default ~320 kbps)')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds each listener stays connected')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for first byte')
+    parser.add_argument('--ramp', type=float, default=0.002, help='Delay between opening listeners')
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.file_id, args.listeners, args.read_rate,
+                    args.duration, args.timeout, args.ramp))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""Index regression check: explains every query shape used by models.py and app.py.
+
+Seeds a scratch database with a synthetic catalog, applies the index plan from
+indexes.py and runs explain() for each query. Exits non-zero if any query that is
+expected to be indexed uses a COLLSCAN, and prints the time of each query.
+
+    python benchmarks/explain_queries.py --songs 100000 --playlists 100000
+
+Uses MONGO_URI from config.py; the scratch database is dropped afterwards unless --keep.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import MongoClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from config import Config  # noqa: E402
+from indexes import apply_indexes  # noqa: E402
+from models import normalize_key  # noqa: E402
+
+
+def seed(db, song_count, playlist_count, artist_count=500, user_count=1000):
+    now = datetime.utcnow()
+    artists = [f'Artist {i}' for i in range(artist_count)]
+    songs = []
+    for i in range(song_count):
+        artist = random.choice(artists)
+        songs.append({
+            '_id': ObjectId(),
+            'title': f'Song {i}',
+            'artist': artist,
+            'genre': random.choice(['rock', 'pop', 'jazz', 'hip hop', 'classical']),
+            'album': f'{artist} Album {i % 7}',
+            'artist_key': normalize_key(artist),
+            'album_key': normalize_key(f'{artist} Album {i % 7}'),
+            'file_id': ObjectId(),
+            'filename': f'song_{i}.mp3',
+            'album_art_id': ObjectId(),
+            'artist_description': 'x' * 500,
+            'upload_date': now - timedelta(minutes=i)
+        })
+    for start in range(0, len(songs), 10000):
+        db.songs.insert_many(songs[start:start + 10000])
+
+    db.artists.insert_many([{'name': name, 'name_key': normalize_key(name), 'description': '', 'photo_id': None}
+                            for name in artists])
+    db.albums.insert_many([{'name': f'{name} Album 0', 'artist': name, 'description': '',
+                            'artist_key': normalize_key(name), 'album_key': normalize_key(f'{name} Album 0'),
+                            'track_count': 1, 'latest_upload': now - timedelta(minutes=i), 'track_ids': []}
+                           for i, name in enumerate(artists)])
+    users = [{'_id': ObjectId(), 'email': f'user{i}@example.com', 'username': f'user{i}'} for i in range(user_count)]
+    db.users.insert_many(users)
+
+    song_ids = [song['_id'] for song in songs]
+    playlists, items = [], []
+    for i in range(playlist_count):
+        playlist = {
+            '_id': ObjectId(),
+            'user_id': users[i % user_count]['_id'],
+            'name': 'Liked Songs' if i < user_count else f'Playlist {i}',
+            'song_count': min(20, len(song_ids)),
+            'tail_position': min(20, len(song_ids)) * 1024.0
+        }
+        playlists.append(playlist)
+        items.extend({'playlist_id': playlist['_id'], 'user_id': playlist['user_id'], 'song_id': song_id,
+                      'position': (position + 1) * 1024.0, 'added_date': now}
+                     for position, song_id in enumerate(random.sample(song_ids, playlist['song_count'])))
+        if len(playlists) == 10000:
+            db.playlists.insert_many(playlists)
+            db.playlist_items.insert_many(items)
+            playlists, items = [], []
+    if playlists:
+        db.playlists.insert_many(playlists)
+        db.playlist_items.insert_many(items)
+    return songs[0], users[0], db.playlists.find_one({'user_id': users[0]['_id']})
+
+
+def query_shapes(song, user, playlist):
+    """(name, collection, filter, sort, reason a scan is accepted or None)."""
+    artist_key = song['artist_key']
+    album_key = song['album_key']
+    return [
+        ('Song.get_by_id', 'songs', {'_id': song['_id']}, None, None),
+        ('Song.get_songs_by_ids', 'songs', {'_id': {'$in': [song['_id']]}}, None, None),
+        ('Song.get_recent_uploads', 'songs', {}, [('upload_date', -1)], None),
+        ('Song.get_artist_info', 'songs', {'artist_key': artist_key}, None, None),
+        ('Artist._load_counts', 'songs', {'artist_key': {'$in': [artist_key]}}, None, None),
+        ('Album.refresh', 'songs', {'album_key': album_key, 'artist_key': artist_key}, [('upload_date', 1)], None),
+        ('Album.rebuild', 'songs', {'album_key': {'$nin': [None, '']}},
+         [('album_key', 1), ('artist_key', 1), ('upload_date', 1)], None),
+        ('Song.search', 'songs', {'$or': [{'title': {'$regex': 'song 1', '$options': 'i'}},
+                                          {'artist': {'$regex': 'song 1', '$options': 'i'}}]}, None,
+         'regex fallback, only used while the search index builds'),
+        ('SearchIndex.catch_up', 'songs', {'$or': [{'upload_date': {'$gte': song['upload_date']}},
+                                                   {'updated_date': {'$gte': song['upload_date']}}]}, None, None),
+        ('User.get', 'users', {'_id': user['_id']}, None, None),
+        ('login/register', 'users', {'email': user['email']}, None, None),
+        ('ListeningHistory.page', 'listening_history', {'user_id': user['_id']}, [('day', -1), ('_id', -1)], None),
+        ('ListeningHistory.top_tracks', 'listening_history',
+         {'user_id': user['_id'], 'day': {'$gte': song['upload_date'] - timedelta(days=30), '$lt': song['upload_date']}},
+         None, None),
+        ('User.get_liked_songs_playlist', 'playlists', {'user_id': user['_id'], 'name': 'Liked Songs'}, None, None),
+        ('User.get_playlist_summaries', 'playlists', {'user_id': user['_id']}, [('name', 1)], None),
+        ('User.get_playlist_names', 'playlists', {'user_id': user['_id'], 'name': {'$ne': 'Liked Songs'}},
+         [('name', 1)], None),
+        ('PlaylistItems.add/remove', 'playlist_items', {'playlist_id': playlist['_id'], 'song_id': song['_id']},
+         None, None),
+        ('PlaylistItems.page', 'playlist_items',
+         {'playlist_id': playlist['_id'], '$or': [{'position': {'$gt': 1024.0}},
+                                                  {'position': 1024.0, '_id': {'$gt': ObjectId()}}]},
+         [('position', 1), ('_id', 1)], None),
+        ('User.get_playlists_for_song', 'playlist_items', {'song_id': song['_id'], 'user_id': user['_id']},
+         None, None),
+        ('refresh_similar', 'playlist_items', {'song_id': {'$in': [song['_id']]}}, None, None),
+        ('build_similar', 'playlist_items', {}, [('playlist_id', 1), ('position', 1), ('_id', 1)], None),
+        ('Artist.get_page', 'artists', {}, [('name', 1)], None),
+        ('Artist._load_by_keys', 'artists', {'name_key': {'$in': [artist_key]}}, None, None),
+        ('Artist.adjust_stats', 'artists', {'name_key': artist_key}, None, None),
+        ('Artist.compute_stats', 'albums', {'artist_key': {'$in': [artist_key]}, 'track_count': {'$gt': 0}},
+         None, None),
+        ('Album.get_tracks', 'albums', {'artist_key': artist_key, 'album_key': album_key}, None, None),
+        ('Album.get_recent', 'albums', {'track_count': {'$gt': 0}}, [('latest_upload', -1)], None),
+        ('Album.get_by_artist', 'albums', {'artist_key': artist_key, 'track_count': {'$gt': 0}},
+         [('latest_upload', -1)], None),
+        ('BlobStore.put', 'blobs', {'sha256': '0' * 64, 'refs': {'$gt': 0}}, None, None),
+        ('MongoDB.delete_file', 'fs.files', {'metadata.original_id': song['album_art_id']}, None, None),
+    ]
+
+
+def plan_stages(plan):
+    """Yields every stage name in an explain() winning plan."""
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from plan_stages(item)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--songs', type=int, default=100000)
+    parser.add_argument('--playlists', type=int, default=100000)
+    parser.add_argument('--db', default='music_app_explain')
+    parser.add_argument('--keep', action='store_true', help='Keep the seeded database')
+    args = parser.parse_args()
+
+    client = MongoClient(Config.MONGO_URI)
+    db = client[args.db]
+    client.drop_database(args.db)
+    try:
+        print(f'Seeding {args.songs} songs and {args.playlists} playlists...')
+        song, user, playlist = seed(db, args.songs, args.playlists)
+        apply_indexes(db)
+
+        failures = 0
+        for name, collection, query, sort, accepted_scan in query_shapes(song, user, playlist):
+            cursor = db[collection].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            started = time.perf_counter()
+            explain = cursor.explain()
+            elapsed = (time.perf_counter() - started) * 1000
+            stages = set(plan_stages(explain['queryPlanner']['winningPlan']))
+            scanned = 'COLLSCAN' in stages
+            status = 'ok'
+            if scanned and accepted_scan:
+                status = f'scan accepted: {accepted_scan}'
+            elif scanned:
+                status = 'COLLSCAN'
+                failures += 1
+            print(f'{name:34} {collection:14} {elapsed:8.1f} ms  {status}')
+
+        if failures:
+            print(f'{failures} queries need a collection scan; add indexes to indexes.py')
+            sys.exit(1)
+        print('All registered queries are indexed.')
+    finally:
+        if not args.keep:
+            client.drop_database(args.db)
+
+
+if __name__ == '__main__':
+    main()
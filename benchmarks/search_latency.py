@@ -0,0 +1,90 @@
+"""Latency of the in-memory search index on a synthetic catalog.
+
+Builds search_index.SearchIndex from generated songs (no MongoDB needed) and reports
+build time and uncached p50/p99 latency of search queries (exact, prefix, broad and
+misspelled) and of typeahead suggestions.
+
+    python benchmarks/search_latency.py --songs 500000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from search_index import SearchIndex  # noqa: E402
+
+WORDS = tuple(('love night heart dream fire rain summer blue gold wild road home light dance river '
+               'shadow storm ocean city star moon sun midnight echo silver broken electric paradise').split())
+GENRES = ('rock', 'pop', 'jazz', 'hip hop', 'classical', 'electronic', 'folk', 'metal')
+
+
+def random_name(words, low, high):
+    return ' '.join(random.choice(words) for _ in range(random.randint(low, high))).title()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--songs', type=int, default=500000)
+    parser.add_argument('--queries', type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(470)
+    # Synthetic vocabulary so the index has a realistic number of distinct terms
+    vocabulary = WORDS + tuple(''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(4, 9)))
+                               for _ in range(20000))
+    artists = [random_name(vocabulary, 1, 3) for _ in range(args.songs // 20 or 1)]
+    now = datetime.utcnow()
+
+    index = SearchIndex()
+    started = time.perf_counter()
+    for i in range(args.songs):
+        artist = random.choice(artists)
+        index._index(str(i), {
+            'title': random_name(vocabulary, 1, 4), 'artist': artist, 'album': random_name(vocabulary, 1, 3),
+            'genre': random.choice(GENRES), 'upload_date': now - timedelta(minutes=i)
+        }, sort_terms=False)
+    index.terms = sorted(index.postings)
+    index.suggestions.finish_build()
+    index._order_broad_terms()
+    print(f'Indexed {args.songs} songs, {len(index.terms)} terms in {time.perf_counter() - started:.1f} s')
+
+    def misspell(word):
+        i = random.randrange(len(word))
+        return word[:i] + random.choice('aeiou') + word[i + 1:]
+
+    kinds = {
+        'exact': lambda: random.choice(artists),
+        'prefix': lambda: random.choice(artists)[:4],
+        'two terms': lambda: f'{random.choice(WORDS)} {random.choice(WORDS)}',
+        'genre': lambda: random.choice(GENRES),
+        'typo': lambda: misspell(random.choice(vocabulary[len(WORDS):])),
+    }
+    for kind, make_query in kinds.items():
+        timings = []
+        for _ in range(args.queries):
+            query = make_query()
+            index._results.clear()  # Measure uncached ranking
+            started = time.perf_counter()
+            index.search(query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f'{kind:10} p50 {timings[len(timings) // 2]:7.2f} ms   p99 {timings[int(len(timings) * 0.99)]:7.2f} ms')
+
+
+    # Typeahead: one request per keystroke of an artist name
+    timings = []
+    for _ in range(args.queries):
+        name = random.choice(artists)
+        for length in range(1, min(len(name), 8) + 1):
+            started = time.perf_counter()
+            index.suggest(name[:length])
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f'{"suggest":10} p50 {timings[len(timings) // 2]:7.2f} ms   p99 {timings[int(len(timings) * 0.99)]:7.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
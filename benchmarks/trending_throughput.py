@@ -0,0 +1,77 @@
+"""Throughput and accuracy of the trending charts on a synthetic play stream.
+
+Feeds trending.Trending (no MongoDB needed) with Zipf-distributed plays spread over a
+simulated week and reports plays recorded per second in one process, chart read latency,
+and how many of the exact top songs of the last hour, day and week the charts found.
+
+    python benchmarks/trending_throughput.py --plays 500000 --songs 200000
+"""
+import argparse
+import bisect
+import itertools
+import math
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from trending import Trending, WINDOWS  # noqa: E402
+
+GENRES = ('rock', 'pop', 'jazz', 'hip hop', 'classical', 'electronic', 'folk', 'metal')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--plays', type=int, default=500000)
+    parser.add_argument('--songs', type=int, default=200000)
+    parser.add_argument('--zipf', type=float, default=1.1, help='Skew of song popularity')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    random.seed(470)
+    songs = [(f'{i:024x}', f'Artist {i % (args.songs // 10 or 1)}', GENRES[i % len(GENRES)])
+             for i in range(args.songs)]
+    # Popularity ranks are reshuffled halfway through the week, so the hour and day charts
+    # differ from the week chart
+    weights = list(itertools.accumulate(1 / (rank + 1) ** args.zipf for rank in range(args.songs)))
+    early, late = list(range(args.songs)), list(range(args.songs))
+    random.shuffle(early)
+    random.shuffle(late)
+    end = time.time()
+    start = end - WINDOWS['week']
+    plays = []
+    for i in range(args.plays):
+        at = start + (end - start) * i / args.plays
+        ranking = early if at < start + (end - start) / 2 else late
+        rank = bisect.bisect(weights, random.random() * weights[-1])
+        plays.append((songs[ranking[rank]], at))
+
+    chart = Trending()
+    started = time.perf_counter()
+    for (song_id, artist, genre), at in plays:
+        chart.record(song_id, artist, genre, now=at)
+    elapsed = time.perf_counter() - started
+    print(f'Recorded {args.plays} plays in {elapsed:.2f} s: {args.plays / elapsed:,.0f} plays/s')
+
+    timings = []
+    for _ in range(1000):
+        started = time.perf_counter()
+        chart.top('songs', 'day', args.top)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f'chart read  p50 {timings[500]:.3f} ms   p99 {timings[990]:.3f} ms')
+
+    for window, tau in WINDOWS.items():
+        # Exact decayed counts, as the charts approximate them
+        exact = Counter()
+        for (song_id, _, _), at in plays:
+            exact[song_id] += math.exp((at - end) / tau)
+        expected = {song_id for song_id, _ in exact.most_common(args.top)}
+        found = {song_id for song_id, _ in chart.top('songs', window, args.top)}
+        print(f'{window:5} top {args.top}: {len(expected & found)}/{args.top} found')
+
+
+if __name__ == '__main__':
+    main()
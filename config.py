@@ -10,5 +10,66 @@ class Config:
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'svg'}
     MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
     MONGO_DB_NAME = 'music_app'
-    
-   
\ No newline at end of file
+
+    # Largest accepted request body (an album upload is a single request)
+    MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 2 * 1024 ** 3))
+    # Uploaded files larger than this are spooled to a temp file while the form is parsed
+    UPLOAD_SPOOL_MAX_BYTES = int(os.getenv('UPLOAD_SPOOL_MAX_BYTES', 1024 * 1024))
+    # Number of album tracks written to GridFS in parallel
+    ALBUM_UPLOAD_WORKERS = int(os.getenv('ALBUM_UPLOAD_WORKERS', 4))
+
+    # Local disk cache for hot audio files served from /stream
+    AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'cache', 'audio'))
+    AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_BYTES', 2 * 1024 ** 3))  # 0 disables the cache
+    # Set to an nginx internal location (e.g. /_audio_cache) to serve hits via X-Accel-Redirect
+    AUDIO_CACHE_ACCEL_PREFIX = os.getenv('AUDIO_CACHE_ACCEL_PREFIX', '')
+
+    # In-memory search index: optional snapshot file to skip the full build on startup
+    # (only point this at a path the app itself writes; it is unpickled on load)
+    SEARCH_SNAPSHOT_PATH = os.getenv('SEARCH_SNAPSHOT_PATH', '')
+    # How often each worker picks up songs added or edited by other workers
+    SEARCH_REFRESH_SECONDS = int(os.getenv('SEARCH_REFRESH_SECONDS', 30))
+
+    # Home page Discover feed: songs sampled into each worker's pool, and how often it is resampled
+    DISCOVER_POOL_SIZE = int(os.getenv('DISCOVER_POOL_SIZE', 2000))
+    DISCOVER_POOL_TTL = int(os.getenv('DISCOVER_POOL_TTL', 600))
+    # uniform, popularity (playlist adds) or genre (equal share per genre)
+    DISCOVER_WEIGHTING = os.getenv('DISCOVER_WEIGHTING', 'uniform')
+
+    # Loaded users are cached per worker (and in the session) for this many seconds
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+    USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))
+    # How long other workers may serve a user's old role after `flask set-role`
+    ROLE_CHANGE_CHECK_SECONDS = int(os.getenv('ROLE_CHANGE_CHECK_SECONDS', 2))
+
+    # Cached home/artist/album fragments: lifetime in seconds, overridable per namespace
+    PAGE_CACHE_TTL = int(os.getenv('PAGE_CACHE_TTL', 300))
+    PAGE_CACHE_TTLS = {'home_albums': int(os.getenv('PAGE_CACHE_HOME_TTL', 60))}
+    PAGE_CACHE_MAX_ENTRIES = int(os.getenv('PAGE_CACHE_MAX_ENTRIES', 1000))
+    # How stale another worker's view of the catalog version may be
+    CATALOG_VERSION_CHECK_SECONDS = int(os.getenv('CATALOG_VERSION_CHECK_SECONDS', 2))
+
+    # Play tracking is buffered and written in batches: every interval, or sooner once
+    # PLAY_FLUSH_EVENTS plays are waiting; the oldest plays are dropped past the cap
+    PLAY_FLUSH_INTERVAL_MS = int(os.getenv('PLAY_FLUSH_INTERVAL_MS', 1000))
+    PLAY_FLUSH_EVENTS = int(os.getenv('PLAY_FLUSH_EVENTS', 500))
+    PLAY_BUFFER_MAX_EVENTS = int(os.getenv('PLAY_BUFFER_MAX_EVENTS', 100000))
+    PLAY_FLUSH_ON_EXIT = os.getenv('PLAY_FLUSH_ON_EXIT', 'true').lower() == 'true'
+    # Optional spool file prefix: plays survive a crash and are replayed by the next worker to record one
+    PLAY_SPOOL_PATH = os.getenv('PLAY_SPOOL_PATH', '')
+    # Listening history keeps one document per user per day, split after this many plays
+    HISTORY_BUCKET_SIZE = int(os.getenv('HISTORY_BUCKET_SIZE', 500))
+
+    # Trending charts: count-min sketch size, heavy hitters kept per chart, snapshot interval
+    TRENDING_SKETCH_WIDTH = int(os.getenv('TRENDING_SKETCH_WIDTH', 2048))
+    TRENDING_SKETCH_DEPTH = int(os.getenv('TRENDING_SKETCH_DEPTH', 4))
+    TRENDING_TOP_K = int(os.getenv('TRENDING_TOP_K', 100))
+    TRENDING_SNAPSHOT_SECONDS = int(os.getenv('TRENDING_SNAPSHOT_SECONDS', 60))
+
+    # "More like this" lists built by `flask build-similar`: neighbours kept per song,
+    # cosine or jaccard, pairs seen in fewer playlists are ignored, and only the last
+    # SIMILAR_MAX_PLAYLIST_LENGTH songs of a playlist are used
+    SIMILAR_TOP_K = int(os.getenv('SIMILAR_TOP_K', 20))
+    SIMILAR_METRIC = os.getenv('SIMILAR_METRIC', 'cosine')
+    SIMILAR_MIN_COUNT = int(os.getenv('SIMILAR_MIN_COUNT', 1))
+    SIMILAR_MAX_PLAYLIST_LENGTH = int(os.getenv('SIMILAR_MAX_PLAYLIST_LENGTH', 500))
@@ -0,0 +1,167 @@
+"""Precomputed pool of song cards for the home page's Discover feed.
+
+Instead of a $sample on every page view, each process keeps a pool of a few thousand
+cards sampled from the catalog (uniformly, by popularity or balanced across genres) and
+resamples it every DISCOVER_POOL_TTL seconds. A feed is a seeded shuffle of the pool, so
+/api/discover pages through a stable order with an offset cursor and no database work.
+The previous pool is kept so a feed being scrolled survives one resample.
+"""
+import heapq
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from bson import ObjectId
+from search_index import search_index
+
+CARD_FIELDS = {'title': 1, 'artist': 1, 'genre': 1, 'album': 1, 'file_id': 1, 'album_art_id': 1}
+WEIGHTINGS = ('uniform', 'popularity', 'genre')
+# Pool generations kept alive for feeds started before a resample
+KEPT_GENERATIONS = 2
+MAX_CACHED_ORDERS = 256
+
+
+def _card(song_doc):
+    """A song card as the templates and /api/discover render it."""
+    return {
+        'id': str(song_doc['_id']),
+        'title': song_doc.get('title'),
+        'artist': song_doc.get('artist'),
+        'album': song_doc.get('album'),
+        'genre': song_doc.get('genre'),
+        'file_id': str(song_doc['file_id']) if song_doc.get('file_id') else None,
+        'album_art_id': str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None
+    }
+
+
+class DiscoverPool:
+    def __init__(self):
+        self.collection = None
+        self.size = 2000
+        self.ttl = 600
+        self.weighting = 'uniform'
+        self.generation = 0
+        self.pools = OrderedDict()    # generation -> list of cards
+        self._orders = OrderedDict()  # (generation, seed) -> shuffled card positions
+        self._removed = set()         # song ids deleted since the pools were sampled
+        self._built_at = 0
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock()
+
+    def init_app(self, app, collection):
+        self.collection = collection
+        self.size = app.config.get('DISCOVER_POOL_SIZE', 2000)
+        self.ttl = app.config.get('DISCOVER_POOL_TTL', 600)
+        weighting = app.config.get('DISCOVER_WEIGHTING', 'uniform')
+        self.weighting = weighting if weighting in WEIGHTINGS else 'uniform'
+
+    def _sample(self, catalog):
+        """Picks up to `size` song ids from (song_id, genre, popularity) without replacement."""
+        if self.weighting == 'uniform' or len(catalog) <= self.size:
+            return [song_id for song_id, _, _ in random.sample(catalog, min(self.size, len(catalog)))]
+        if self.weighting == 'popularity':
+            weights = [1 + popularity for _, _, popularity in catalog]
+        else:
+            # Every genre gets an equal share of the pool, however many songs it has
+            genre_sizes = Counter(genre.casefold() for _, genre, _ in catalog)
+            weights = [1 / genre_sizes[genre.casefold()] for _, genre, _ in catalog]
+        # Weighted sampling without replacement: keep the largest random() ** (1 / weight)
+        keyed = ((random.random() ** (1 / weight), song_id) for (song_id, _, _), weight in zip(catalog, weights))
+        return [song_id for _, song_id in heapq.nlargest(self.size, keyed)]
+
+    def build(self):
+        """Samples a fresh pool and makes it the current generation."""
+        catalog = search_index.catalog() if search_index.ready else None
+        if catalog is None:
+            # The search index is still building: fall back to one $sample per pool
+            song_docs = self.collection.aggregate([{'$sample': {'size': self.size}}, {'$project': CARD_FIELDS}])
+        else:
+            song_ids = [ObjectId(song_id) for song_id in self._sample(catalog)]
+            song_docs = self.collection.find({'_id': {'$in': song_ids}}, CARD_FIELDS)
+        cards = [_card(song_doc) for song_doc in song_docs]
+        with self._lock:
+            self.generation += 1
+            self.pools[self.generation] = cards
+            while len(self.pools) > KEPT_GENERATIONS:
+                self.pools.popitem(last=False)
+            self._removed.clear()
+            self._built_at = time.monotonic()
+
+    def _refresh_if_stale(self):
+        if not self.pools:
+            # Nothing to serve yet, so the first request waits for the pool
+            with self._refreshing:
+                if not self.pools:
+                    self.build()
+            return
+        if time.monotonic() - self._built_at >= self.ttl and self._refreshing.acquire(blocking=False):
+            def rebuild():
+                try:
+                    self.build()
+                except Exception as e:
+                    print(f"Error resampling discover pool: {e}")
+                finally:
+                    self._refreshing.release()
+            threading.Thread(target=rebuild, daemon=True).start()
+
+    def _order(self, generation, seed):
+        """The feed order of a pool generation for one seed."""
+        key = (generation, seed)
+        order = self._orders.get(key)
+        if order is None:
+            order = list(range(len(self.pools[generation])))
+            random.Random(f'{seed}:{generation}').shuffle(order)
+            self._orders[key] = order
+            if len(self._orders) > MAX_CACHED_ORDERS:
+                self._orders.popitem(last=False)
+        else:
+            self._orders.move_to_end(key)
+        return order
+
+    def page(self, seed, cursor=None, limit=15):
+        """Returns (cards, next cursor or None) for one page of the feed seeded by `seed`.
+
+        Cursors look like "<generation>.<offset>"; one from a generation that has since been
+        dropped continues at the same offset of the current pool.
+        """
+        try:
+            self._refresh_if_stale()
+        except Exception as e:
+            print(f"Error building discover pool: {e}")
+        with self._lock:
+            if not self.pools:
+                return [], None
+            generation, offset = self.generation, 0
+            if cursor:
+                try:
+                    generation, offset = (int(part) for part in cursor.split('.', 1))
+                except ValueError:
+                    generation, offset = self.generation, 0
+                if generation not in self.pools:
+                    generation = self.generation
+            offset = max(offset, 0)
+            cards = self.pools[generation]
+            order = self._order(generation, seed)
+            page = [cards[i] for i in order[offset:offset + limit] if cards[i]['id'] not in self._removed]
+            next_offset = offset + limit
+            return page, f'{generation}.{next_offset}' if next_offset < len(order) else None
+
+    def update(self, song_id, fields):
+        """Applies an edit to the song's card in every pool generation."""
+        changes = {field: str(fields[field]) if isinstance(fields[field], ObjectId) else fields[field]
+                   for field in CARD_FIELDS if field in fields}
+        if not changes:
+            return
+        with self._lock:
+            for cards in self.pools.values():
+                for card in cards:
+                    if card['id'] == song_id:
+                        card.update(changes)
+
+    def remove(self, song_id):
+        """Hides a deleted song until the next resample."""
+        with self._lock:
+            self._removed.add(song_id)
+
+
+discover_pool = DiscoverPool()
@@ -0,0 +1,158 @@
+"""Listening history stored with the bucket pattern.
+
+Each document holds one user's plays for one UTC day as parallel arrays (`song_ids`,
+`played_at`, `event_ids`, in play order) plus a `counts` map of song id -> plays, so a day
+of listening is one document instead of hundreds. A bucket takes at most
+HISTORY_BUCKET_SIZE plays; heavy listeners spill into further buckets for the same day, and
+only the newest bucket of a day is appended to.
+
+Plays arrive from play_buffer.py, one bulk_write per flush with at most one append per
+(user, day); each play's event id is stored with it, so a retried batch is not counted
+twice. "My history" pages backwards through buckets with a cursor, and top tracks over a
+date range sum the `counts` maps of the matching buckets without touching individual plays.
+"""
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+
+
+class ListeningHistory:
+    def __init__(self):
+        self.collection = None
+        self.bucket_size = 500
+
+    def init_app(self, app, collection):
+        self.collection = collection
+        self.bucket_size = app.config.get('HISTORY_BUCKET_SIZE', 500)
+
+    @staticmethod
+    def _day(played_at):
+        return datetime(played_at.year, played_at.month, played_at.day)
+
+    def record(self, events):
+        """Appends (user_id, song_id, played_at, event_id) plays, oldest first, in one bulk_write.
+
+        Plays whose event id is already stored are skipped, so a batch can be retried after a
+        failure or replayed from a spool. Raises if a bucket changed under the write; the
+        caller retries the whole batch.
+        """
+        if self.collection is None or not events:
+            return
+        user_ids = list({ObjectId(user_id) for user_id, _, _, _ in events})
+        days = list({self._day(played_at) for _, _, played_at, _ in events})
+        event_ids = [event_id for _, _, _, event_id in events]
+        # Buckets of the batch's users and days (the (user_id, day) index); normally none match
+        stored = set()
+        for bucket in self.collection.find({'user_id': {'$in': user_ids}, 'day': {'$in': days},
+                                            'event_ids': {'$in': event_ids}}, {'event_ids': 1}):
+            stored.update(bucket['event_ids'])
+
+        buckets = {}
+        for user_id, song_id, played_at, event_id in events:
+            if event_id not in stored:
+                key = (ObjectId(user_id), self._day(played_at))
+                buckets.setdefault(key, []).append((song_id, played_at, event_id))
+        if not buckets:
+            return
+        # Only the newest bucket of a day takes more plays, so buckets stay in play order
+        newest = {}
+        for bucket in self.collection.find({'user_id': {'$in': user_ids}, 'day': {'$in': days}},
+                                           {'user_id': 1, 'day': 1, 'count': 1}).sort('_id', 1):
+            newest[bucket['user_id'], bucket['day']] = bucket
+
+        operations = []
+        appends = 0
+        for (user_id, day), plays in buckets.items():
+            bucket = newest.get((user_id, day))
+            room = self.bucket_size - bucket['count'] if bucket else 0
+            if room > 0:
+                operations.append(UpdateOne(
+                    # The count read above: a concurrent append makes this match nothing
+                    {'_id': bucket['_id'], 'count': bucket['count']}, self._append(plays[:room])
+                ))
+                appends += 1
+                plays = plays[room:]
+            for start in range(0, len(plays), self.bucket_size):
+                chunk = plays[start:start + self.bucket_size]
+                # ObjectIds made in order keep the (day, _id) sort in play order
+                operations.append(InsertOne({
+                    '_id': ObjectId(), 'user_id': user_id, 'day': day,
+                    'song_ids': [ObjectId(song_id) for song_id, _, _ in chunk],
+                    'played_at': [played_at for _, played_at, _ in chunk],
+                    'event_ids': [event_id for _, _, event_id in chunk],
+                    'count': len(chunk), 'counts': self._counts(chunk), 'last_played': chunk[-1][1]
+                }))
+        result = self.collection.bulk_write(operations, ordered=False)
+        if result.matched_count < appends:
+            raise RuntimeError('listening history bucket changed during the write')
+
+    @staticmethod
+    def _counts(plays):
+        counts = {}
+        for song_id, _, _ in plays:
+            counts[str(song_id)] = counts.get(str(song_id), 0) + 1
+        return counts
+
+    def _append(self, plays):
+        return {
+            '$push': {'song_ids': {'$each': [ObjectId(song_id) for song_id, _, _ in plays]},
+                      'played_at': {'$each': [played_at for _, played_at, _ in plays]},
+                      'event_ids': {'$each': [event_id for _, _, event_id in plays]}},
+            '$inc': {'count': len(plays), **{f'counts.{song_id}': n for song_id, n in self._counts(plays).items()}},
+            '$max': {'last_played': plays[-1][1]}
+        }
+
+    def page(self, user_id, cursor=None, limit=50):
+        """Returns ([(song_id, played_at)] newest first, next cursor or None).
+
+        Cursors look like "<bucket id>.<n>": the page continues with that bucket's first n
+        plays, then older buckets. Buckets only grow at the end, so cursors stay valid while
+        the user keeps listening.
+        """
+        query = {'user_id': ObjectId(user_id)}
+        end = None
+        if cursor:
+            try:
+                bucket_id, end = cursor.split('.', 1)
+                end = int(end)
+                bucket = self.collection.find_one({'_id': ObjectId(bucket_id), 'user_id': ObjectId(user_id)},
+                                                  {'day': 1})
+            except Exception:
+                bucket = None
+            if bucket is None:
+                return [], None
+            # The cursor's bucket (for its remaining plays) and everything older
+            query['$or'] = [{'day': {'$lt': bucket['day']}},
+                            {'day': bucket['day'], '_id': {'$lte': bucket['_id']}}]
+        plays = []
+        buckets = self.collection.find(query, {'song_ids': 1, 'played_at': 1}) \
+            .sort([('day', -1), ('_id', -1)]).batch_size(4)
+        for bucket in buckets:
+            song_ids = bucket.get('song_ids', [])[:end]
+            played_at = bucket.get('played_at', [])[:end]
+            end = None
+            start = max(len(song_ids) - (limit - len(plays)), 0)
+            plays.extend((str(song_id), at) for song_id, at in zip(reversed(song_ids[start:]), reversed(played_at[start:])))
+            if len(plays) >= limit:
+                if start:
+                    return plays, f"{bucket['_id']}.{start}"
+                # The bucket is used up: the next page starts at whatever bucket comes next
+                following = next(buckets, None)
+                return plays, f"{following['_id']}.{len(following.get('song_ids', []))}" if following else None
+        return plays, None
+
+    def top_tracks(self, user_id, start, end, limit=10):
+        """[(song_id, plays)] over the UTC days from `start` to `end` inclusive, most played first."""
+        pipeline = [
+            {'$match': {'user_id': ObjectId(user_id),
+                        'day': {'$gte': self._day(start), '$lt': self._day(end) + timedelta(days=1)}}},
+            {'$project': {'counts': {'$objectToArray': '$counts'}}},
+            {'$unwind': '$counts'},
+            {'$group': {'_id': '$counts.k', 'plays': {'$sum': '$counts.v'}}},
+            {'$sort': {'plays': -1, '_id': 1}},
+            {'$limit': limit}
+        ]
+        return [(row['_id'], row['plays']) for row in self.collection.aggregate(pipeline)]
+
+
+listening_history = ListeningHistory()
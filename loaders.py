@@ -0,0 +1,65 @@
+"""Request-scoped batching loaders (DataLoader-style).
+
+A loader memoizes values by key for the rest of the request and fetches every missing
+key with one batched query. Keys can be queued with `enqueue` ahead of time (e.g. every
+artist on a page) so that the first `load` fetches them all at once.
+"""
+from flask import g, has_app_context
+
+
+class Loader:
+    def __init__(self, batch_fn):
+        # batch_fn(keys) -> {key: value}; keys missing from the result load as None
+        self.batch_fn = batch_fn
+        self.cache = {}
+        self.pending = {}
+
+    def enqueue(self, keys):
+        """Queues keys to be fetched with the next batch."""
+        for key in keys:
+            if key not in self.cache:
+                self.pending[key] = None
+
+    def load_many(self, keys):
+        """Returns values for `keys` in the same order, fetching missing ones in one batch."""
+        keys = list(keys)
+        self.enqueue(keys)
+        if self.pending:
+            batch = list(self.pending)
+            self.pending = {}
+            results = self.batch_fn(batch)
+            for key in batch:
+                self.cache[key] = results.get(key)
+        return [self.cache[key] for key in keys]
+
+    def load(self, key):
+        return self.load_many([key])[0]
+
+    def prime(self, key, value):
+        self.cache[key] = value
+
+    def clear(self, key=None):
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key, None)
+
+
+def get_loader(name, batch_fn):
+    """Returns the current request's loader called `name`, creating it on first use.
+
+    Outside an app context (CLI commands, background threads) every call gets a fresh,
+    unshared loader.
+    """
+    if not has_app_context():
+        return Loader(batch_fn)
+    loaders = g.setdefault('_loaders', {})
+    if name not in loaders:
+        loaders[name] = Loader(batch_fn)
+    return loaders[name]
+
+
+def clear_loader(name, key=None):
+    """Forgets memoized values after a write in the same request."""
+    if has_app_context() and name in g.get('_loaders', {}):
+        g._loaders[name].clear(key)
@@ -0,0 +1,155 @@
+"""Helpers for serving GridFS files over HTTP (byte ranges, chunked reads, validators)."""
+import re
+from datetime import timezone
+from uuid import uuid4
+from werkzeug.http import http_date, parse_date, parse_etags, parse_if_range_header, quote_etag
+
+# Upper bound on how much of a GridFS file is held in memory at once while streaming.
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# GridFS files never change once written, so id-addressed URLs can be cached forever.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(range_header, file_size):
+    """Parse a `Range: bytes=...` header against a file of `file_size` bytes.
+
+    Returns None when the header is missing or malformed (serve the whole file),
+    an empty list when no range is satisfiable (416), or a list of inclusive
+    (start, end) tuples with out-of-bounds ends clamped to the file size.
+    """
+    if not range_header:
+        return None
+
+    unit, _, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        m = _RANGE_SPEC.match(spec)
+        if not m:
+            return None
+        first, last = m.groups()
+        if not first and not last:
+            return None
+
+        if not first:
+            # Suffix range: the last N bytes of the file
+            suffix_length = int(last)
+            if suffix_length == 0 or file_size == 0:
+                continue
+            start = max(file_size - suffix_length, 0)
+            end = file_size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+            if last and end < start:
+                return None
+            if start >= file_size:
+                continue
+            end = min(end, file_size - 1)
+        ranges.append((start, end))
+
+    return ranges
+
+
+def file_validators(file_id, upload_date):
+    """Returns a strong ETag and Last-Modified datetime for a GridFS file."""
+    # pymongo hands back naive datetimes that are already in UTC
+    if upload_date.tzinfo is None:
+        upload_date = upload_date.replace(tzinfo=timezone.utc)
+    etag = f'{file_id}-{int(upload_date.timestamp() * 1000):x}'
+    return etag, upload_date.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def cache_headers(etag, last_modified):
+    return {
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL,
+    }
+
+
+def is_not_modified(if_none_match, if_modified_since, etag, last_modified):
+    """True when the client's cached copy is current and a 304 can be sent."""
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        return parse_etags(if_none_match).contains_weak(etag)
+    since = parse_date(if_modified_since)
+    return since is not None and last_modified <= since
+
+
+def range_allowed(if_range, etag, last_modified):
+    """False when an If-Range validator no longer matches, so the full file must be sent."""
+    if not if_range:
+        return True
+    condition = parse_if_range_header(if_range)
+    if condition.etag is not None:
+        return condition.etag == etag
+    if condition.date is not None:
+        return condition.date == last_modified
+    return False
+
+
+def pick_variant(metadata, width, accepts_webp):
+    """Returns the id of the smallest resized image variant at least `width` wide.
+
+    None means the original should be served: either it is already small enough or
+    no variants have been generated for it yet.
+    """
+    variants = (metadata or {}).get('variants') or {}
+    fmt = 'webp' if accepts_webp else 'jpeg'
+    chosen = next((w for w in sorted(int(w) for w in variants) if w >= width), None)
+    return variants[str(chosen)].get(fmt) if chosen else None
+
+
+def iter_file(grid_fs_file, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield bytes `start`..`end` (inclusive) of a GridFS file in bounded chunks."""
+    if end is None:
+        end = grid_fs_file.length - 1
+    grid_fs_file.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        chunk = grid_fs_file.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+class MultipartRanges:
+    """A `multipart/byteranges` body for several ranges of one file.
+
+    The part headers are precomputed so the exact Content-Length is known up front;
+    the bytes of each part are read lazily while the body is iterated.
+    """
+
+    def __init__(self, ranges, content_type, file_size):
+        self.boundary = uuid4().hex
+        self.content_type = f'multipart/byteranges; boundary={self.boundary}'
+        self.parts = [
+            (
+                (
+                    f'\r\n--{self.boundary}\r\n'
+                    f'Content-Type: {content_type}\r\n'
+                    f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n'
+                ).encode('latin-1'),
+                start,
+                end,
+            )
+            for start, end in ranges
+        ]
+        self.closing = f'\r\n--{self.boundary}--\r\n'.encode('latin-1')
+
+    @property
+    def content_length(self):
+        return sum(len(header) + end - start + 1 for header, start, end in self.parts) + len(self.closing)
+
+    def iter_file(self, grid_fs_file, chunk_size=STREAM_CHUNK_SIZE):
+        for header, start, end in self.parts:
+            yield header
+            yield from iter_file(grid_fs_file, start, end, chunk_size)
+        yield self.closing
@@ -1,17 +1,32 @@
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 from pymongo import MongoClient
-from pymongo import MongoClient
-from gridfs import GridFS
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from gridfs import GridFS, GridFSBucket
 from bson import ObjectId
 from datetime import datetime
 from flask_login import UserMixin
+from audio_cache import audio_cache
+from search_index import search_index
+from discover import discover_pool
+from page_cache import page_cache
+from play_buffer import play_buffer
+from history import listening_history
+from trending import trending
+from loaders import get_loader, clear_loader
+from indexes import apply_indexes
+from collections import OrderedDict
+import hashlib
 import re
 import ssl
+import threading
+import time
 
 class MongoDB:
     def __init__(self):
         self.client = None
         self.db = None
         self.fs = None
+        self.bucket = None
         self.songs_collection = None
         self.users_collection = None
         self.playlists_collection = None
@@ -29,30 +44,136 @@ class MongoDB:
 
             self.db = self.client[app.config['MONGO_DB_NAME']]
             self.fs = GridFS(self.db)
+            self.bucket = GridFSBucket(self.db)  # Chunked writes from file-like sources
             self.songs_collection = self.db.songs
             self.users_collection = self.db.users
             self.playlists_collection = self.db.playlists
+            self.playlist_items_collection = self.db.playlist_items  # One document per song in a playlist
             self.artists_collection = self.db.artists
             self.albums_collection = self.db.albums  # For album descriptions
+            self.uploads_collection = self.db.uploads  # Album upload progress
+            self.blobs_collection = self.db.blobs  # Content hashes and reference counts of GridFS files
+            self.meta_collection = self.db.meta  # Shared counters such as the catalog version
+            self.history_collection = self.db.listening_history  # Plays bucketed per user per day
+            self.trending_collection = self.db.trending  # Snapshots of the trending charts
+            self.similar_songs_collection = self.db.similar_songs  # Top neighbours per song (similarity.py)
 
-            self.songs_collection.create_index([('title', 'text'), ('artist', 'text'), ('genre', 'text')])
-            self.artists_collection.create_index([('name', 'text')])
-            self.albums_collection.create_index([('name', 'text'), ('artist', 'text')])  # Index for album info
+            apply_indexes(self.db)
+            # Before anything reads playlist items (the search index counts them)
+            if not self.meta_collection.find_one({'_id': 'playlist_items'}):
+                PlaylistItems.migrate()
+            search_index.init_app(app, self.songs_collection, self.playlist_items_collection)
+            discover_pool.init_app(app, self.songs_collection)
+            page_cache.init_app(app, self.meta_collection)
+            user_cache.init_app(app, self.meta_collection)
+            play_buffer.init_app(app, self.users_collection)
+            listening_history.init_app(app, self.history_collection)
+            trending.init_app(app, self.trending_collection, self.songs_collection)
             
             print("Successfully connected to MongoDB Atlas!")
         except Exception as e:
             print(f"Error connecting to MongoDB: {e}")
             raise
 
+    def delete_file(self, file_id):
+        """Deletes a GridFS file along with any resized variants of it."""
+        for variant in self.db.fs.files.find({'metadata.original_id': ObjectId(file_id)}, {'_id': 1}):
+            self.fs.delete(variant['_id'])
+        self.fs.delete(ObjectId(file_id))
+
 mongo_db = MongoDB()
 
+# Songs checked for cover art in each playlist summary
+PLAYLIST_COVER_SCAN = 12
+
+class UserCache:
+    """Users recently loaded by this worker, so most requests skip the users lookup.
+
+    Profiles carry `loaded_at`, the time they were read from the users collection, and
+    expire USER_CACHE_TTL seconds after it however often they are passed between this cache
+    and the session. A role change stamps `meta.roles.changed_at`, which every worker re-reads
+    at most every ROLE_CHANGE_CHECK_SECONDS; profiles loaded before it are stale.
+    """
+    def __init__(self):
+        self.meta = None
+        self.ttl = 60
+        self.max_entries = 10000
+        self.check_seconds = 2
+        self.roles_changed_at = 0
+        self._checked = 0
+        self._entries = OrderedDict()  # user_id -> profile
+        self._lock = threading.Lock()
+
+    def init_app(self, app, meta_collection):
+        self.meta = meta_collection
+        self.ttl = app.config.get('USER_CACHE_TTL', 60)
+        self.max_entries = app.config.get('USER_CACHE_MAX_ENTRIES', 10000)
+        self.check_seconds = app.config.get('ROLE_CHANGE_CHECK_SECONDS', 2)
+
+    def last_role_change(self):
+        """When any role last changed, re-read at most every check_seconds."""
+        now = time.monotonic()
+        if self.meta is not None and now - self._checked >= self.check_seconds:
+            try:
+                doc = self.meta.find_one({'_id': 'roles'}, {'changed_at': 1})
+                self.roles_changed_at = doc['changed_at'] if doc else 0
+            except Exception as e:
+                print(f"Error reading role change time: {e}")
+            self._checked = now
+        return self.roles_changed_at
+
+    def is_fresh(self, profile):
+        loaded_at = profile.get('loaded_at', 0)
+        return time.time() - loaded_at < self.ttl and loaded_at > self.last_role_change()
+
+    def get(self, user_id):
+        with self._lock:
+            profile = self._entries.get(user_id)
+        if profile is None:
+            return None
+        if not self.is_fresh(profile):
+            self.discard(user_id)
+            return None
+        with self._lock:
+            if user_id in self._entries:
+                self._entries.move_to_end(user_id)
+        return profile
+
+    def put(self, user_id, profile):
+        with self._lock:
+            self._entries[user_id] = profile
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def role_changed(self):
+        """Makes every profile loaded before now stale, in all workers."""
+        changed_at = time.time()
+        if self.meta is not None:
+            self.meta.update_one({'_id': 'roles'}, {'$max': {'changed_at': changed_at}}, upsert=True)
+        self.roles_changed_at = max(self.roles_changed_at, changed_at)
+        self._checked = time.monotonic()
+
+
+user_cache = UserCache()
+
+
 class User(UserMixin):
+    # What a loaded user needs; recently_played and the password hash are read on demand
+    PROFILE_FIELDS = {'username': 1, 'email': 1, 'role': 1}
+
     def __init__(self, user_data):
         self.id = str(user_data.get('_id'))
         self.username = user_data.get('username')
         self.email = user_data.get('email')
         self.password_hash = user_data.get('password')
         self.role = user_data.get('role', 'user')
+        # A profile keeps the time it was read; anything else was just read from the database
+        self.loaded_at = user_data.get('loaded_at') or time.time()
 
     @property
     def is_admin(self):
@@ -65,6 +186,37 @@ class User(UserMixin):
             return User(user_data)
         return None
 
+    def profile(self):
+        """The fields a User is rebuilt from by get_cached or from the session."""
+        return {'_id': self.id, 'username': self.username, 'email': self.email, 'role': self.role,
+                'loaded_at': self.loaded_at}
+
+    @staticmethod
+    def get_cached(user_id, profile=None):
+        """Loads a user through the worker's cache, seeding it from a fresh `profile` when given."""
+        cached = user_cache.get(user_id)
+        if cached is None:
+            cached = profile
+            if cached is None:
+                user_data = mongo_db.users_collection.find_one({'_id': ObjectId(user_id)}, User.PROFILE_FIELDS)
+                if not user_data:
+                    return None
+                cached = User(user_data).profile()
+            user_cache.put(user_id, cached)
+        return User(cached)
+
+    @staticmethod
+    def forget(user_id):
+        """Drops a user's cached profile, e.g. on logout."""
+        user_cache.discard(str(user_id))
+
+    @staticmethod
+    def set_role(user_id, role):
+        """Changes a user's role; every worker drops the profiles it loaded before."""
+        result = mongo_db.users_collection.update_one({'_id': ObjectId(user_id)}, {'$set': {'role': role}})
+        user_cache.role_changed()
+        return result.matched_count > 0
+
 
     def get_liked_songs_playlist(self):
         """Finds or creates the 'Liked Songs' playlist for the user."""
@@ -76,7 +228,8 @@ class User(UserMixin):
             playlist_id = mongo_db.playlists_collection.insert_one({
                 'user_id': ObjectId(self.id),
                 'name': 'Liked Songs',
-                'songs': [] 
+                'song_count': 0,
+                'tail_position': 0.0
             }).inserted_id
             playlist = mongo_db.playlists_collection.find_one({'_id': playlist_id})
         return playlist
@@ -84,28 +237,15 @@ class User(UserMixin):
     def get_liked_song_ids(self):
         """Returns a list of song IDs from the user's Liked Songs playlist."""
         playlist = self.get_liked_songs_playlist()
-        return playlist.get('songs', [])
+        return PlaylistItems.song_ids(playlist['_id'])
     
     def add_to_recently_played(self, song_id):
-        """Adds a song to the user's recently played list (limit to 15)."""
+        """Adds a song to the user's recently played list (limit to 15).
+
+        The play is queued and written with the next play_buffer flush.
+        """
         try:
-            # Remove the song if it already exists to avoid duplicates
-            mongo_db.users_collection.update_one(
-                {'_id': ObjectId(self.id)},
-                {'$pull': {'recently_played': ObjectId(song_id)}}
-            )
-            
-            # Add the song to the beginning of the list
-            mongo_db.users_collection.update_one(
-                {'_id': ObjectId(self.id)},
-                {'$push': {
-                    'recently_played': {
-                        '$each': [ObjectId(song_id)],
-                        '$position': 0,
-                        '$slice': 15  # Keep only the last 15 songs
-                    }
-                }}
-            )
+            play_buffer.record(self.id, str(ObjectId(song_id)))
             return True
         except Exception as e:
             print(f"Error adding to recently played: {e}")
@@ -114,42 +254,52 @@ class User(UserMixin):
     def get_recently_played_songs(self):
         """Returns the user's recently played songs (up to 15)."""
         try:
-            user_data = mongo_db.users_collection.find_one({'_id': ObjectId(self.id)})
-            recently_played_ids = user_data.get('recently_played', [])
+            user_data = mongo_db.users_collection.find_one({'_id': ObjectId(self.id)}, {'recently_played': 1})
+            # Plays still waiting in the buffer come first
+            recently_played_ids = list(dict.fromkeys(
+                play_buffer.pending_for(self.id) + [str(song_id) for song_id in user_data.get('recently_played', [])]
+            ))[:15]
             
             if not recently_played_ids:
                 return []
             
-            # Get songs while preserving order
-            songs = []
-            for song_id in recently_played_ids:
-                song = Song.get_by_id(str(song_id))
-                if song:  # Only add if song still exists
-                    songs.append(song)
-            
-            return songs
+            # One batched query; the loader preserves order and skips deleted songs
+            songs = Song.loader().load_many(recently_played_ids)
+            return [song for song in songs if song]
         except Exception as e:
             print(f"Error getting recently played songs: {e}")
             return []
 
+    def get_listening_history(self, cursor=None, limit=50):
+        """Returns ([(song, played_at)] newest first, next cursor or None)."""
+        try:
+            plays, next_cursor = listening_history.page(self.id, cursor, limit)
+            songs = Song.loader().load_many(song_id for song_id, _ in plays)
+            # Plays of deleted songs are skipped
+            return [(song, played_at) for song, (_, played_at) in zip(songs, plays) if song], next_cursor
+        except Exception as e:
+            print(f"Error getting listening history: {e}")
+            return [], None
+
+    def get_top_tracks(self, start, end, limit=10):
+        """Returns [(song, plays)] for the user's most played songs between two dates."""
+        try:
+            counts = listening_history.top_tracks(self.id, start, end, limit)
+            songs = Song.loader().load_many(song_id for song_id, _ in counts)
+            return [(song, plays) for song, (_, plays) in zip(songs, counts) if song]
+        except Exception as e:
+            print(f"Error getting top tracks: {e}")
+            return []
+
     def toggle_like(self, song_id):
         """Adds or removes a song from the 'Liked Songs' playlist."""
         liked_playlist = self.get_liked_songs_playlist()
-        song_object_id = ObjectId(song_id)
         
-        if song_object_id in liked_playlist['songs']:
-            
-            mongo_db.playlists_collection.update_one(
-                {'_id': liked_playlist['_id']},
-                {'$pull': {'songs': song_object_id}}
-            )
-            return False 
-        else:
-            mongo_db.playlists_collection.update_one(
-                {'_id': liked_playlist['_id']},
-                {'$addToSet': {'songs': song_object_id}} 
-            )
-            return True
+        # Removing succeeds only if the song was liked; otherwise it is added
+        if PlaylistItems.remove(liked_playlist['_id'], self.id, song_id):
+            return False
+        PlaylistItems.add({'_id': liked_playlist['_id']}, song_id)
+        return True
     
     def create_playlist(self, playlist_name):
         """Creates a new playlist for the user."""
@@ -166,7 +316,8 @@ class User(UserMixin):
             playlist_data = {
                 'user_id': ObjectId(self.id),
                 'name': playlist_name,
-                'songs': [],
+                'song_count': 0,
+                'tail_position': 0.0,
                 'created_date': datetime.utcnow()
             }
             
@@ -176,41 +327,70 @@ class User(UserMixin):
             print(f"Error creating playlist: {e}")
             return None
     
-    def get_all_playlists(self):
-        """Returns all playlists for the user."""
+    def get_playlist_summaries(self):
+        """Returns each playlist's name, song count and up to four cover art ids without loading its songs."""
         try:
+            pipeline = [
+                {'$match': {'user_id': ObjectId(self.id)}},
+                {'$sort': {'name': 1}},
+                {'$project': {'name': 1, 'created_date': 1, 'song_count': 1}},
+                # Covers come from the first few songs; more than four in case some lack art
+                {'$lookup': {
+                    'from': 'playlist_items', 'localField': '_id', 'foreignField': 'playlist_id',
+                    'pipeline': [{'$sort': {'position': 1, '_id': 1}}, {'$limit': PLAYLIST_COVER_SCAN},
+                                 {'$project': {'_id': 0, 'song_id': 1}}],
+                    'as': 'first_items'
+                }}
+            ]
+            playlist_docs = list(mongo_db.playlists_collection.aggregate(pipeline))
+            loader = Song.loader()
+            loader.enqueue(str(item['song_id']) for doc in playlist_docs for item in doc['first_items'])
+
             playlists = []
-            for playlist_doc in mongo_db.playlists_collection.find({
-                'user_id': ObjectId(self.id)
-            }).sort('name', 1):
-                # Get song details for this playlist
-                songs = Song.get_songs_by_ids(playlist_doc.get('songs', []))
-                
-                playlist = {
+            for playlist_doc in playlist_docs:
+                cover_art_ids = []
+                for song in loader.load_many(str(item['song_id']) for item in playlist_doc['first_items']):
+                    if song and song.album_art_id and song.album_art_id not in cover_art_ids:
+                        cover_art_ids.append(song.album_art_id)
+                playlists.append({
                     'id': str(playlist_doc['_id']),
                     'name': playlist_doc['name'],
-                    'songs': songs,
-                    'song_count': len(songs),
+                    'song_count': playlist_doc.get('song_count', 0),
+                    'cover_art_ids': cover_art_ids[:4],
                     'created_date': playlist_doc.get('created_date')
-                }
-                playlists.append(playlist)
-            
+                })
             return playlists
         except Exception as e:
-            print(f"Error getting user playlists: {e}")
+            print(f"Error getting playlist summaries: {e}")
             return []
+
+    def get_playlist_songs(self, playlist_id, cursor=None, limit=50):
+        """Returns (playlist name, songs, next cursor or None) for one page of a playlist."""
+        try:
+            playlist_doc = mongo_db.playlists_collection.find_one(
+                {'_id': ObjectId(playlist_id), 'user_id': ObjectId(self.id)}, {'name': 1}
+            )
+            if not playlist_doc:
+                return None
+            song_ids, next_cursor = PlaylistItems.page(playlist_doc['_id'], cursor, limit)
+            songs = [song for song in Song.loader().load_many(song_ids) if song]
+            return playlist_doc['name'], songs, next_cursor
+        except Exception as e:
+            print(f"Error getting playlist songs: {e}")
+            return None
+
+    def get_liked_among(self, song_ids):
+        """Returns which of `song_ids` are in the user's Liked Songs, without loading the whole playlist."""
+        playlist = mongo_db.playlists_collection.find_one({'user_id': ObjectId(self.id), 'name': 'Liked Songs'}, {'_id': 1})
+        if not playlist:
+            return set()
+        return PlaylistItems.among(playlist['_id'], song_ids)
     
     def add_song_to_playlist(self, playlist_id, song_id):
         """Adds a song to a specific playlist."""
         try:
-            result = mongo_db.playlists_collection.update_one(
-                {
-                    '_id': ObjectId(playlist_id),
-                    'user_id': ObjectId(self.id)  # Ensure user owns the playlist
-                },
-                {'$addToSet': {'songs': ObjectId(song_id)}}
-            )
-            return result.modified_count > 0
+            # The filter ensures the user owns the playlist
+            return PlaylistItems.add({'_id': ObjectId(playlist_id), 'user_id': ObjectId(self.id)}, song_id)
         except Exception as e:
             print(f"Error adding song to playlist: {e}")
             return False
@@ -218,17 +398,18 @@ class User(UserMixin):
     def remove_song_from_playlist(self, playlist_id, song_id):
         """Removes a song from a specific playlist."""
         try:
-            result = mongo_db.playlists_collection.update_one(
-                {
-                    '_id': ObjectId(playlist_id),
-                    'user_id': ObjectId(self.id)  # Ensure user owns the playlist
-                },
-                {'$pull': {'songs': ObjectId(song_id)}}
-            )
-            return result.modified_count > 0
+            return PlaylistItems.remove(playlist_id, self.id, song_id)
         except Exception as e:
             print(f"Error removing song from playlist: {e}")
             return False
+
+    def move_song_in_playlist(self, playlist_id, song_id, after_song_id=None):
+        """Moves a song to just after another one in a playlist (to the top if None)."""
+        try:
+            return PlaylistItems.move(playlist_id, self.id, song_id, after_song_id)
+        except Exception as e:
+            print(f"Error moving song in playlist: {e}")
+            return False
     
     def delete_playlist(self, playlist_id):
         """Deletes a user's playlist (except Liked Songs)."""
@@ -250,6 +431,7 @@ class User(UserMixin):
                 '_id': ObjectId(playlist_id),
                 'user_id': ObjectId(self.id)
             })
+            mongo_db.playlist_items_collection.delete_many({'playlist_id': ObjectId(playlist_id)})
             
             return result.deleted_count > 0
         except Exception as e:
@@ -276,20 +458,398 @@ class User(UserMixin):
     def get_playlists_for_song(self, song_id):
         """Returns a list of playlist IDs that contain a specific song for the user."""
         try:
-            song_object_id = ObjectId(song_id)
-            # Find playlists that belong to the user and contain the song_id
-            playlists = mongo_db.playlists_collection.find({
-                'user_id': ObjectId(self.id),
-                'songs': song_object_id
-            }, {'_id': 1})  # Only retrieve the ID field
+            # The user's items for this song, one per playlist
+            items = mongo_db.playlist_items_collection.find({
+                'song_id': ObjectId(song_id),
+                'user_id': ObjectId(self.id)
+            }, {'playlist_id': 1})
             
-            return [str(p['_id']) for p in playlists]
+            return [str(item['playlist_id']) for item in items]
         except Exception as e:
             print(f"Error getting playlists for song {song_id}: {e}")
             return []        
 
+class PlaylistItems:
+    """Songs of a playlist, one `playlist_items` document each: {playlist_id, user_id,
+    song_id, position, added_date}.
+
+    Items are ordered by a fractional `position`: appending takes the playlist's
+    `tail_position` plus POSITION_STEP, and moving a song gives it the midpoint of its new
+    neighbours, so a reorder rewrites one document. The playlist keeps `song_count` and
+    `tail_position`; (playlist_id, song_id) is unique, which makes adds idempotent.
+    """
+    POSITION_STEP = 1024.0
+
+    @staticmethod
+    def add(playlist_filter, song_id):
+        """Appends a song to the playlist matching `playlist_filter`. False if it was already there."""
+        step = PlaylistItems.POSITION_STEP
+        playlist = mongo_db.playlists_collection.find_one_and_update(
+            playlist_filter,
+            {'$inc': {'tail_position': step, 'song_count': 1}},
+            projection={'user_id': 1, 'tail_position': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not playlist:
+            return False
+        try:
+            mongo_db.playlist_items_collection.insert_one({
+                'playlist_id': playlist['_id'],
+                'user_id': playlist['user_id'],
+                'song_id': ObjectId(song_id),
+                'position': playlist['tail_position'],
+                'added_date': datetime.utcnow()
+            })
+            return True
+        except DuplicateKeyError:
+            mongo_db.playlists_collection.update_one({'_id': playlist['_id']}, {'$inc': {'song_count': -1}})
+            return False
+
+    @staticmethod
+    def remove(playlist_id, user_id, song_id):
+        """Removes a song from one of the user's playlists. False if it was not there."""
+        result = mongo_db.playlist_items_collection.delete_one({
+            'playlist_id': ObjectId(playlist_id),
+            'song_id': ObjectId(song_id),
+            'user_id': ObjectId(user_id)  # Ensure user owns the playlist
+        })
+        if not result.deleted_count:
+            return False
+        mongo_db.playlists_collection.update_one({'_id': ObjectId(playlist_id)}, {'$inc': {'song_count': -1}})
+        return True
+
+    @staticmethod
+    def remove_song(song_id):
+        """Removes a deleted song from every playlist."""
+        items = list(mongo_db.playlist_items_collection.find({'song_id': ObjectId(song_id)}, {'playlist_id': 1}))
+        if not items:
+            return
+        mongo_db.playlist_items_collection.delete_many({'song_id': ObjectId(song_id)})
+        mongo_db.playlists_collection.update_many(
+            {'_id': {'$in': [item['playlist_id'] for item in items]}},
+            {'$inc': {'song_count': -1}}
+        )
+
+    @staticmethod
+    def among(playlist_id, song_ids):
+        """The subset of `song_ids` (strings) that are in the playlist."""
+        items = mongo_db.playlist_items_collection.find(
+            {'playlist_id': ObjectId(playlist_id), 'song_id': {'$in': [ObjectId(i) for i in song_ids]}},
+            {'_id': 0, 'song_id': 1}
+        )
+        return {str(item['song_id']) for item in items}
+
+    @staticmethod
+    def song_ids(playlist_id):
+        """Every song id of the playlist, in order."""
+        items = mongo_db.playlist_items_collection.find(
+            {'playlist_id': ObjectId(playlist_id)}, {'_id': 0, 'song_id': 1}
+        ).sort([('position', 1), ('_id', 1)])
+        return [item['song_id'] for item in items]
+
+    @staticmethod
+    def page(playlist_id, cursor=None, limit=50):
+        """Returns ([song_id], next cursor or None) for one page of a playlist, in order.
+
+        Cursors look like "<position>_<item id>" of the last item returned, so pages stay
+        consistent while songs are added, removed or moved elsewhere in the playlist.
+        """
+        query = {'playlist_id': ObjectId(playlist_id)}
+        if cursor:
+            try:
+                position, item_id = cursor.split('_', 1)
+                position, item_id = float(position), ObjectId(item_id)
+            except Exception:
+                return [], None
+            query['$or'] = [{'position': {'$gt': position}}, {'position': position, '_id': {'$gt': item_id}}]
+        # One item past the page tells whether there is a next one
+        items = list(mongo_db.playlist_items_collection.find(query, {'song_id': 1, 'position': 1})
+                     .sort([('position', 1), ('_id', 1)]).limit(limit + 1))
+        next_cursor = None
+        if len(items) > limit:
+            last = items[limit - 1]
+            next_cursor = f"{last['position']!r}_{last['_id']}"
+        return [str(item['song_id']) for item in items[:limit]], next_cursor
+
+    @staticmethod
+    def move(playlist_id, user_id, song_id, after_song_id=None):
+        """Moves a song to just after `after_song_id`, or to the top when it is None."""
+        collection = mongo_db.playlist_items_collection
+        playlist_id, user_id = ObjectId(playlist_id), ObjectId(user_id)
+        item = collection.find_one({'playlist_id': playlist_id, 'song_id': ObjectId(song_id), 'user_id': user_id})
+        if not item:
+            return False
+        for _ in range(2):
+            if after_song_id:
+                after = collection.find_one({'playlist_id': playlist_id, 'song_id': ObjectId(after_song_id)},
+                                            {'position': 1})
+                if not after:
+                    return False
+                following = collection.find_one(
+                    {'playlist_id': playlist_id, 'position': {'$gt': after['position']}, '_id': {'$ne': item['_id']}},
+                    {'position': 1}, sort=[('position', 1), ('_id', 1)]
+                )
+                low = after['position']
+                high = following['position'] if following else None
+            else:
+                first = collection.find_one({'playlist_id': playlist_id, '_id': {'$ne': item['_id']}},
+                                            {'position': 1}, sort=[('position', 1), ('_id', 1)])
+                low, high = None, first['position'] if first else None
+            if high is None:
+                # Moved to the end: take a fresh tail position
+                playlist = mongo_db.playlists_collection.find_one_and_update(
+                    {'_id': playlist_id}, {'$inc': {'tail_position': PlaylistItems.POSITION_STEP}},
+                    projection={'tail_position': 1}, return_document=ReturnDocument.AFTER
+                )
+                position = playlist['tail_position']
+            elif low is None:
+                position = high - PlaylistItems.POSITION_STEP
+            else:
+                position = (low + high) / 2
+                if not low < position < high:
+                    # Floats between the neighbours are used up: respace the playlist and retry
+                    PlaylistItems.rebalance(playlist_id)
+                    continue
+            collection.update_one({'_id': item['_id']}, {'$set': {'position': position}})
+            return True
+        return False
+
+    @staticmethod
+    def rebalance(playlist_id):
+        """Respaces a playlist's positions POSITION_STEP apart, keeping the order."""
+        step = PlaylistItems.POSITION_STEP
+        items = PlaylistItems.song_ids(playlist_id)
+        operations = [UpdateOne({'playlist_id': ObjectId(playlist_id), 'song_id': song_id},
+                                {'$set': {'position': (i + 1) * step}})
+                      for i, song_id in enumerate(items)]
+        if operations:
+            mongo_db.playlist_items_collection.bulk_write(operations, ordered=False)
+        mongo_db.playlists_collection.update_one({'_id': ObjectId(playlist_id)},
+                                                 {'$max': {'tail_position': len(items) * step}})
+
+    @staticmethod
+    def migrate():
+        """Moves songs embedded in playlist documents to `playlist_items`. Safe to re-run.
+
+        Runs on startup until it has completed once. Songs added through `playlist_items`
+        before a playlist was migrated stay after its embedded songs. Returns
+        (playlists, items) migrated.
+        """
+        step = PlaylistItems.POSITION_STEP
+        playlists_migrated = items_migrated = 0
+        for playlist in mongo_db.playlists_collection.find({'songs': {'$exists': True}},
+                                                           {'user_id': 1, 'songs': 1, 'created_date': 1}):
+            song_ids = list(dict.fromkeys(playlist.get('songs') or []))
+            added_date = playlist.get('created_date') or datetime.utcnow()
+            # Items not from this array, e.g. added since the deploy: the migrated songs go first
+            first = mongo_db.playlist_items_collection.find_one(
+                {'playlist_id': playlist['_id'], 'song_id': {'$nin': song_ids}},
+                {'position': 1}, sort=[('position', 1), ('_id', 1)]
+            )
+            start = first['position'] - (len(song_ids) + 1) * step if first else 0
+            items = [{'playlist_id': playlist['_id'], 'user_id': playlist['user_id'], 'song_id': song_id,
+                      'position': start + (i + 1) * step, 'added_date': added_date}
+                     for i, song_id in enumerate(song_ids)]
+            if items:
+                try:
+                    mongo_db.playlist_items_collection.insert_many(items, ordered=False)
+                except BulkWriteError as e:
+                    # Items left by an interrupted run are already there
+                    if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])):
+                        raise
+            mongo_db.playlists_collection.update_one({'_id': playlist['_id']}, {
+                '$set': {'song_count': mongo_db.playlist_items_collection.count_documents(
+                             {'playlist_id': playlist['_id']})},
+                '$max': {'tail_position': start + len(song_ids) * step},
+                '$unset': {'songs': ''}
+            })
+            playlists_migrated += 1
+            items_migrated += len(items)
+        # Index of the embedded arrays, no longer used
+        for name in ('user_id_1_songs_1', 'songs_1'):
+            try:
+                mongo_db.playlists_collection.drop_index(name)
+            except Exception:
+                pass
+        mongo_db.meta_collection.update_one({'_id': 'playlist_items'}, {'$set': {'migrated_date': datetime.utcnow()}},
+                                            upsert=True)
+        return playlists_migrated, items_migrated
+
+class _HashingReader:
+    """Wraps a file object and hashes everything read through it."""
+
+    def __init__(self, source):
+        self.source = source
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class BlobStore:
+    """Content-addressed, reference-counted GridFS storage.
+
+    Each unique file is stored once. `blobs` holds one document per GridFS file with its
+    SHA-256 and the number of songs/artists referencing it; the file is deleted when
+    the last reference is released. GridFS files that predate the blob layer have no
+    blobs entry and count as a single reference.
+    """
+
+    @staticmethod
+    def put(source, filename, metadata=None):
+        """Stores bytes or a readable file, reusing an identical existing blob.
+
+        Returns (file_id, created). The caller owns one new reference either way.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            digest = hashlib.sha256(source).hexdigest()
+        elif hasattr(source, 'seek') and source.seekable():
+            # Hash the (spooled) upload first so duplicates skip the GridFS write entirely
+            start = source.tell()
+            sha256 = hashlib.sha256()
+            for chunk in iter(lambda: source.read(1024 * 1024), b''):
+                sha256.update(chunk)
+            source.seek(start)
+            digest = sha256.hexdigest()
+        else:
+            digest = None
+
+        if digest:
+            existing = BlobStore._add_ref_by_hash(digest)
+            if existing:
+                return existing, False
+
+        reader = None if digest else _HashingReader(source)
+        file_id = mongo_db.bucket.upload_from_stream(filename, reader or source, metadata=metadata)
+        digest = digest or reader.sha256.hexdigest()
+        for attempt in range(3):
+            try:
+                mongo_db.blobs_collection.insert_one({'_id': file_id, 'sha256': digest, 'refs': 1})
+                return file_id, True
+            except DuplicateKeyError:
+                # Same content was stored concurrently (or the source wasn't seekable): keep one copy
+                existing = BlobStore._add_ref_by_hash(digest)
+                if existing:
+                    mongo_db.fs.delete(file_id)
+                    return existing, False
+                if attempt == 2:
+                    mongo_db.fs.delete(file_id)
+                    raise
+                # The other copy lost its last reference and is being deleted: keep this one
+                mongo_db.blobs_collection.delete_one({'sha256': digest, 'refs': {'$lte': 0}})
+
+    @staticmethod
+    def _add_ref_by_hash(digest):
+        blob = mongo_db.blobs_collection.find_one_and_update(
+            {'sha256': digest, 'refs': {'$gt': 0}}, {'$inc': {'refs': 1}}
+        )
+        return blob['_id'] if blob else None
+
+    @staticmethod
+    def add_ref(file_id, count=1):
+        """Records `count` more references to an existing file."""
+        if count <= 0:
+            return
+        result = mongo_db.blobs_collection.update_one({'_id': ObjectId(file_id)}, {'$inc': {'refs': count}})
+        if result.matched_count == 0:
+            try:
+                mongo_db.blobs_collection.insert_one({'_id': ObjectId(file_id), 'refs': count + 1})
+            except DuplicateKeyError:
+                BlobStore.add_ref(file_id, count)
+
+    @staticmethod
+    def release(file_id):
+        """Drops one reference; deletes the file once nothing refers to it.
+
+        Returns True if the file was deleted.
+        """
+        file_id = ObjectId(file_id)
+        blob = mongo_db.blobs_collection.find_one_and_update(
+            {'_id': file_id}, {'$inc': {'refs': -1}}, return_document=ReturnDocument.AFTER
+        )
+        if blob and blob['refs'] > 0:
+            return False
+        if blob:
+            mongo_db.blobs_collection.delete_one({'_id': file_id, 'refs': {'$lte': 0}})
+        mongo_db.delete_file(file_id)
+        return True
+
+    @staticmethod
+    def rebuild(compute_hashes=False):
+        """Recounts references from songs and artists, e.g. after upgrading existing data.
+
+        With compute_hashes, files without a recorded hash are read once and hashed so
+        later uploads of the same content are deduplicated against them.
+        """
+        refs = {}
+        for song_doc in mongo_db.songs_collection.find({}, {'file_id': 1, 'album_art_id': 1}):
+            for key in ('file_id', 'album_art_id'):
+                if song_doc.get(key):
+                    refs[ObjectId(song_doc[key])] = refs.get(ObjectId(song_doc[key]), 0) + 1
+        for artist_doc in mongo_db.artists_collection.find({'photo_id': {'$ne': None}}, {'photo_id': 1}):
+            refs[ObjectId(artist_doc['photo_id'])] = refs.get(ObjectId(artist_doc['photo_id']), 0) + 1
+
+        for file_id, count in refs.items():
+            update = {'refs': count}
+            if compute_hashes and not mongo_db.blobs_collection.find_one({'_id': file_id, 'sha256': {'$exists': True}}):
+                try:
+                    sha256 = hashlib.sha256()
+                    grid_fs_file = mongo_db.fs.get(file_id)
+                    for chunk in iter(lambda: grid_fs_file.read(1024 * 1024), b''):
+                        sha256.update(chunk)
+                    update['sha256'] = sha256.hexdigest()
+                except Exception as e:
+                    print(f"Error hashing file {file_id}: {e}")
+            try:
+                mongo_db.blobs_collection.update_one({'_id': file_id}, {'$set': update}, upsert=True)
+            except DuplicateKeyError:
+                # Byte-identical legacy copies: keep each file with its own count
+                del update['sha256']
+                mongo_db.blobs_collection.update_one({'_id': file_id}, {'$set': update}, upsert=True)
+        return len(refs)
+
+
+def normalize_key(name):
+    """Casefolded, whitespace-collapsed form of an artist or album name for indexed equality lookups."""
+    return ' '.join((name or '').split()).casefold()
+
+
+def backfill_normalized_keys(batch_size=1000):
+    """Sets artist_key/album_key/name_key on documents written before the keys existed."""
+    key_fields = {
+        mongo_db.songs_collection: {'artist_key': 'artist', 'album_key': 'album'},
+        mongo_db.artists_collection: {'name_key': 'name'},
+        mongo_db.albums_collection: {'artist_key': 'artist', 'album_key': 'name'},
+    }
+    updated = 0
+    for collection, fields in key_fields.items():
+        projection = {source: 1 for source in fields.values()}
+        missing = {'$or': [{key: {'$exists': False}} for key in fields]}
+        operations = []
+        for doc in collection.find(missing, projection):
+            keys = {key: normalize_key(doc.get(source)) for key, source in fields.items()}
+            operations.append(UpdateOne({'_id': doc['_id']}, {'$set': keys}))
+            if len(operations) >= batch_size:
+                updated += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
+
+
 class Song:
+    __slots__ = ('id', 'title', 'artist', 'genre', 'album', 'file_id', 'filename', 'album_art_id',
+                 'artist_description', 'upload_date')
+
+    # Projections for each kind of view, so list pages never ship fields they don't render
+    CARD_FIELDS = {'title': 1, 'artist': 1, 'genre': 1, 'album': 1, 'file_id': 1, 'album_art_id': 1}
+    ADMIN_FIELDS = {**CARD_FIELDS, 'filename': 1, 'upload_date': 1}
+    DETAIL_FIELDS = {**ADMIN_FIELDS, 'artist_description': 1}
+
     def __init__(self, title=None, artist=None, genre=None, album=None, file_id=None, filename=None, album_art_id=None, artist_description=None):
+        self.id = None
         self.title = title
         self.artist = artist
         self.genre = genre
@@ -298,75 +858,123 @@ class Song:
         self.filename = filename
         self.album_art_id = album_art_id
         self.artist_description = artist_description
+        self.upload_date = None
+
+    @staticmethod
+    def from_document(song_doc):
+        """Builds a Song from a (possibly projected) songs document."""
+        song = Song(
+            title=song_doc.get('title'), artist=song_doc.get('artist'), genre=song_doc.get('genre'),
+            album=song_doc.get('album'), file_id=str(song_doc['file_id']) if song_doc.get('file_id') else None,
+            filename=song_doc.get('filename'),
+            album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
+            artist_description=song_doc.get('artist_description')
+        )
+        song.id = str(song_doc['_id'])
+        song.upload_date = song_doc.get('upload_date')
+        return song
     
-    def save(self):
-        song_data = {
+    def to_document(self):
+        return {
             'title': self.title, 'artist': self.artist, 'genre': self.genre, 'album': self.album,
             'file_id': self.file_id, 'filename': self.filename, 'album_art_id': self.album_art_id,
             'artist_description': self.artist_description,
+            'artist_key': normalize_key(self.artist), 'album_key': normalize_key(self.album),
             'upload_date': datetime.utcnow()
         }
-        result = mongo_db.songs_collection.insert_one(song_data)
+
+    def save(self):
+        document = self.to_document()
+        result = mongo_db.songs_collection.insert_one(document)
+        search_index.add(str(result.inserted_id), document)
+        Artist.adjust_stats(document['artist_key'], songs=1, last_upload=document['upload_date'])
+        Album.refresh(document['artist_key'], document['album_key'])
+        page_cache.bump()
         return result.inserted_id
+
+    @staticmethod
+    def save_many(songs):
+        """Inserts several songs in one round-trip.
+
+        Returns a list with the inserted id, or None for songs that failed, in input order.
+        """
+        if not songs:
+            return []
+        documents = [song.to_document() for song in songs]
+        failed = set()
+        try:
+            mongo_db.songs_collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+        albums = set()
+        artist_songs = {}
+        for i, doc in enumerate(documents):
+            if i not in failed:
+                search_index.add(str(doc['_id']), doc)
+                albums.add((doc['artist_key'], doc['album_key']))
+                artist_songs.setdefault(doc['artist_key'], []).append(doc['upload_date'])
+        for artist_key, upload_dates in artist_songs.items():
+            Artist.adjust_stats(artist_key, songs=len(upload_dates), last_upload=max(upload_dates))
+        for artist_key, album_key in albums:
+            Album.refresh(artist_key, album_key)
+        page_cache.bump()
+        return [None if i in failed else doc['_id'] for i, doc in enumerate(documents)]
     
     @staticmethod
-    def get_all():
+    def get_all(fields=CARD_FIELDS):
         songs = []
-        for song_doc in mongo_db.songs_collection.find():
-            song = Song(
-                title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                artist_description=song_doc.get('artist_description')
-            )
-            song.id = str(song_doc['_id'])
+        for song_doc in mongo_db.songs_collection.find({}, fields):
+            song = Song.from_document(song_doc)
             songs.append(song)
         return songs
 
     @staticmethod
-    def search(query):
+    def search(query, page=1, per_page=24):
+        """Ranked, typo-tolerant search. Returns (songs on the page, total matches)."""
+        if search_index.ready:
+            song_ids, total = search_index.search(query, page, per_page)
+            found = {song.id: song for song in Song.get_songs_by_ids([ObjectId(i) for i in song_ids])}
+            for song_id in song_ids:
+                if song_id not in found:
+                    # Deleted by another worker since this process indexed it
+                    search_index.remove(song_id)
+            return [found[i] for i in song_ids if i in found], total
+
+        # The index is still building: fall back to an unranked regex scan
         safe_query = re.escape(query)
         search_filter = {"$or": [{"title": {"$regex": safe_query, "$options": "i"}}, {"artist": {"$regex": safe_query, "$options": "i"}}, {"genre": {"$regex": safe_query, "$options": "i"}}, {"album": {"$regex": safe_query, "$options": "i"}}]}
         songs = []
-        for song_doc in mongo_db.songs_collection.find(search_filter):
-            song = Song(
-                title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                artist_description=song_doc.get('artist_description')
-            )
-            song.id = str(song_doc['_id'])
+        cursor = mongo_db.songs_collection.find(search_filter, Song.CARD_FIELDS).skip((max(page, 1) - 1) * per_page).limit(per_page)
+        for song_doc in cursor:
+            song = Song.from_document(song_doc)
             songs.append(song)
-        return songs
+        return songs, mongo_db.songs_collection.count_documents(search_filter)
 
     @staticmethod
-    def get_songs_by_ids(song_ids):
+    def get_songs_by_ids(song_ids, fields=CARD_FIELDS):
         """Retrieve multiple songs from a list of ObjectIds."""
         songs = []
-        for song_doc in mongo_db.songs_collection.find({'_id': {'$in': song_ids}}):
-            song = Song(
-                title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                artist_description=song_doc.get('artist_description')
-            )
-            song.id = str(song_doc['_id'])
+        for song_doc in mongo_db.songs_collection.find({'_id': {'$in': song_ids}}, fields):
+            song = Song.from_document(song_doc)
             songs.append(song)
         return songs
     
     @staticmethod
-    def get_by_id(song_id):
+    def _load_by_ids(song_ids):
+        return {song.id: song for song in Song.get_songs_by_ids([ObjectId(i) for i in song_ids])}
+
+    @staticmethod
+    def loader():
+        """The current request's Song loader, keyed by string id (card fields only)."""
+        return get_loader('songs', Song._load_by_ids)
+
+    @staticmethod
+    def get_by_id(song_id, fields=DETAIL_FIELDS):
         """Retrieve a single song by its ID."""
         try:
-            song_doc = mongo_db.songs_collection.find_one({'_id': ObjectId(song_id)})
+            song_doc = mongo_db.songs_collection.find_one({'_id': ObjectId(song_id)}, fields)
             if song_doc:
-                song = Song(
-                    title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                    album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                    album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                    artist_description=song_doc.get('artist_description')
-                )
-                song.id = str(song_doc['_id'])
+                song = Song.from_document(song_doc)
                 return song
         except Exception as e:
             print(f"Error getting song by ID: {e}")
@@ -376,10 +984,34 @@ class Song:
     def update(song_id, update_data):
         """Update a song's information."""
         try:
+            update_data = dict(update_data)
+            if 'artist' in update_data:
+                update_data['artist_key'] = normalize_key(update_data['artist'])
+            if 'album' in update_data:
+                update_data['album_key'] = normalize_key(update_data['album'])
+            update_data['updated_date'] = datetime.utcnow()  # Lets other workers' search indexes catch up
+            # The song may move between albums or change the album's art, so note where it was
+            before = None
+            if Album.SONG_FIELDS & update_data.keys():
+                before = mongo_db.songs_collection.find_one({'_id': ObjectId(song_id)},
+                                                            {'artist_key': 1, 'album_key': 1, 'upload_date': 1})
             result = mongo_db.songs_collection.update_one(
                 {'_id': ObjectId(song_id)},
                 {'$set': update_data}
             )
+            search_index.update(song_id, update_data)
+            discover_pool.update(song_id, update_data)
+            clear_loader('songs', song_id)
+            if before:
+                old_keys = (before.get('artist_key'), before.get('album_key'))
+                new_keys = (update_data.get('artist_key', old_keys[0]), update_data.get('album_key', old_keys[1]))
+                if new_keys[0] != old_keys[0]:
+                    Artist.adjust_stats(old_keys[0], songs=-1)
+                    Artist.adjust_stats(new_keys[0], songs=1, last_upload=before.get('upload_date'))
+                Album.refresh(*old_keys)
+                if new_keys != old_keys:
+                    Album.refresh(*new_keys)
+            page_cache.bump()
             return result.modified_count > 0
         except Exception as e:
             print(f"Error updating song: {e}")
@@ -389,19 +1021,12 @@ class Song:
     def get_featured(limit=None):
         """Get featured songs with optional limit."""
         songs = []
-        query = mongo_db.songs_collection.find()
+        query = mongo_db.songs_collection.find({}, Song.CARD_FIELDS)
         if limit:
             query = query.limit(limit)
         
         for song_doc in query:
-            song = Song(
-                title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                artist_description=song_doc.get('artist_description')
-            )
-            song.id = str(song_doc['_id'])
-            song.upload_date = song_doc.get('upload_date')
+            song = Song.from_document(song_doc)
             songs.append(song)
         return songs
     
@@ -409,142 +1034,70 @@ class Song:
     def get_recent_uploads(limit=20):
         """Get recently uploaded songs sorted by upload date."""
         songs = []
-        query = mongo_db.songs_collection.find().sort('upload_date', -1).limit(limit)
+        query = mongo_db.songs_collection.find({}, Song.ADMIN_FIELDS).sort('upload_date', -1).limit(limit)
         
         for song_doc in query:
-            song = Song(
-                title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                artist_description=song_doc.get('artist_description')
-            )
-            song.id = str(song_doc['_id'])
-            song.upload_date = song_doc.get('upload_date')
+            song = Song.from_document(song_doc)
             songs.append(song)
         return songs
     
     @staticmethod
     def get_recent_albums(limit=4):
-        """Get recently uploaded albums with their songs."""
-        albums = []
-        
-        # Get albums ordered by the most recent song upload in each album
-        pipeline = [
-            {'$match': {'album': {'$ne': None, '$ne': ''}}},  # Only songs with albums
-            {'$sort': {'upload_date': -1}},  # Sort by upload date descending
-            {'$group': {
-                '_id': {'album': '$album', 'artist': '$artist'},
-                'latest_upload': {'$first': '$upload_date'},
-                'album_art_id': {'$first': '$album_art_id'},
-                'songs': {'$push': '$$ROOT'}  # Collect all songs in the album
-            }},
-            {'$sort': {'latest_upload': -1}},  # Sort albums by latest upload
-            {'$limit': limit}
-        ]
-        
-        for album_doc in mongo_db.songs_collection.aggregate(pipeline):
-            album_info = {
-                'name': album_doc['_id']['album'],
-                'artist': album_doc['_id']['artist'],
-                'album_art_id': str(album_doc['album_art_id']) if album_doc.get('album_art_id') else None,
-                'latest_upload': album_doc['latest_upload'],
-                'songs': []
-            }
-            
-            # Convert song documents to Song objects
-            for song_doc in album_doc['songs']:
-                song = Song(
-                    title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                    album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                    album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                    artist_description=song_doc.get('artist_description')
-                )
-                song.id = str(song_doc['_id'])
-                song.upload_date = song_doc.get('upload_date')
-                album_info['songs'].append(song)
-            
-            # Sort songs within album by track order or upload date
-            album_info['songs'].sort(key=lambda s: s.upload_date or datetime.min, reverse=False)
-            album_info['song_count'] = len(album_info['songs'])
-            albums.append(album_info)
-        
-        return albums
+        """Get the albums with the most recent uploads."""
+        return Album.get_recent(limit)
     
     @staticmethod
-    def get_random_songs(limit=15):
-        """Get random songs from the database."""
+    def get_similar(song_id, limit=10):
+        """Returns [(song, score)] most similar first, from the lists built by similarity.py.
+
+        A song in no playlist yet is padded with other songs by the same artist (score 0).
+        """
         try:
-            # Use MongoDB's $sample aggregation to get random songs efficiently
-            pipeline = [
-                {'$sample': {'size': limit}}
-            ]
-            
-            songs = []
-            for song_doc in mongo_db.songs_collection.aggregate(pipeline):
-                song = Song(
-                    title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                    album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                    album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                    artist_description=song_doc.get('artist_description')
-                )
-                song.id = str(song_doc['_id'])
-                song.upload_date = song_doc.get('upload_date')
-                songs.append(song)
-            
-            return songs
+            # Extra neighbours in case some have been deleted since the last build
+            doc = mongo_db.similar_songs_collection.find_one({'_id': ObjectId(song_id)},
+                                                             {'neighbours': {'$slice': limit * 2}})
+            neighbours = doc.get('neighbours', []) if doc else []
+            songs = Song.loader().load_many(str(neighbour['song_id']) for neighbour in neighbours)
+            similar = [(song, neighbour['score']) for song, neighbour in zip(songs, neighbours) if song][:limit]
+            if len(similar) < limit:
+                song_doc = mongo_db.songs_collection.find_one({'_id': ObjectId(song_id)}, {'artist_key': 1})
+                if song_doc:
+                    seen = {song.id for song, _ in similar} | {str(song_id)}
+                    for artist_song in mongo_db.songs_collection.find(
+                        {'artist_key': song_doc.get('artist_key')}, Song.CARD_FIELDS
+                    ).limit(limit + len(seen)):
+                        song = Song.from_document(artist_song)
+                        if song.id not in seen and len(similar) < limit:
+                            similar.append((song, 0))
+            return similar
         except Exception as e:
-            print(f"Error getting random songs: {e}")
+            print(f"Error getting similar songs: {e}")
             return []
-    
+
     @staticmethod
     def get_artist_info(artist_name):
         """Get artist information and their songs."""
         try:
-            # Get artist description from any song by this artist
-            artist_song = mongo_db.songs_collection.find_one(
-                {'artist': {'$regex': f'^{re.escape(artist_name)}$', '$options': 'i'}}
-            )
-            
-            if not artist_song:
-                return None
-            
-            # Get all songs by this artist
+            # One indexed read for all of the artist's songs; the description comes from the first
             songs = []
+            description = None
             for song_doc in mongo_db.songs_collection.find(
-                {'artist': {'$regex': f'^{re.escape(artist_name)}$', '$options': 'i'}}
+                {'artist_key': normalize_key(artist_name)},
+                {**Song.CARD_FIELDS, 'upload_date': 1, 'artist_description': 1}
             ):
-                song = Song(
-                    title=song_doc['title'], artist=song_doc['artist'], genre=song_doc['genre'],
-                    album=song_doc.get('album'), file_id=str(song_doc['file_id']), filename=song_doc['filename'],
-                    album_art_id=str(song_doc['album_art_id']) if song_doc.get('album_art_id') else None,
-                    artist_description=song_doc.get('artist_description')
-                )
-                song.id = str(song_doc['_id'])
+                song = Song.from_document(song_doc)
                 songs.append(song)
+                if description is None:
+                    description = song_doc.get('artist_description', '')
+
+            if not songs:
+                return None
             
-            # Get unique albums with album art and metadata
-            albums_dict = {}
-            for song in songs:
-                if song.album and song.album.strip():
-                    if song.album not in albums_dict:
-                        albums_dict[song.album] = {
-                            'name': song.album,
-                            'artist': song.artist,
-                            'album_art_id': song.album_art_id,
-                            'song_count': 0,
-                            'latest_upload': getattr(song, 'upload_date', None)
-                        }
-                    albums_dict[song.album]['song_count'] += 1
-                    # Keep the latest album art
-                    if song.album_art_id:
-                        albums_dict[song.album]['album_art_id'] = song.album_art_id
-            
-            # Convert to list
-            albums_with_art = list(albums_dict.values())
+            albums_with_art = Album.get_by_artist(artist_name)
             
             return {
-                'name': artist_song['artist'],
-                'description': artist_song.get('artist_description', ''),
+                'name': songs[0].artist,
+                'description': description,
                 'songs': songs,
                 'total_songs': len(songs),
                 'albums': albums_with_art
@@ -554,8 +1107,9 @@ class Song:
             return None
     
     @staticmethod
-    def store_file(file_data, filename, metadata=None):
-        return mongo_db.fs.put(file_data, filename=filename, metadata=metadata)
+    def store_file(source, filename, metadata=None):
+        """Stores bytes or a readable file in GridFS one chunk at a time, deduplicated by content."""
+        return BlobStore.put(source, filename, metadata)[0]
 
     @staticmethod
     def get_file(file_id):
@@ -565,12 +1119,23 @@ class Song:
     def delete(song_id):
         try:
             song_doc = mongo_db.songs_collection.find_one_and_delete({'_id': ObjectId(song_id)})
+            search_index.remove(song_id)
+            discover_pool.remove(song_id)
+            trending.discard('songs', song_id)
+            mongo_db.similar_songs_collection.delete_one({'_id': ObjectId(song_id)})
+            PlaylistItems.remove_song(song_id)
+            clear_loader('songs', song_id)
+            if song_doc:
+                Artist.adjust_stats(song_doc.get('artist_key'), songs=-1)
+                Album.refresh(song_doc.get('artist_key'), song_doc.get('album_key'))
+                page_cache.bump()
             if song_doc and 'file_id' in song_doc:
-                mongo_db.fs.delete(ObjectId(song_doc['file_id']))
-                # Also delete album art if it exists
+                if BlobStore.release(song_doc['file_id']):
+                    audio_cache.discard(song_doc['file_id'])
+                # Also release album art, which other songs of the album may still use
                 if song_doc.get('album_art_id'):
                     try:
-                        mongo_db.fs.delete(ObjectId(song_doc['album_art_id']))
+                        BlobStore.release(song_doc['album_art_id'])
                     except Exception as e:
                         print(f"Error deleting album art: {e}")
             return True
@@ -579,21 +1144,41 @@ class Song:
             return False
 
 class Artist:
+    # Admin artist list page size
+    PER_PAGE = 48
+    EMPTY_STATS = {'songs': 0, 'albums': 0, 'last_upload': None}
+
     def __init__(self, name=None, description=None, photo_id=None, created_date=None):
         self.name = name
         self.description = description
         self.photo_id = photo_id
         self.created_date = created_date or datetime.utcnow()
+        # Counters kept on the artist document: songs, albums, last_upload
+        self.stats = None
+
+    @staticmethod
+    def from_document(artist_doc):
+        artist = Artist(
+            name=artist_doc['name'],
+            description=artist_doc.get('description', ''),
+            photo_id=str(artist_doc['photo_id']) if artist_doc.get('photo_id') else None,
+            created_date=artist_doc.get('created_date')
+        )
+        artist.id = str(artist_doc['_id'])
+        artist.stats = artist_doc.get('stats')
+        return artist
     
     def save(self):
         artist_data = {
             'name': self.name,
             'description': self.description,
             'photo_id': self.photo_id,
-            'created_date': self.created_date
+            'created_date': self.created_date,
+            'name_key': normalize_key(self.name)
         }
+        clear_loader('artists')
         # Check if artist already exists
-        existing_artist = mongo_db.artists_collection.find_one({'name': {'$regex': f'^{re.escape(self.name)}$', '$options': 'i'}})
+        existing_artist = mongo_db.artists_collection.find_one({'name_key': artist_data['name_key']})
         if existing_artist:
             # Update existing artist
             result = mongo_db.artists_collection.update_one(
@@ -601,40 +1186,123 @@ class Artist:
                 {'$set': artist_data}
             )
             self.id = str(existing_artist['_id'])
+            page_cache.bump()
             return existing_artist['_id']
         else:
-            # Create new artist
+            # Create new artist, with counters for any songs uploaded before it
+            artist_data['stats'] = Artist.compute_stats([artist_data['name_key']]).get(artist_data['name_key'], dict(Artist.EMPTY_STATS))
             result = mongo_db.artists_collection.insert_one(artist_data)
             self.id = str(result.inserted_id)
+            self.stats = artist_data['stats']
+            page_cache.bump()
             return result.inserted_id
     
     @staticmethod
     def get_all():
         artists = []
         for artist_doc in mongo_db.artists_collection.find().sort('name', 1):
-            artist = Artist(
-                name=artist_doc['name'],
-                description=artist_doc.get('description', ''),
-                photo_id=str(artist_doc['photo_id']) if artist_doc.get('photo_id') else None,
-                created_date=artist_doc.get('created_date')
-            )
-            artist.id = str(artist_doc['_id'])
-            artists.append(artist)
+            artists.append(Artist.from_document(artist_doc))
         return artists
+
+    @staticmethod
+    def get_page(page=1, per_page=PER_PAGE):
+        """Returns (artists on the page sorted by name, total number of artists)."""
+        artists = []
+        query = mongo_db.artists_collection.find().sort('name', 1).skip((max(page, 1) - 1) * per_page).limit(per_page)
+        for artist_doc in query:
+            artists.append(Artist.from_document(artist_doc))
+        return artists, mongo_db.artists_collection.estimated_document_count()
+
+    @staticmethod
+    def adjust_stats(artist_key, songs=0, albums=0, last_upload=None):
+        """Atomically applies a song write to the artist's counters.
+
+        Artists without a document (songs can name any artist) are skipped; their counters
+        are computed when the artist is created. reconcile_stats repairs any drift.
+        """
+        if not artist_key:
+            return
+        update = {}
+        if songs or albums:
+            update['$inc'] = {key: value for key, value in (('stats.songs', songs), ('stats.albums', albums)) if value}
+        if last_upload:
+            update['$max'] = {'stats.last_upload': last_upload}
+        if not update:
+            return
+        try:
+            mongo_db.artists_collection.update_one({'name_key': artist_key}, update)
+            clear_loader('artists', artist_key)
+        except Exception as e:
+            print(f"Error updating artist stats: {e}")
+
+    @staticmethod
+    def compute_stats(name_keys=None):
+        """Counters recomputed from songs and albums, per artist key (all artists if None)."""
+        match = {'artist_key': {'$in': name_keys}} if name_keys is not None else {}
+        stats = {}
+        pipeline = [
+            {'$match': match},
+            {'$group': {'_id': '$artist_key', 'songs': {'$sum': 1}, 'last_upload': {'$max': '$upload_date'}}}
+        ]
+        for doc in mongo_db.songs_collection.aggregate(pipeline):
+            stats[doc['_id']] = {'songs': doc['songs'], 'albums': 0, 'last_upload': doc['last_upload']}
+        pipeline = [
+            {'$match': {**match, 'track_count': {'$gt': 0}}},
+            {'$group': {'_id': '$artist_key', 'albums': {'$sum': 1}}}
+        ]
+        for doc in mongo_db.albums_collection.aggregate(pipeline):
+            if doc['_id'] in stats:
+                stats[doc['_id']]['albums'] = doc['albums']
+        return stats
+
+    @staticmethod
+    def reconcile_stats(batch_size=500):
+        """Rewrites every artist's counters from the catalog. Returns how many had drifted."""
+        stats = Artist.compute_stats()
+        operations = []
+        drifted = 0
+        for artist_doc in mongo_db.artists_collection.find({}, {'name_key': 1, 'stats': 1}):
+            expected = stats.get(artist_doc.get('name_key'), Artist.EMPTY_STATS)
+            if artist_doc.get('stats') != expected:
+                drifted += 1
+                operations.append(UpdateOne({'_id': artist_doc['_id']}, {'$set': {'stats': expected}}))
+            if len(operations) >= batch_size:
+                mongo_db.artists_collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            mongo_db.artists_collection.bulk_write(operations, ordered=False)
+        clear_loader('artists')
+        return drifted
+
+    @staticmethod
+    def _load_by_keys(name_keys):
+        artists = {}
+        for artist_doc in mongo_db.artists_collection.find({'name_key': {'$in': name_keys}}):
+            artists.setdefault(artist_doc['name_key'], Artist.from_document(artist_doc))
+        return artists
+
+    @staticmethod
+    def _load_counts(name_keys):
+        """(song count, album count) per artist key, in one aggregation."""
+        pipeline = [
+            {'$match': {'artist_key': {'$in': name_keys}}},
+            {'$group': {'_id': '$artist_key', 'songs': {'$sum': 1}, 'albums': {'$addToSet': '$album_key'}}}
+        ]
+        return {doc['_id']: (doc['songs'], len([album for album in doc['albums'] if album]))
+                for doc in mongo_db.songs_collection.aggregate(pipeline)}
+
+    @staticmethod
+    def prefetch_counts(artists):
+        """Queues song/album counts for artists without stored stats so they load in one query."""
+        get_loader('artist_counts', Artist._load_counts).enqueue(
+            normalize_key(artist.name) for artist in artists if artist.stats is None
+        )
     
     @staticmethod
     def get_by_name(name):
         try:
-            artist_doc = mongo_db.artists_collection.find_one({'name': {'$regex': f'^{re.escape(name)}$', '$options': 'i'}})
-            if artist_doc:
-                artist = Artist(
-                    name=artist_doc['name'],
-                    description=artist_doc.get('description', ''),
-                    photo_id=str(artist_doc['photo_id']) if artist_doc.get('photo_id') else None,
-                    created_date=artist_doc.get('created_date')
-                )
-                artist.id = str(artist_doc['_id'])
-                return artist
+            # Memoized for the request, so repeated template lookups cost one query
+            return get_loader('artists', Artist._load_by_keys).load(normalize_key(name))
         except Exception as e:
             print(f"Error getting artist by name: {e}")
         return None
@@ -644,14 +1312,7 @@ class Artist:
         try:
             artist_doc = mongo_db.artists_collection.find_one({'_id': ObjectId(artist_id)})
             if artist_doc:
-                artist = Artist(
-                    name=artist_doc['name'],
-                    description=artist_doc.get('description', ''),
-                    photo_id=str(artist_doc['photo_id']) if artist_doc.get('photo_id') else None,
-                    created_date=artist_doc.get('created_date')
-                )
-                artist.id = str(artist_doc['_id'])
-                return artist
+                return Artist.from_document(artist_doc)
         except Exception as e:
             print(f"Error getting artist by ID: {e}")
         return None
@@ -659,10 +1320,17 @@ class Artist:
     @staticmethod
     def update(artist_id, update_data):
         try:
+            if 'name' in update_data:
+                name_key = normalize_key(update_data['name'])
+                # Renamed onto another artist key: take over that key's counters
+                stats = Artist.compute_stats([name_key]).get(name_key, dict(Artist.EMPTY_STATS))
+                update_data = {**update_data, 'name_key': name_key, 'stats': stats}
+            clear_loader('artists')
             result = mongo_db.artists_collection.update_one(
                 {'_id': ObjectId(artist_id)},
                 {'$set': update_data}
             )
+            page_cache.bump()
             return result.modified_count > 0
         except Exception as e:
             print(f"Error updating artist: {e}")
@@ -672,9 +1340,11 @@ class Artist:
     def delete(artist_id):
         try:
             artist_doc = mongo_db.artists_collection.find_one_and_delete({'_id': ObjectId(artist_id)})
+            clear_loader('artists')
+            page_cache.bump()
             if artist_doc and artist_doc.get('photo_id'):
                 try:
-                    mongo_db.fs.delete(ObjectId(artist_doc['photo_id']))
+                    BlobStore.release(artist_doc['photo_id'])
                 except Exception as e:
                     print(f"Error deleting artist photo: {e}")
             return True
@@ -683,8 +1353,9 @@ class Artist:
             return False
     
     @staticmethod
-    def store_file(file_data, filename, metadata=None):
-        return mongo_db.fs.put(file_data, filename=filename, metadata=metadata)
+    def store_file(source, filename, metadata=None):
+        """Stores bytes or a readable file in GridFS one chunk at a time, deduplicated by content."""
+        return BlobStore.put(source, filename, metadata)[0]
     
     @staticmethod
     def get_file(file_id):
@@ -692,25 +1363,25 @@ class Artist:
     
     def get_song_count(self):
         """Get the number of songs by this artist"""
-        return mongo_db.songs_collection.count_documents({'artist': {'$regex': f'^{re.escape(self.name)}$', '$options': 'i'}})
+        if self.stats is not None:
+            return self.stats.get('songs', 0)
+        counts = get_loader('artist_counts', Artist._load_counts).load(normalize_key(self.name))
+        return counts[0] if counts else 0
     
     def get_album_count(self):
         """Get the number of unique albums by this artist"""
-        pipeline = [
-            {'$match': {'artist': {'$regex': f'^{re.escape(self.name)}$', '$options': 'i'}, 'album': {'$ne': None, '$ne': ''}}},
-            {'$group': {'_id': '$album'}},
-            {'$count': 'total'}
-        ]
-        result = list(mongo_db.songs_collection.aggregate(pipeline))
-        return result[0]['total'] if result else 0
+        if self.stats is not None:
+            return self.stats.get('albums', 0)
+        counts = get_loader('artist_counts', Artist._load_counts).load(normalize_key(self.name))
+        return counts[1] if counts else 0
 
     @staticmethod
     def get_album_info(album_name, artist_name):
         """Get album information including description."""
         try:
             album_doc = mongo_db.albums_collection.find_one({
-                'name': album_name,
-                'artist': {'$regex': f'^{re.escape(artist_name)}$', '$options': 'i'}
+                'artist_key': normalize_key(artist_name),
+                'album_key': normalize_key(album_name)
             })
             return album_doc
         except Exception as e:
@@ -725,27 +1396,217 @@ class Artist:
                 'name': album_name,
                 'artist': artist_name,
                 'description': description,
-                'updated_date': datetime.utcnow()
+                'updated_date': datetime.utcnow(),
+                'artist_key': normalize_key(artist_name),
+                'album_key': normalize_key(album_name)
             }
             
-            # Check if album info already exists
-            existing_album = mongo_db.albums_collection.find_one({
-                'name': album_name,
-                'artist': {'$regex': f'^{re.escape(artist_name)}$', '$options': 'i'}
-            })
-            
-            if existing_album:
-                # Update existing album info
-                result = mongo_db.albums_collection.update_one(
-                    {'_id': existing_album['_id']},
-                    {'$set': album_data}
-                )
-                return result.modified_count > 0
-            else:
-                # Create new album info
-                album_data['created_date'] = datetime.utcnow()
-                result = mongo_db.albums_collection.insert_one(album_data)
-                return result.inserted_id is not None
+            # One upsert on the unique keys, so concurrent saves cannot create two documents
+            result = mongo_db.albums_collection.update_one(
+                {'artist_key': album_data['artist_key'], 'album_key': album_data['album_key']},
+                {'$set': album_data, '$setOnInsert': {'created_date': datetime.utcnow()}},
+                upsert=True
+            )
+            saved = result.modified_count > 0 or result.upserted_id is not None
+            page_cache.bump()
+            return saved
         except Exception as e:
             print(f"Error saving album info: {e}")
             return False
+
+
+class Album:
+    """Read model of each album, kept in the albums collection beside its description.
+
+    One document per (artist_key, album_key) holds the display name, art, track count,
+    latest upload and track ids in upload order. Song writes call `refresh`, which
+    recomputes just that album from the songs index, so listings never group the
+    whole songs collection. `flask rebuild-albums` backfills it.
+    """
+    # Song fields whose change can alter an album document
+    SONG_FIELDS = {'artist', 'album', 'album_art_id'}
+    LIST_FIELDS = {'name': 1, 'artist': 1, 'album_art_id': 1, 'track_count': 1, 'latest_upload': 1}
+
+    @staticmethod
+    def _document(song_docs):
+        """Album fields from its song documents, oldest upload first."""
+        latest = song_docs[-1]
+        return {
+            'name': latest.get('album'),
+            'artist': latest.get('artist'),
+            # The newest track that has art, as the album cards always showed
+            'album_art_id': next((doc['album_art_id'] for doc in reversed(song_docs) if doc.get('album_art_id')), None),
+            'track_count': len(song_docs),
+            'latest_upload': latest.get('upload_date'),
+            'track_ids': [doc['_id'] for doc in song_docs]
+        }
+
+    @staticmethod
+    def _update(song_docs):
+        """Returns (update, upsert) bringing an album document in line with its songs."""
+        if song_docs:
+            return {'$set': Album._document(song_docs), '$setOnInsert': {'created_date': datetime.utcnow()}}, True
+        # No tracks left: an album with a description keeps it, just out of listings
+        return {'$set': {'track_count': 0, 'track_ids': []}}, False
+
+    @staticmethod
+    def refresh(artist_key, album_key):
+        """Recomputes one album document after a song in it was added, edited or deleted."""
+        if not album_key:
+            return
+        try:
+            song_docs = list(mongo_db.songs_collection.find(
+                {'album_key': album_key, 'artist_key': artist_key},
+                {'artist': 1, 'album': 1, 'album_art_id': 1, 'upload_date': 1}
+            ).sort('upload_date', 1))
+            update, upsert = Album._update(song_docs)
+            before = mongo_db.albums_collection.find_one_and_update(
+                {'artist_key': artist_key, 'album_key': album_key}, update,
+                projection={'track_count': 1}, upsert=upsert
+            )
+            had_tracks = bool(before and before.get('track_count'))
+            if had_tracks != bool(song_docs):
+                # The album appeared in or left the artist's discography
+                Artist.adjust_stats(artist_key, albums=1 if song_docs else -1)
+            if not song_docs:
+                mongo_db.albums_collection.delete_one({'artist_key': artist_key, 'album_key': album_key,
+                                                       'description': {'$in': [None, '']}})
+        except Exception as e:
+            print(f"Error refreshing album: {e}")
+
+    @staticmethod
+    def merge_duplicates():
+        """Keeps one document per (artist_key, album_key), preferring one with a description.
+
+        Duplicates could be created before the keys had a unique index. Returns the number removed.
+        """
+        removed = 0
+        pipeline = [
+            {'$match': {'album_key': {'$exists': True}}},
+            {'$group': {'_id': {'artist_key': '$artist_key', 'album_key': '$album_key'},
+                        'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}}
+        ]
+        for group in list(mongo_db.albums_collection.aggregate(pipeline)):
+            album_docs = list(mongo_db.albums_collection.find({'_id': {'$in': group['ids']}}))
+            album_docs.sort(key=lambda doc: (not doc.get('description'), doc['_id']))
+            extra = [doc['_id'] for doc in album_docs[1:]]
+            removed += mongo_db.albums_collection.delete_many({'_id': {'$in': extra}}).deleted_count
+        return removed
+
+    @staticmethod
+    def rebuild(batch_size=500):
+        """Recomputes every album document from the songs collection. Returns the number of albums."""
+        Album.merge_duplicates()
+        operations = []
+        seen = set()
+        current, song_docs = None, []
+
+        def flush():
+            if current:
+                update, upsert = Album._update(song_docs)
+                operations.append(UpdateOne({'artist_key': current[0], 'album_key': current[1]}, update, upsert=upsert))
+                seen.add(current)
+            if len(operations) >= batch_size:
+                mongo_db.albums_collection.bulk_write(operations, ordered=False)
+                operations.clear()
+
+        # Streams songs already grouped by album (the Album.refresh index), one album in memory at a time
+        cursor = mongo_db.songs_collection.find(
+            {'album_key': {'$nin': [None, '']}},
+            {'artist': 1, 'album': 1, 'album_art_id': 1, 'upload_date': 1, 'artist_key': 1, 'album_key': 1}
+        ).sort([('album_key', 1), ('artist_key', 1), ('upload_date', 1)])
+        for doc in cursor:
+            keys = (doc.get('artist_key'), doc['album_key'])
+            if keys != current:
+                flush()
+                current, song_docs = keys, []
+            song_docs.append(doc)
+        flush()
+        if operations:
+            mongo_db.albums_collection.bulk_write(operations, ordered=False)
+
+        # Albums whose songs are all gone
+        for album_doc in mongo_db.albums_collection.find({'track_count': {'$gt': 0}}, {'artist_key': 1, 'album_key': 1}):
+            if (album_doc.get('artist_key'), album_doc.get('album_key')) not in seen:
+                Album.refresh(album_doc.get('artist_key'), album_doc.get('album_key'))
+        page_cache.bump()
+        return len(seen)
+
+    @staticmethod
+    def to_dict(album_doc):
+        return {
+            'name': album_doc['name'],
+            'artist': album_doc['artist'],
+            'album_art_id': str(album_doc['album_art_id']) if album_doc.get('album_art_id') else None,
+            'song_count': album_doc.get('track_count', 0),
+            'latest_upload': album_doc.get('latest_upload')
+        }
+
+    @staticmethod
+    def get_recent(limit=4):
+        """Albums ordered by their latest upload."""
+        query = mongo_db.albums_collection.find({'track_count': {'$gt': 0}}, Album.LIST_FIELDS)
+        return [Album.to_dict(album_doc) for album_doc in query.sort('latest_upload', -1).limit(limit)]
+
+    @staticmethod
+    def get_by_artist(artist_name):
+        """One artist's albums, newest first."""
+        query = mongo_db.albums_collection.find(
+            {'artist_key': normalize_key(artist_name), 'track_count': {'$gt': 0}}, Album.LIST_FIELDS
+        )
+        return [Album.to_dict(album_doc) for album_doc in query.sort('latest_upload', -1)]
+
+    @staticmethod
+    def get_tracks(album_name, artist_name):
+        """Returns (album document, its songs in upload order), or None if the album has no tracks."""
+        album_doc = mongo_db.albums_collection.find_one({
+            'artist_key': normalize_key(artist_name),
+            'album_key': normalize_key(album_name)
+        })
+        if not album_doc or not album_doc.get('track_count'):
+            return None
+        songs = Song.loader().load_many(str(song_id) for song_id in album_doc['track_ids'])
+        return album_doc, [song for song in songs if song]
+
+
+class AlbumUpload:
+    """Per-track progress of an album upload, polled by upload_album.html.
+
+    Stored in MongoDB rather than in memory so any worker can answer the poll.
+    """
+
+    @staticmethod
+    def start(upload_id, filenames):
+        mongo_db.uploads_collection.replace_one({'_id': upload_id}, {
+            '_id': upload_id,
+            'done': False,
+            'tracks': [{'filename': name, 'status': 'pending'} for name in filenames],
+            'created_date': datetime.utcnow()
+        }, upsert=True)
+
+    @staticmethod
+    def set_track_status(upload_id, index, status, error=None):
+        """Marks one track as 'stored' (audio is in GridFS), 'saved' or 'failed'."""
+        update = {f'tracks.{index}.status': status}
+        if error:
+            update[f'tracks.{index}.error'] = error
+        mongo_db.uploads_collection.update_one({'_id': upload_id}, {'$set': update})
+
+    @staticmethod
+    def finish(upload_id):
+        mongo_db.uploads_collection.update_one({'_id': upload_id}, {'$set': {'done': True}})
+
+    @staticmethod
+    def get(upload_id):
+        upload = mongo_db.uploads_collection.find_one({'_id': upload_id}, {'created_date': 0})
+        if not upload:
+            return None
+        statuses = [track['status'] for track in upload['tracks']]
+        return {
+            'done': upload['done'],
+            'total': len(statuses),
+            'completed': sum(1 for status in statuses if status != 'pending'),
+            'failed': statuses.count('failed'),
+            'tracks': upload['tracks']
+        }
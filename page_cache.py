@@ -0,0 +1,102 @@
+"""Cache of rendered fragments and JSON payloads derived from the catalog.
+
+Entries are keyed by the catalog version, a counter in the `meta` collection that every
+catalog write bumps (Song.save/update/delete, artist and album edits). A bump makes all
+older entries unreachable at once, in this worker immediately and in others within
+CATALOG_VERSION_CHECK_SECONDS; they then age out of the LRU. Anything per-user (liked
+songs) is merged in after a cached fragment is served, so entries are shared by every
+viewer with the same role.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict
+from pymongo import ReturnDocument
+
+
+class PageCache:
+    def __init__(self):
+        self.meta = None
+        self.default_ttl = 300
+        self.ttls = {}
+        self.max_entries = 1000
+        self.check_seconds = 2
+        self.version = 0
+        self._checked = 0
+        self._entries = OrderedDict()  # (namespace, key, version) -> (expires, value)
+        self._hits = Counter()
+        self._misses = Counter()
+        self._lock = threading.Lock()
+
+    def init_app(self, app, meta_collection):
+        self.meta = meta_collection
+        self.default_ttl = app.config.get('PAGE_CACHE_TTL', 300)
+        self.ttls = app.config.get('PAGE_CACHE_TTLS', {})
+        self.max_entries = app.config.get('PAGE_CACHE_MAX_ENTRIES', 1000)
+        self.check_seconds = app.config.get('CATALOG_VERSION_CHECK_SECONDS', 2)
+
+    def catalog_version(self):
+        """The shared catalog version, re-read at most every check_seconds."""
+        now = time.monotonic()
+        if self.meta is not None and now - self._checked >= self.check_seconds:
+            try:
+                doc = self.meta.find_one({'_id': 'catalog'}, {'version': 1})
+                self.version = doc['version'] if doc else 0
+            except Exception as e:
+                print(f"Error reading catalog version: {e}")
+            self._checked = now
+        return self.version
+
+    def bump(self):
+        """Invalidates every cached entry after a catalog write."""
+        if self.meta is None:
+            return
+        try:
+            doc = self.meta.find_one_and_update(
+                {'_id': 'catalog'}, {'$inc': {'version': 1}},
+                upsert=True, return_document=ReturnDocument.AFTER
+            )
+            self.version = doc['version']
+            self._checked = time.monotonic()
+        except Exception as e:
+            print(f"Error bumping catalog version: {e}")
+
+    def get_or_set(self, namespace, key, build):
+        """Returns the cached value for (namespace, key), calling build() on a miss.
+
+        build() may return None (e.g. not found); that is cached too.
+        """
+        entry_key = (namespace, key, self.catalog_version())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(entry_key)
+                self._hits[namespace] += 1
+                return entry[1]
+            self._misses[namespace] += 1
+        value = build()
+        with self._lock:
+            self._entries[entry_key] = (now + self.ttls.get(namespace, self.default_ttl), value)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        """Hit/miss counts per namespace for this worker."""
+        with self._lock:
+            namespaces = sorted(set(self._hits) | set(self._misses))
+            return {
+                'version': self.version,
+                'entries': len(self._entries),
+                'namespaces': {
+                    namespace: {
+                        'hits': self._hits[namespace],
+                        'misses': self._misses[namespace],
+                        'hit_rate': round(self._hits[namespace] / ((self._hits[namespace] + self._misses[namespace]) or 1), 3)
+                    } for namespace in namespaces
+                }
+            }
+
+
+page_cache = PageCache()
@@ -0,0 +1,246 @@
+"""Write-behind buffer for play events (/api/track-play).
+
+A play is queued in memory and acknowledged at once. A background thread flushes the queue
+every PLAY_FLUSH_INTERVAL_MS, or as soon as PLAY_FLUSH_EVENTS plays are waiting, as one
+bulk_write with a single update per user: all of that user's plays in the batch are
+coalesced into one pipeline update of recently_played. The same batch is appended to the
+listening history buckets (history.py).
+
+Durability is configurable: the queue is flushed at interpreter exit (PLAY_FLUSH_ON_EXIT),
+and with PLAY_SPOOL_PATH set every play is also appended to a local spool file (one per
+worker process) until the batch holding it has been written. Spool files of processes that
+are no longer running are claimed (renamed, so only one worker gets each) and replayed by
+the next worker to record a play, or by `flask flush-plays`.
+Replaying a play is harmless: recently_played only moves the song to the front again, and
+the history skips plays whose event id it already holds.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne
+from history import listening_history
+
+RECENTLY_PLAYED_LIMIT = 15
+
+
+class PlayBuffer:
+    def __init__(self):
+        self.users = None
+        self.flush_interval = 1.0
+        self.flush_events = 500
+        self.max_events = 100000
+        self.spool_path = None
+        self._pending = []        # (user_id, song_id, played_at, event_id) in play order
+        self._spool = None
+        self._spool_files = []    # rotated spool files whose plays are not written yet
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self.metrics = {'queued': 0, 'flushed': 0, 'batches': 0, 'failed_batches': 0, 'dropped': 0,
+                        'last_flush_ms': 0.0, 'last_batch_size': 0}
+
+    def init_app(self, app, users_collection):
+        self.users = users_collection
+        self.flush_interval = app.config.get('PLAY_FLUSH_INTERVAL_MS', 1000) / 1000
+        self.flush_events = app.config.get('PLAY_FLUSH_EVENTS', 500)
+        self.max_events = app.config.get('PLAY_BUFFER_MAX_EVENTS', 100000)
+        self.spool_path = app.config.get('PLAY_SPOOL_PATH') or None
+        if app.config.get('PLAY_FLUSH_ON_EXIT', True):
+            atexit.register(self.flush)
+
+    @staticmethod
+    def _running(pid):
+        """Whether the process that owns a spool file may still be writing it."""
+        if pid == os.getpid():
+            return False  # A previous process with our pid (e.g. a restarted container)
+        if os.name != 'posix':
+            return True   # No safe liveness check: leave it to its owner
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def recover(self):
+        """Queues plays left in spool files by processes that are no longer running.
+
+        Returns the number of plays queued. Call before this process opens its own spool file.
+        """
+        if not self.spool_path:
+            return 0
+        recovered = []
+        for path in sorted(glob.glob(f'{glob.escape(self.spool_path)}.*')):
+            try:
+                pid = int(path[len(self.spool_path) + 1:].split('.')[0])
+            except ValueError:
+                continue
+            if self._running(pid):
+                continue
+            # Claiming the file under our pid keeps other workers off it, and if we crash
+            # before writing its plays the next worker recovers it from us
+            claimed = f'{self._spool_file()}.{time.time_ns()}'
+            try:
+                os.replace(path, claimed)
+            except OSError:
+                continue  # Claimed by another worker first
+            try:
+                with open(claimed) as f:
+                    for line in f:
+                        try:
+                            event = json.loads(line)
+                            played_at = datetime.fromisoformat(event['played_at'])
+                            recovered.append((event['user_id'], event['song_id'], played_at,
+                                              event.get('event_id') or str(ObjectId())))
+                        except (ValueError, KeyError):
+                            continue  # A line cut short by a crash
+            except OSError as e:
+                print(f"Error reading play spool {claimed}: {e}")
+            with self._lock:
+                self._spool_files.append(claimed)
+        with self._lock:
+            self._pending[:0] = recovered
+            self.metrics['queued'] += len(recovered)
+        return len(recovered)
+
+    def _spool_file(self):
+        return f'{self.spool_path}.{os.getpid()}'
+
+    def _ensure_thread(self):
+        # Started lazily so that forked workers (gunicorn --preload) each get their own
+        if self._thread_pid != os.getpid():
+            self._thread_pid = os.getpid()
+            # Spool state inherited from a parent process is the parent's to finish
+            self._spool = None
+            self._spool_files = []
+            try:
+                self.recover()
+            except Exception as e:
+                print(f"Error recovering play spool: {e}")
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the thread alive; the next interval tries again
+                print(f"Error in play flush thread: {e}")
+
+    def record(self, user_id, song_id):
+        """Queues a play. song_id must be a valid ObjectId string."""
+        played_at = datetime.utcnow()
+        event_id = str(ObjectId())
+        # Before the first spool write, so recovery never sees this process's own file
+        self._ensure_thread()
+        with self._lock:
+            if self.spool_path:
+                try:
+                    if self._spool is None:
+                        self._spool = open(self._spool_file(), 'a')
+                    self._spool.write(json.dumps({'user_id': user_id, 'song_id': song_id,
+                                                  'played_at': played_at.isoformat(),
+                                                  'event_id': event_id}) + '\n')
+                    self._spool.flush()
+                except OSError as e:
+                    # The play is still queued in memory
+                    print(f"Error writing play spool: {e}")
+            self._pending.append((user_id, song_id, played_at, event_id))
+            self.metrics['queued'] += 1
+            if len(self._pending) > self.max_events:
+                # Writes are failing for a long time: keep the newest plays
+                dropped = len(self._pending) - self.max_events
+                del self._pending[:dropped]
+                self.metrics['dropped'] += dropped
+            full = len(self._pending) >= self.flush_events
+        if full:
+            self._wake.set()
+
+    @staticmethod
+    def _coalesce(events):
+        """user_id -> that user's distinct played songs, most recent first."""
+        recent = {}
+        for user_id, song_id, *_ in reversed(events):
+            songs = recent.setdefault(user_id, [])
+            if song_id not in songs and len(songs) < RECENTLY_PLAYED_LIMIT:
+                songs.append(song_id)
+        return recent
+
+    @staticmethod
+    def _update(song_ids):
+        """One pipeline update that moves `song_ids` to the front of recently_played."""
+        song_ids = [ObjectId(song_id) for song_id in song_ids]
+        return [{'$set': {'recently_played': {'$slice': [{'$concatArrays': [song_ids, {'$filter': {
+            'input': {'$ifNull': ['$recently_played', []]},
+            'cond': {'$not': [{'$in': ['$$this', song_ids]}]}
+        }}]}, RECENTLY_PLAYED_LIMIT]}}}]
+
+    def flush(self):
+        """Writes every queued play. Returns the number of plays written."""
+        with self._flushing:
+            with self._lock:
+                events, self._pending = self._pending, []
+                if self._spool is not None:
+                    # Plays queued from here on go to a fresh spool file
+                    rotated = f'{self._spool_file()}.{time.time_ns()}'
+                    try:
+                        self._spool.close()
+                        os.replace(self._spool_file(), rotated)
+                        self._spool_files.append(rotated)
+                    except OSError as e:
+                        print(f"Error rotating play spool: {e}")
+                    self._spool = None
+                spool_files = list(self._spool_files)
+            if not events:
+                return 0
+            started = time.perf_counter()
+            operations = [UpdateOne({'_id': ObjectId(user_id)}, self._update(song_ids))
+                          for user_id, song_ids in self._coalesce(events).items()]
+            try:
+                self.users.bulk_write(operations, ordered=False)
+                # Retrying a failed history write repeats the recently_played update, which is harmless,
+                # and skips the plays the history already holds
+                listening_history.record(events)
+            except Exception as e:
+                print(f"Error flushing play buffer: {e}")
+                with self._lock:
+                    # Retry with the next flush, ahead of anything queued meanwhile
+                    self._pending[:0] = events
+                    self.metrics['failed_batches'] += 1
+                return 0
+            for path in spool_files:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            with self._lock:
+                self._spool_files = [path for path in self._spool_files if path not in spool_files]
+                self.metrics['flushed'] += len(events)
+                self.metrics['batches'] += 1
+                self.metrics['last_batch_size'] = len(events)
+                self.metrics['last_flush_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            return len(events)
+
+    def pending_for(self, user_id):
+        """A user's queued plays, most recent first, so reads can include them before the flush."""
+        with self._lock:
+            events = [event for event in self._pending if event[0] == user_id]
+        return self._coalesce(events).get(user_id, [])
+
+    def stats(self):
+        with self._lock:
+            return {**self.metrics, 'depth': len(self._pending),
+                    'users_pending': len({event[0] for event in self._pending}),
+                    'spool_files': len(self._spool_files)}
+
+
+play_buffer = PlayBuffer()
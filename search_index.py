@@ -0,0 +1,460 @@
+"""In-memory inverted index over the song catalog for /search.
+
+Each process keeps postings of term -> {song_id: field-boosted weight} plus a trigram ->
+terms map for typo tolerance. The index is built in the background at startup (or loaded
+from a snapshot), updated in place by Song.save/update/delete, and periodically catches
+up on songs written by other workers via their upload/updated dates.
+"""
+import heapq
+import os
+import pickle
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from itertools import islice
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta, timezone
+from suggest_index import SuggestIndex
+
+FIELD_BOOSTS = {'title': 3.0, 'artist': 2.0, 'album': 1.5, 'genre': 1.0}
+PROJECTION = {'title': 1, 'artist': 1, 'album': 1, 'genre': 1, 'upload_date': 1}
+
+# Score multipliers for terms that only match a query term approximately
+PREFIX_FACTOR = 0.8
+FUZZY_FACTOR = 0.6
+MAX_PREFIX_EXPANSIONS = 50
+MAX_FUZZY_EXPANSIONS = 10
+MIN_FUZZY_SIMILARITY = 0.3
+# Added per upload-second to every weight so equal scores rank the newest song first
+RECENCY_EPSILON = 1e-14
+
+# Ranked results kept per query; any write to the index clears them
+CACHED_RESULTS = 240
+MAX_CACHED_QUERIES = 1024
+# Queries matching at most this many songs score them all; larger ones walk the rarest
+# term's postings best first and stop once no remaining song can enter the top results,
+# or after scoring MAX_SCORED matches (the total is still exact)
+SCORE_ALL_LIMIT = 2000
+MAX_SCORED = 500
+
+# Tolerates clock skew between app servers when catching up on recent writes
+CATCH_UP_MARGIN = timedelta(seconds=5)
+SNAPSHOT_VERSION = 2
+
+
+def tokenize(text):
+    """Splits text into casefolded, accent-stripped word tokens."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    return re.findall(r'\w+', text)
+
+
+def trigrams(term):
+    padded = f' {term} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    def __init__(self):
+        self.collection = None
+        self.playlist_items = None
+        self.snapshot_path = None
+        self.refresh_seconds = 30
+        self.ready = False
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock()
+        self._last_refresh = 0
+        self._reset()
+
+    def _reset(self):
+        self.docs = {}             # song_id -> (title, artist, album, genre, upload timestamp)
+        self.postings = {}         # term -> {song_id: weight}
+        self.term_trigrams = {}    # trigram -> set of terms
+        self.terms = []            # sorted vocabulary, for prefix expansion
+        self._ordered = {}         # term -> [(-weight, song_id)] ascending, built on first use and kept in step
+        self._results = OrderedDict()  # query terms -> (top song ids, total)
+        self.suggestions = SuggestIndex(tokenize)
+        self.synced_at = None
+
+    def init_app(self, app, collection, playlist_items=None):
+        self.collection = collection
+        self.playlist_items = playlist_items
+        self.snapshot_path = app.config.get('SEARCH_SNAPSHOT_PATH')
+        self.refresh_seconds = app.config.get('SEARCH_REFRESH_SECONDS', 30)
+        threading.Thread(target=self._load, daemon=True).start()
+
+    def _load(self):
+        try:
+            if not (self.snapshot_path and self.load_snapshot(self.snapshot_path)):
+                self.build()
+                if self.snapshot_path:
+                    self.save_snapshot(self.snapshot_path)
+            self.ready = True
+        except Exception as e:
+            print(f"Error building search index: {e}")
+
+    def build(self):
+        """Indexes the whole catalog into fresh structures, then swaps them in."""
+        started = datetime.utcnow()
+        fresh = SearchIndex()
+        fresh.suggestions.popularity = self._song_popularity()
+        for song_doc in self.collection.find({}, PROJECTION):
+            fresh._index(str(song_doc['_id']), song_doc, sort_terms=False)
+        fresh.terms = sorted(fresh.postings)
+        fresh.suggestions.finish_build()
+        with self._lock:
+            self.docs, self.postings = fresh.docs, fresh.postings
+            self.term_trigrams, self.terms = fresh.term_trigrams, fresh.terms
+            self.suggestions = fresh.suggestions
+            self._ordered = {}
+            self._results.clear()
+            self._order_broad_terms()
+        # Pick up anything written while the build was running
+        self.catch_up(started)
+
+    def _song_popularity(self):
+        """Number of playlists (Liked Songs included) each song is in."""
+        if self.playlist_items is None:
+            return {}
+        pipeline = [{'$group': {'_id': '$song_id', 'count': {'$sum': 1}}}]
+        return {str(doc['_id']): doc['count'] for doc in self.playlist_items.aggregate(pipeline)}
+
+    def catch_up(self, since):
+        """Re-indexes songs uploaded or edited since `since` (e.g. by other workers)."""
+        synced_at = datetime.utcnow()
+        since -= CATCH_UP_MARGIN
+        query = {'$or': [{'upload_date': {'$gte': since}}, {'updated_date': {'$gte': since}}]}
+        for song_doc in self.collection.find(query, PROJECTION):
+            self.add(str(song_doc['_id']), song_doc)
+        self.synced_at = synced_at
+        self._last_refresh = time.monotonic()
+
+    def _refresh_if_stale(self):
+        if not self.ready or time.monotonic() - self._last_refresh < self.refresh_seconds:
+            return
+        if self._refreshing.acquire(blocking=False):
+            try:
+                self.catch_up(self.synced_at)
+            except Exception as e:
+                print(f"Error refreshing search index: {e}")
+            finally:
+                self._refreshing.release()
+
+    def _index(self, song_id, song_doc, sort_terms=True):
+        self._results.clear()
+        upload_date = song_doc.get('upload_date')
+        self.docs[song_id] = (
+            song_doc.get('title') or '', song_doc.get('artist') or '', song_doc.get('album') or '',
+            song_doc.get('genre') or '', upload_date.replace(tzinfo=timezone.utc).timestamp() if upload_date else 0
+        )
+        self.suggestions.add_song(song_id, *self.docs[song_id][:3], bulk=not sort_terms)
+        for term, weight in self._weights(self.docs[song_id]).items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                for trigram in trigrams(term):
+                    self.term_trigrams.setdefault(trigram, set()).add(term)
+                if sort_terms:
+                    insort(self.terms, term)
+            self._unorder(term, song_id)
+            postings[song_id] = weight
+            order = self._ordered.get(term)
+            if order is not None:
+                insort(order, (-weight, song_id))
+
+    def _unindex(self, song_id):
+        doc = self.docs.pop(song_id, None)
+        if doc is None:
+            return None
+        self._results.clear()
+        self.suggestions.remove_song(song_id)
+        for term in self._weights(doc):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            self._unorder(term, song_id)
+            postings.pop(song_id, None)
+            if not postings:
+                del self.postings[term]
+                self._ordered.pop(term, None)
+                for trigram in trigrams(term):
+                    self.term_trigrams[trigram].discard(term)
+                i = bisect_left(self.terms, term)
+                if i < len(self.terms) and self.terms[i] == term:
+                    del self.terms[i]
+        return doc
+
+    def _unorder(self, term, song_id):
+        """Takes a song out of a term's weight order, if it is in it."""
+        order = self._ordered.get(term)
+        weight = self.postings[term].get(song_id)
+        if order is None or weight is None:
+            return
+        i = bisect_left(order, (-weight, song_id))
+        if i < len(order) and order[i][1] == song_id:
+            del order[i]
+
+    @staticmethod
+    def _weights(doc):
+        weights = {}
+        for text, boost in zip(doc, FIELD_BOOSTS.values()):
+            for term in set(tokenize(text)):
+                weights[term] = weights.get(term, doc[4] * RECENCY_EPSILON) + boost
+        return weights
+
+    def add(self, song_id, song_doc):
+        with self._lock:
+            self._unindex(song_id)
+            self._index(song_id, song_doc)
+
+    def update(self, song_id, fields):
+        """Applies a partial update (any of title/artist/album/genre) to an indexed song."""
+        with self._lock:
+            doc = self._unindex(song_id)
+            if doc is None:
+                return
+            song_doc = dict(zip(('title', 'artist', 'album', 'genre'), doc))
+            song_doc.update({k: v for k, v in fields.items() if k in FIELD_BOOSTS})
+            song_doc['upload_date'] = datetime.fromtimestamp(doc[4], timezone.utc) if doc[4] else None
+            self._index(song_id, song_doc)
+
+    def remove(self, song_id):
+        with self._lock:
+            self._unindex(song_id)
+
+    def _expand(self, term, prefix):
+        """Returns [(indexed term, score factor)] that a query term matches."""
+        expansions = {}
+        if term in self.postings:
+            expansions[term] = 1.0
+        if prefix:
+            # The last query term may still be being typed
+            i = bisect_left(self.terms, term)
+            while i < len(self.terms) and len(expansions) < MAX_PREFIX_EXPANSIONS and \
+                    self.terms[i].startswith(term):
+                expansions.setdefault(self.terms[i], PREFIX_FACTOR)
+                i += 1
+        if not expansions and len(term) >= 3:
+            # Typo tolerance: indexed terms sharing enough trigrams with the query term
+            query_trigrams = trigrams(term)
+            shared = {}
+            for trigram in query_trigrams:
+                for candidate in self.term_trigrams.get(trigram, ()):
+                    shared[candidate] = shared.get(candidate, 0) + 1
+            similar = []
+            for candidate, count in shared.items():
+                similarity = count / (len(query_trigrams) + len(trigrams(candidate)) - count)
+                if similarity >= MIN_FUZZY_SIMILARITY:
+                    similar.append((similarity, candidate))
+            for similarity, candidate in heapq.nlargest(MAX_FUZZY_EXPANSIONS, similar):
+                expansions[candidate] = FUZZY_FACTOR * similarity
+        return list(expansions.items())
+
+    def search(self, query, page=1, per_page=24):
+        """Returns (song ids for the page, total matches), best match first.
+
+        Every query term must match a title, artist, album or genre term exactly, as a
+        prefix (last term only) or approximately.
+        """
+        self._refresh_if_stale()
+        terms = tuple(tokenize(query))
+        if not terms:
+            return [], 0
+        end = max(page, 1) * per_page
+        with self._lock:
+            if end > CACHED_RESULTS:
+                top, total = self._rank(terms, end)
+            else:
+                cached = self._results.get(terms)
+                if cached is None:
+                    cached = self._results[terms] = self._rank(terms, CACHED_RESULTS)
+                    if len(self._results) > MAX_CACHED_QUERIES:
+                        self._results.popitem(last=False)
+                else:
+                    self._results.move_to_end(terms)
+                top, total = cached
+            return top[end - per_page:end], total
+
+    def _by_weight(self, term):
+        order = self._ordered.get(term)
+        if order is None:
+            postings = self.postings[term]
+            order = self._ordered[term] = sorted((-weight, song_id) for song_id, weight in postings.items())
+        return order
+
+    def _order_broad_terms(self):
+        """Sorts the postings of broad terms (genres, common words) ahead of the first query."""
+        for term, postings in self.postings.items():
+            if len(postings) > SCORE_ALL_LIMIT:
+                self._by_weight(term)
+
+    def _weighted(self, term, factor):
+        for neg_weight, song_id in self._by_weight(term):
+            yield -neg_weight * factor, song_id
+
+    def _best_first(self, expansions):
+        """Yields (song_id, score) for one query term, best first; a song scores its best expansion."""
+        if len(expansions) == 1:
+            for score, song_id in self._weighted(*expansions[0]):
+                yield song_id, score
+            return
+        seen = set()
+        streams = [self._weighted(term, factor) for term, factor in expansions]
+        for score, song_id in heapq.merge(*streams, key=lambda entry: -entry[0]):
+            if song_id not in seen:
+                seen.add(song_id)
+                yield song_id, score
+
+    def _rank(self, terms, limit):
+        """Scores songs matching all terms. Returns (best `limit` song ids, total)."""
+        expanded = [self._expand(term, prefix=i == len(terms) - 1) for i, term in enumerate(terms)]
+        # Start from the rarest term so later terms only probe its matches
+        expanded.sort(key=lambda expansions: sum(len(self.postings[t]) for t, _ in expansions))
+        if sum(len(self.postings[t]) for t, _ in expanded[0]) <= SCORE_ALL_LIMIT:
+            return self._score_all(expanded, limit)
+
+        # A broad query: matches are counted with set operations and only the best are scored
+        term_postings = [[(self.postings[t], factor) for t, factor in expansions] for expansions in expanded]
+        if len(term_postings) == 1:
+            postings = term_postings[0]
+            # Every song of a single term matches, and its score is the one streamed
+            return [song_id for song_id, _ in islice(self._best_first(expanded[0]), limit)], self._count(postings)
+        first = term_postings[0]
+        matches = first[0][0].keys() if len(first) == 1 else set().union(*(p.keys() for p, _ in first))
+        for postings in term_postings[1:]:
+            # Intersecting each expansion separately never copies a broad term's postings
+            parts = sorted((p.keys() & matches for p, _ in postings), key=len, reverse=True)
+            matches = parts[0]
+            for part in parts[1:]:
+                matches |= part
+            if not matches:
+                return [], 0
+
+        def score(song_id, first_score=None):
+            if first_score is None:
+                first_score = max(p.get(song_id, 0) * factor for p, factor in term_postings[0])
+            return first_score + sum(max(p.get(song_id, 0) * factor for p, factor in postings)
+                                     for postings in term_postings[1:])
+
+        if len(matches) <= SCORE_ALL_LIMIT:
+            return heapq.nlargest(limit, matches, key=score), len(matches)
+        # The other terms can add at most their best weight to a song
+        rest_bound = sum(max(-self._by_weight(t)[0][0] * factor for t, factor in expansions)
+                         for expansions in expanded[1:])
+        top = []  # min-heap of (score, song_id)
+        scored = 0
+        for song_id, first_score in self._best_first(expanded[0]):
+            if len(top) == limit and (first_score + rest_bound <= top[0][0] or scored >= MAX_SCORED):
+                break
+            if song_id not in matches:
+                continue
+            scored += 1
+            entry = (score(song_id, first_score), song_id)
+            if len(top) < limit:
+                heapq.heappush(top, entry)
+            elif entry > top[0]:
+                heapq.heapreplace(top, entry)
+        return [song_id for _, song_id in sorted(top, reverse=True)], len(matches)
+
+    @staticmethod
+    def _count(postings):
+        """Number of songs in any of a query term's expansions, without copying the largest."""
+        postings = sorted((p for p, _ in postings), key=len, reverse=True)
+        largest = postings[0]
+        extra = set()
+        for p in postings[1:]:
+            extra.update(song_id for song_id in p if song_id not in largest)
+        return len(largest) + len(extra)
+
+    def _score_all(self, expanded, limit):
+        """Scores every song matching all terms, for queries whose rarest term is selective."""
+        scores = {}
+        for candidate, factor in expanded[0]:
+            for song_id, weight in self.postings[candidate].items():
+                score = weight * factor
+                if score > scores.get(song_id, 0):
+                    scores[song_id] = score
+        for expansions in expanded[1:]:
+            if not scores:
+                break
+            if len(expansions) == 1:
+                (candidate, factor), = expansions
+                postings = self.postings[candidate]
+                scores = {song_id: score + postings[song_id] * factor
+                          for song_id, score in scores.items() if song_id in postings}
+                continue
+            postings = [(self.postings[t], factor) for t, factor in expansions]
+            next_scores = {}
+            for song_id, score in scores.items():
+                best = max((p.get(song_id, 0) * factor for p, factor in postings), default=0)
+                if best:
+                    next_scores[song_id] = score + best
+            scores = next_scores
+        return heapq.nlargest(limit, scores, key=scores.get), len(scores)
+
+    def catalog(self):
+        """(song_id, genre, playlist count) for every indexed song, e.g. for sampling."""
+        with self._lock:
+            popularity = self.suggestions.popularity
+            return [(song_id, doc[3], popularity.get(song_id, 0)) for song_id, doc in self.docs.items()]
+
+    def song(self, song_id):
+        """(title, artist, album, genre, upload timestamp) of an indexed song, or None."""
+        with self._lock:
+            return self.docs.get(str(song_id))
+
+    def suggest(self, prefix, limit=8):
+        """Returns [(type, item, label, artist)] completions for a typeahead prefix."""
+        with self._lock:
+            return self.suggestions.suggest(prefix, limit)
+
+    def save_snapshot(self, path):
+        """Writes the index to `path` so later startups can skip the full build."""
+        with self._lock:
+            data = pickle.dumps({
+                'version': SNAPSHOT_VERSION, 'synced_at': self.synced_at, 'docs': self.docs,
+                'postings': self.postings, 'term_trigrams': self.term_trigrams, 'terms': self.terms,
+                'suggestions': self.suggestions
+            }, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path):
+        """Loads a snapshot written by save_snapshot and catches up from it. Returns False if unusable."""
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        if data.get('version') != SNAPSHOT_VERSION or not data.get('synced_at'):
+            return False
+        with self._lock:
+            self.docs, self.postings = data['docs'], data['postings']
+            self.term_trigrams, self.terms = data['term_trigrams'], data['terms']
+            self.suggestions = data['suggestions']
+            self._ordered = {}
+            self._results.clear()
+        dropped = self._drop_deleted()
+        with self._lock:
+            self._order_broad_terms()
+        self.catch_up(data['synced_at'])
+        if dropped:
+            # The next worker to start restores without repeating the comparison's removals
+            self.save_snapshot(path)
+        return True
+
+    def _drop_deleted(self):
+        """Unindexes songs deleted since the snapshot was written. Returns how many."""
+        live = {str(song_doc['_id']) for song_doc in self.collection.find({}, {'_id': 1})}
+        with self._lock:
+            deleted = [song_id for song_id in self.docs if song_id not in live]
+            for song_id in deleted:
+                self._unindex(song_id)
+        return len(deleted)
+
+
+search_index = SearchIndex()
@@ -0,0 +1,170 @@
+"""Item-to-item "more like this" neighbours from playlist co-occurrence.
+
+Two songs are similar when the same playlists (Liked Songs included) contain them. The
+offline job (`flask build-similar`) builds the sparse playlist x song incidence matrix A
+from chunks of playlists, computes co-occurrence counts A^T A one block of songs at a
+time, normalizes them (cosine or Jaccard) and writes each song's top-K neighbours to the
+`similar_songs` collection: {_id: song_id, neighbours: [{song_id, score}], built_at}.
+
+`--incremental` only scores songs uploaded since the last full build and merges them
+into their neighbours' lists, so new songs get recommendations between nightly builds.
+"""
+from datetime import datetime
+import numpy as np
+from scipy import sparse
+from pymongo import ReplaceOne, UpdateOne
+from models import mongo_db
+
+METRICS = ('cosine', 'jaccard')
+WRITE_BATCH = 1000
+
+
+def _incidence(playlists, columns, max_length):
+    """Binary CSR matrix of playlists x songs; songs missing from `columns` are skipped."""
+    indptr, indices = [0], []
+    for songs in playlists:
+        # Only the most recently added songs of very long playlists (e.g. big Liked Songs)
+        indices.extend({columns[song_id] for song_id in songs[-max_length:] if song_id in columns})
+        indptr.append(len(indices))
+    return sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, len(columns))
+    )
+
+
+def _playlist_chunks(query, chunk_size):
+    """Yields lists of up to `chunk_size` playlists, each the list of its song ids in order."""
+    chunk, songs, playlist_id = [], [], None
+    items = mongo_db.playlist_items_collection.find(query, {'_id': 0, 'playlist_id': 1, 'song_id': 1}) \
+        .sort([('playlist_id', 1), ('position', 1), ('_id', 1)]).batch_size(10000)
+    for item in items:
+        if item['playlist_id'] != playlist_id:
+            if songs:
+                chunk.append(songs)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+            songs, playlist_id = [], item['playlist_id']
+        songs.append(item['song_id'])
+    if songs:
+        chunk.append(songs)
+    if chunk:
+        yield chunk
+
+
+def _scores(co, row_counts, col_counts, row_columns, metric, min_count):
+    """Normalizes a block of co-occurrence counts; drops self-pairs and rare pairs."""
+    co = co.tocoo()
+    keep = (co.col != row_columns[co.row]) & (co.data >= min_count)
+    rows, cols, counts = co.row[keep], co.col[keep], co.data[keep]
+    n_i, n_j = row_counts[rows], col_counts[cols]
+    if metric == 'jaccard':
+        scores = counts / (n_i + n_j - counts)
+    else:
+        scores = counts / np.sqrt(n_i * n_j)
+    return sparse.csr_matrix((scores, (rows, cols)), shape=co.shape)
+
+
+def _top_k(scores, k):
+    """Yields (row, columns, scores) of each row's k best neighbours, best first."""
+    for row in range(scores.shape[0]):
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        if start == end:
+            continue
+        cols, values = scores.indices[start:end], scores.data[start:end]
+        if end - start > k:
+            best = np.argpartition(-values, k)[:k]
+            cols, values = cols[best], values[best]
+        order = np.lexsort((cols, -values))
+        yield row, cols[order], values[order]
+
+
+def _neighbours(song_ids, cols, values):
+    return [{'song_id': song_ids[col], 'score': round(float(value), 4)} for col, value in zip(cols, values)]
+
+
+def _write(operations):
+    for start in range(0, len(operations), WRITE_BATCH):
+        mongo_db.similar_songs_collection.bulk_write(operations[start:start + WRITE_BATCH], ordered=True)
+
+
+def build_similar(top_k=20, metric='cosine', min_count=1, max_length=500, block_size=20000, chunk_size=100000):
+    """Rebuilds every song's neighbours. Returns the number of songs that have any."""
+    started = datetime.utcnow()
+    song_ids = [doc['_id'] for doc in mongo_db.songs_collection.find({}, {'_id': 1})]
+    columns = {song_id: i for i, song_id in enumerate(song_ids)}
+    chunks = [_incidence(chunk, columns, max_length) for chunk in _playlist_chunks({}, chunk_size)]
+    incidence = sparse.vstack(chunks, format='csr') if chunks else sparse.csr_matrix((0, len(song_ids)), dtype=np.float32)
+    counts = np.asarray(incidence.sum(axis=0)).ravel()  # playlists containing each song
+    by_song = incidence.T.tocsr()
+
+    written = 0
+    for start in range(0, len(song_ids), block_size):
+        # One block of rows of the song x song co-occurrence matrix at a time
+        block = by_song[start:start + block_size]
+        row_columns = np.arange(start, start + block.shape[0])
+        scores = _scores(block @ incidence, counts[row_columns], counts, row_columns, metric, min_count)
+        operations = [
+            ReplaceOne({'_id': song_ids[start + row]},
+                       {'neighbours': _neighbours(song_ids, cols, values), 'built_at': started}, upsert=True)
+            for row, cols, values in _top_k(scores, top_k)
+        ]
+        _write(operations)
+        written += len(operations)
+
+    # Songs that lost all their neighbours
+    mongo_db.similar_songs_collection.delete_many({'built_at': {'$lt': started}})
+    mongo_db.meta_collection.update_one({'_id': 'similar_songs'}, {'$set': {'built_at': started}}, upsert=True)
+    return written
+
+
+def refresh_similar(top_k=20, metric='cosine', min_count=1, max_length=500):
+    """Scores songs uploaded since the last full build. Returns the number of songs scored."""
+    meta = mongo_db.meta_collection.find_one({'_id': 'similar_songs'}) or {}
+    if not meta.get('built_at'):
+        return build_similar(top_k, metric, min_count, max_length)
+    new_ids = [doc['_id'] for doc in mongo_db.songs_collection.find({'upload_date': {'$gt': meta['built_at']}}, {'_id': 1})]
+    if not new_ids:
+        return 0
+    playlist_ids = mongo_db.playlist_items_collection.distinct('playlist_id', {'song_id': {'$in': new_ids}})
+    playlists = [songs for chunk in _playlist_chunks({'playlist_id': {'$in': playlist_ids}}, WRITE_BATCH)
+                 for songs in chunk]
+    # Columns are the songs of these playlists only
+    song_ids = list(dict.fromkeys(song_id for songs in playlists for song_id in songs[-max_length:]))
+    columns = {song_id: i for i, song_id in enumerate(song_ids)}
+    new_ids = [song_id for song_id in new_ids if song_id in columns]
+    if not new_ids:
+        return 0
+    new_set = set(new_ids)
+    incidence = _incidence(playlists, columns, max_length)
+
+    # Every playlist with a new song is loaded, so their counts are exact; the other songs'
+    # counts come from all playlists
+    counts = np.asarray(incidence.sum(axis=0)).ravel()
+    others = [song_id for song_id in song_ids if song_id not in new_set]
+    for row in mongo_db.playlist_items_collection.aggregate([
+        {'$match': {'song_id': {'$in': others}}},
+        {'$group': {'_id': '$song_id', 'count': {'$sum': 1}}}
+    ]):
+        counts[columns[row['_id']]] = row['count']
+
+    row_columns = np.array([columns[song_id] for song_id in new_ids])
+    block = incidence[:, row_columns].T.tocsr()
+    scores = _scores(block @ incidence, counts[row_columns], counts, row_columns, metric, min_count)
+    operations = []
+    for row, cols, values in _top_k(scores, top_k):
+        song_id = new_ids[row]
+        operations.append(ReplaceOne({'_id': song_id}, {'neighbours': _neighbours(song_ids, cols, values),
+                                                        'built_at': meta['built_at']}, upsert=True))
+        # Similarity is symmetric: offer the new song to each neighbour's list
+        for col, value in zip(cols, values):
+            if song_ids[col] in new_set:
+                continue
+            operations.append(UpdateOne({'_id': song_ids[col]}, {'$pull': {'neighbours': {'song_id': song_id}}}))
+            operations.append(UpdateOne({'_id': song_ids[col]}, {
+                '$push': {'neighbours': {'$each': [{'song_id': song_id, 'score': round(float(value), 4)}],
+                                         '$sort': {'score': -1}, '$slice': top_k}},
+                '$setOnInsert': {'built_at': meta['built_at']}
+            }, upsert=True))
+    _write(operations)
+    return len(new_ids)
@@ -21,6 +21,10 @@ document.addEventListener('DOMContentLoaded', () => {
     let isDraggingVolume = false;
     let hideDropdownTimeout = null;
     let userPlaylists = [];
+    // Radio: when on, "next" plays songs similar to the current one
+    let radioOn = localStorage.getItem('radio') === 'on';
+    let radioQueue = [];
+    const radioPlayed = new Set();
 
     if (!audioPlayer) {
         console.error("Audio player element not found!");
@@ -28,7 +32,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // --- Core Player Functions ---
-    function playSong(songContainer) {
+    function playSong(songContainer, fromRadio = false) {
         const songUrl = songContainer.dataset.url;
         const songTitle = songContainer.dataset.title;
         const songArtist = songContainer.dataset.artist;
@@ -52,7 +56,10 @@ document.addEventListener('DOMContentLoaded', () => {
             
             if (songId) {
                 trackSongPlay(songId);
+                radioPlayed.add(songId);
             }
+            // Picking a song by hand starts the radio over from it
+            if (!fromRadio) radioQueue = [];
             
             audioPlayer.play().catch(e => console.error('Play failed:', e));
         }
@@ -85,7 +92,7 @@ document.addEventListener('DOMContentLoaded', () => {
         currentTrackArt.innerHTML = '';
         if (albumArtId && albumArtId.trim()) {
             const img = document.createElement('img');
-            img.src = `/album_art/${albumArtId}`;
+            img.src = `/album_art/${albumArtId}?w=160`;
             img.alt = 'Album Art';
             img.className = 'player-album-art';
             img.onerror = () => { currentTrackArt.innerHTML = '<i class="fas fa-music track-icon"></i>'; };
@@ -294,9 +301,9 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     
     // --- Simplified Event Handling Setup ---
-    function initializeInteractiveElements() {
-        // Initialize hover behavior for playlist dropdowns
-        document.querySelectorAll('.favorite-btn-container').forEach(container => {
+    // Hover behavior for playlist dropdowns; also called for rows added after page load
+    function bindFavoriteContainers(root) {
+        root.querySelectorAll('.favorite-btn-container').forEach(container => {
             container.addEventListener('mouseenter', () => {
                 clearTimeout(hideDropdownTimeout);
                 const dropdown = container.querySelector('.playlist-dropdown');
@@ -308,6 +315,27 @@ document.addEventListener('DOMContentLoaded', () => {
                 hideDropdownTimeout = setTimeout(hideAllDropdowns, 300);
             });
         });
+    }
+    window.bindFavoriteContainers = bindFavoriteContainers;
+
+    // Cached page fragments are rendered without the viewer's likes; mark them here
+    function applyLikedState(root) {
+        const likedData = document.getElementById('liked-song-ids');
+        if (!likedData) return;
+        const likedIds = new Set(JSON.parse(likedData.textContent));
+        root.querySelectorAll('[data-song-id]').forEach(item => {
+            if (!likedIds.has(item.dataset.songId)) return;
+            const button = item.querySelector('.favorite-btn');
+            if (!button) return;
+            button.classList.add('liked');
+            const icon = button.querySelector('i');
+            if (icon) icon.classList.replace('far', 'fas');
+        });
+    }
+    applyLikedState(document);
+
+    function initializeInteractiveElements() {
+        bindFavoriteContainers(document);
 
         // Single delegated click listener for the whole page
         document.body.addEventListener('click', (event) => {
@@ -358,6 +386,14 @@ document.addEventListener('DOMContentLoaded', () => {
     // The rest of your player logic (progress bar, volume, etc.) remains unchanged.
     // ...
     function playNextSong() {
+        if (radioOn && currentSongId) {
+            playNextRadioSong().then(played => { if (!played) playNextPageSong(); });
+            return;
+        }
+        playNextPageSong();
+    }
+
+    function playNextPageSong() {
         const allSongs = Array.from(document.querySelectorAll('[data-url]'));
         if (allSongs.length === 0) return;
         if (!currentSongUrl) { playSong(allSongs[0]); return; }
@@ -375,6 +411,42 @@ document.addEventListener('DOMContentLoaded', () => {
         playSong(allSongs[prevIndex]);
     }
 
+    // --- Radio: queue of similar songs from /api/song/<id>/similar ---
+    const radioBtn = document.getElementById('radio-btn');
+
+    async function fillRadioQueue() {
+        try {
+            const response = await fetch(`/api/song/${currentSongId}/similar?limit=20`);
+            const data = await response.json();
+            if (!data.success) throw new Error(data.message);
+            const queued = new Set(radioQueue.map(song => song.id));
+            radioQueue.push(...data.songs.filter(song => song.file_id && !radioPlayed.has(song.id) && !queued.has(song.id)));
+        } catch (error) {
+            console.error('Error loading radio songs:', error);
+        }
+    }
+
+    async function playNextRadioSong() {
+        if (radioQueue.length < 3) await fillRadioQueue();
+        const song = radioQueue.shift();
+        if (!song) return false;
+        playSong(createSongContainerFromData(song), true);
+        return true;
+    }
+
+    function updateRadioButton() {
+        radioBtn?.classList.toggle('active', radioOn);
+    }
+
+    radioBtn?.addEventListener('click', () => {
+        radioOn = !radioOn;
+        localStorage.setItem('radio', radioOn ? 'on' : 'off');
+        updateRadioButton();
+        showToast(radioOn ? 'Radio on: similar songs will keep playing' : 'Radio off');
+        if (radioOn && currentSongId) fillRadioQueue();
+    });
+    updateRadioButton();
+
     function onPlay() { isPlaying = true; mainPlayBtn.innerHTML = '<i class="fas fa-pause"></i>'; }
     function onPause() { isPlaying = false; mainPlayBtn.innerHTML = '<i class="fas fa-play"></i>'; }
     function onSongEnd() { playNextSong(); }
@@ -470,7 +542,7 @@ document.addEventListener('DOMContentLoaded', () => {
                     item.dataset.url = `/stream/${song.file_id}`; item.dataset.title = song.title;
                     item.dataset.artist = song.artist; item.dataset.album = song.album || '';
                     item.dataset.albumArtId = song.album_art_id || ''; item.dataset.songId = song.id;
-                    item.innerHTML = `<div class="recently-played-art">${song.album_art_id ? `<img src="/album_art/${song.album_art_id}">` : '<i class="fas fa-music"></i>'}</div><div class="recently-played-details"><div class="recently-played-title">${song.title}</div><div class="recently-played-meta">${song.artist}${song.album ? ` • ${song.album}` : ''}</div></div><button class="recently-played-play-btn"><i class="fas fa-play"></i></button>`;
+                    item.innerHTML = `<div class="recently-played-art">${song.album_art_id ? `<img src="/album_art/${song.album_art_id}?w=160" loading="lazy">` : '<i class="fas fa-music"></i>'}</div><div class="recently-played-details"><div class="recently-played-title">${song.title}</div><div class="recently-played-meta">${song.artist}${song.album ? ` • ${song.album}` : ''}</div></div><button class="recently-played-play-btn"><i class="fas fa-play"></i></button>`;
                     item.addEventListener('click', () => { playSong(item); hideRecentlyPlayed(); });
                     listContainer.appendChild(item);
                 });
@@ -515,7 +587,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 // Update album art in header
                 const albumArtHeader = document.getElementById('album-art-header');
                 if (album.album_art_id) {
-                    albumArtHeader.innerHTML = `<img src="/album_art/${album.album_art_id}" alt="${album.name} Album Art" onclick="playAlbum()">`;
+                    albumArtHeader.innerHTML = `<img src="/album_art/${album.album_art_id}?w=320" alt="${album.name} Album Art" onclick="playAlbum()">`;
                 } else {
                     albumArtHeader.innerHTML = '<i class="fas fa-compact-disc"></i>';
                 }
@@ -741,4 +813,116 @@ document.addEventListener('DOMContentLoaded', () => {
             alert('Error saving album description. Please try again.');
         }
     };
+
+    // Typeahead suggestions for the navbar search box
+    const searchForm = document.querySelector('.nav-search');
+    const searchInput = searchForm ? searchForm.querySelector('input[name="query"]') : null;
+    const suggestionsBox = searchForm ? searchForm.querySelector('.search-suggestions') : null;
+    const suggestionIcons = { song: 'fa-music', artist: 'fa-user', album: 'fa-compact-disc' };
+    let suggestTimer = null;
+    let suggestRequest = 0;
+    let activeSuggestion = -1;
+
+    function hideSuggestions() {
+        if (!suggestionsBox) return;
+        suggestionsBox.style.display = 'none';
+        suggestionsBox.innerHTML = '';
+        activeSuggestion = -1;
+    }
+
+    function renderSuggestions(suggestions) {
+        suggestionsBox.innerHTML = '';
+        activeSuggestion = -1;
+        if (!suggestions.length) { hideSuggestions(); return; }
+        suggestions.forEach(suggestion => {
+            const link = document.createElement('a');
+            link.className = 'suggestion-item';
+            link.href = suggestion.url;
+            const icon = document.createElement('i');
+            icon.className = `fas ${suggestionIcons[suggestion.type] || 'fa-search'}`;
+            const label = document.createElement('span');
+            label.textContent = suggestion.label;
+            link.append(icon, label);
+            if (suggestion.type !== 'artist' && suggestion.artist) {
+                const meta = document.createElement('span');
+                meta.className = 'suggestion-meta';
+                meta.textContent = suggestion.artist;
+                link.append(meta);
+            }
+            suggestionsBox.append(link);
+        });
+        suggestionsBox.style.display = 'block';
+    }
+
+    if (searchInput && suggestionsBox) {
+        searchInput.addEventListener('input', () => {
+            clearTimeout(suggestTimer);
+            const query = searchInput.value.trim();
+            if (!query) { hideSuggestions(); return; }
+            suggestTimer = setTimeout(async () => {
+                const requestId = ++suggestRequest;
+                try {
+                    const response = await fetch(`/api/suggest?q=${encodeURIComponent(query)}`);
+                    const data = await response.json();
+                    // Ignore responses that arrive after a newer keystroke's
+                    if (requestId === suggestRequest && data.success) renderSuggestions(data.suggestions);
+                } catch (error) {
+                    console.error('Error fetching suggestions:', error);
+                }
+            }, 80);
+        });
+
+        searchInput.addEventListener('keydown', (e) => {
+            const items = suggestionsBox.querySelectorAll('.suggestion-item');
+            if (!items.length) return;
+            if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+                e.preventDefault();
+                activeSuggestion = (activeSuggestion + (e.key === 'ArrowDown' ? 1 : items.length - 1)) % items.length;
+                items.forEach((item, i) => item.classList.toggle('active', i === activeSuggestion));
+            } else if (e.key === 'Enter' && activeSuggestion >= 0) {
+                e.preventDefault();
+                window.location.href = items[activeSuggestion].href;
+            } else if (e.key === 'Escape') {
+                hideSuggestions();
+            }
+        });
+
+        document.addEventListener('click', (e) => {
+            if (!searchForm.contains(e.target)) hideSuggestions();
+        });
+    }
+
+    // --- Discover feed: infinite scroll through /api/discover ---
+    const discoverSentinel = document.querySelector('.discover-feed-sentinel');
+    const discoverGrid = document.getElementById('discover-feed');
+    let discoverLoading = false;
+
+    async function loadMoreDiscover() {
+        if (discoverLoading || !discoverSentinel.dataset.cursor) return;
+        discoverLoading = true;
+        const { seed, cursor } = discoverSentinel.dataset;
+        try {
+            const response = await fetch(`/api/discover?seed=${seed}&cursor=${encodeURIComponent(cursor)}`);
+            const data = await response.json();
+            if (!data.success) throw new Error(data.message);
+            const cards = document.createElement('div');
+            cards.innerHTML = data.html;
+            bindFavoriteContainers(cards);
+            discoverGrid.append(...cards.children);
+            discoverSentinel.dataset.cursor = data.next_cursor || '';
+        } catch (error) {
+            console.error('Error loading discover songs:', error);
+            discoverSentinel.dataset.cursor = '';
+        } finally {
+            discoverLoading = false;
+        }
+        discoverObserver.unobserve(discoverSentinel);
+        // Re-observing reports the sentinel again if it is still in view after this page
+        if (discoverSentinel.dataset.cursor) discoverObserver.observe(discoverSentinel);
+    }
+
+    const discoverObserver = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) loadMoreDiscover();
+    }, { rootMargin: '600px' });
+    if (discoverSentinel && discoverGrid) discoverObserver.observe(discoverSentinel);
 });
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""Prefix index of song, artist and album names for /api/suggest.
+
+Completions live in one sorted list of (key, item) pairs, where the keys are the
+normalized name and every word-suffix of it ("rhapsody" finds "Bohemian Rhapsody"), so a
+prefix is a binary-searched slice. Items are weighted by popularity: playlist adds
+(Liked Songs included) for songs, summed over their songs for artists and albums.
+
+Short prefixes cover huge slices, so their top completions are precomputed and kept up
+to date as weights change; a list is only rescanned after one of its items drops out.
+
+The index is owned by search_index.SearchIndex, which feeds it every song it indexes.
+"""
+import heapq
+from bisect import bisect_left, insort
+
+# Prefixes up to this length get a maintained top-k list instead of a slice scan
+TOP_PREFIX_LENGTH = 3
+TOP_K = 20
+# A prefix of the whole name ranks above a match on a later word
+NAME_START_BOOST = 2.0
+
+
+def _normalize(text, tokenize):
+    return ' '.join(tokenize(text))
+
+
+class SuggestIndex:
+    def __init__(self, tokenize):
+        self.tokenize = tokenize
+        self.keys = []         # sorted (key, item)
+        self.items = {}        # item -> [label, artist, weight, song count, normalized label]
+        self.song_items = {}   # song_id -> ((song, artist, album items), weight)
+        self.popularity = {}   # song_id -> playlist count
+        self.top = {}          # short prefix -> [(score, item)], best first
+        self._stale = set()    # short prefixes whose top list must be rescanned
+
+    @staticmethod
+    def _keys_for(normalized):
+        words = normalized.split(' ')
+        return {' '.join(words[i:]) for i in range(len(words))}
+
+    def _short_prefixes(self, normalized):
+        return {key[:length] for key in self._keys_for(normalized)
+                for length in range(1, min(len(key), TOP_PREFIX_LENGTH) + 1)}
+
+    @staticmethod
+    def _score(entry, prefix):
+        return entry[2] * (NAME_START_BOOST if entry[4].startswith(prefix) else 1)
+
+    def _update_top(self, item, entry, removed=False):
+        """Keeps the short-prefix top lists current after an item's weight changed or it was removed."""
+        for prefix in self._short_prefixes(entry[4]):
+            if prefix in self._stale:
+                continue
+            ranked = self.top.setdefault(prefix, [])
+            was_full = len(ranked) >= TOP_K
+            position = next((i for i, (_, other) in enumerate(ranked) if other == item), None)
+            if position is not None:
+                del ranked[position]
+            score = None if removed else self._score(entry, prefix)
+            if score is not None and (len(ranked) < TOP_K or score > ranked[-1][0]):
+                ranked.append((score, item))
+                ranked.sort(key=lambda pair: -pair[0])
+                del ranked[TOP_K:]
+            elif position is not None and was_full:
+                # An item left a full list, so the next best one outside it is unknown
+                self._stale.add(prefix)
+
+    def _add_item(self, item, label, artist, weight, bulk):
+        entry = self.items.get(item)
+        if entry is None:
+            entry = self.items[item] = [label, artist, weight, 1, _normalize(label, self.tokenize)]
+            for key in self._keys_for(entry[4]):
+                if bulk:
+                    self.keys.append((key, item))
+                else:
+                    insort(self.keys, (key, item))
+        else:
+            entry[2] += weight
+            entry[3] += 1
+        if not bulk:
+            self._update_top(item, entry)
+
+    def _remove_item(self, item, weight):
+        entry = self.items.get(item)
+        if entry is None:
+            return
+        entry[2] -= weight
+        entry[3] -= 1
+        if entry[3] > 0:
+            self._update_top(item, entry)
+            return
+        del self.items[item]
+        for key in self._keys_for(entry[4]):
+            i = bisect_left(self.keys, (key, item))
+            if i < len(self.keys) and self.keys[i] == (key, item):
+                del self.keys[i]
+        self._update_top(item, entry, removed=True)
+
+    def add_song(self, song_id, title, artist, album, bulk=False):
+        """Adds a song's completions. During a bulk build pass bulk=True, then call finish_build."""
+        self.remove_song(song_id)
+        weight = 1 + self.popularity.get(song_id, 0)
+        artist_key = _normalize(artist, self.tokenize)
+        album_key = _normalize(album, self.tokenize)
+        items = (
+            ('song', song_id) if _normalize(title, self.tokenize) else None,
+            ('artist', artist_key) if artist_key else None,
+            ('album', artist_key, album_key) if album_key else None,
+        )
+        for item, label in zip(items, (title, artist, album)):
+            if item:
+                self._add_item(item, label, artist, weight, bulk)
+        self.song_items[song_id] = (items, weight)
+
+    def remove_song(self, song_id):
+        entry = self.song_items.pop(song_id, None)
+        if entry is None:
+            return
+        items, weight = entry
+        for item in items:
+            if item:
+                self._remove_item(item, weight)
+
+    def finish_build(self):
+        """Sorts the keys and computes every short-prefix top list after a bulk build."""
+        self.keys.sort()
+        self._stale = set()
+        prefixes = {key[:length] for key, _ in self.keys
+                    for length in range(1, min(len(key), TOP_PREFIX_LENGTH) + 1)}
+        self.top = {prefix: self._scan(prefix, TOP_K) for prefix in prefixes}
+
+    def _scan(self, prefix, limit):
+        """Best `limit` (score, item) for a prefix, from its slice of the sorted keys."""
+        lo = bisect_left(self.keys, (prefix,))
+        hi = bisect_left(self.keys, (prefix + '\uffff',))
+        scores = {}
+        for _, item in self.keys[lo:hi]:
+            if item not in scores:
+                scores[item] = self._score(self.items[item], prefix)
+        return [(scores[item], item) for item in heapq.nlargest(limit, scores, key=scores.get)]
+
+    def suggest(self, prefix, limit=8):
+        """Returns up to `limit` of the most popular (type, item, label, artist) completing `prefix`."""
+        prefix = _normalize(prefix, self.tokenize)
+        if not prefix:
+            return []
+        if len(prefix) <= TOP_PREFIX_LENGTH and limit <= TOP_K:
+            if prefix in self._stale:
+                self.top[prefix] = self._scan(prefix, TOP_K)
+                self._stale.discard(prefix)
+            ranked = self.top.get(prefix, [])[:limit]
+        else:
+            ranked = self._scan(prefix, limit)
+        return [(item[0], item) + tuple(self.items[item][:2]) for _, item in ranked]
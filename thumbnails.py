@@ -0,0 +1,60 @@
+"""Resized WebP/JPEG variants of album art and artist photos.
+
+Variants are stored in GridFS next to the original, and the original's metadata keeps
+a `variants` map of width -> {format: file_id} so the image routes can pick one
+without an extra query.
+"""
+from io import BytesIO
+from bson import ObjectId
+from PIL import Image, ImageOps
+from models import mongo_db
+
+THUMBNAIL_WIDTHS = (160, 320, 640)
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def create_thumbnails(file_id, image_data, widths=THUMBNAIL_WIDTHS):
+    """Generates and stores resized variants of an image. Returns the variants map."""
+    try:
+        image = Image.open(BytesIO(image_data))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    except Exception as e:
+        # SVGs and corrupt uploads are served as-is
+        print(f"Skipping thumbnails for {file_id}: {e}")
+        return {}
+
+    variants = {}
+    for width in widths:
+        if width >= image.width:
+            continue
+        height = round(image.height * width / image.width)
+        resized = image.resize((width, height), Image.LANCZOS)
+        variants[str(width)] = {}
+        for fmt, (pil_format, content_type, options) in THUMBNAIL_FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, pil_format, **options)
+            variant_id = mongo_db.fs.put(buffer.getvalue(), filename=f'{file_id}_{width}.{fmt}', metadata={
+                'content_type': content_type, 'type': 'thumbnail', 'original_id': ObjectId(file_id), 'width': width
+            })
+            variants[str(width)][fmt] = variant_id
+
+    # Recorded even when empty so the backfill knows this image was processed
+    mongo_db.db.fs.files.update_one({'_id': ObjectId(file_id)}, {'$set': {'metadata.variants': variants}})
+    return variants
+
+
+def backfill_thumbnails():
+    """Creates variants for album art and artist photos uploaded before thumbnails existed."""
+    processed = 0
+    query = {'metadata.type': {'$in': ['album_art', 'artist_photo']}, 'metadata.variants': {'$exists': False}}
+    for file_doc in mongo_db.db.fs.files.find(query, {'_id': 1}):
+        try:
+            image_data = mongo_db.fs.get(file_doc['_id']).read()
+            create_thumbnails(file_doc['_id'], image_data)
+            processed += 1
+        except Exception as e:
+            print(f"Error creating thumbnails for {file_doc['_id']}: {e}")
+    return processed
@@ -0,0 +1,243 @@
+"""Trending songs, artists and genres from the stream of plays.
+
+Every play from /api/track-play is counted, per dimension (song, artist, genre) and per
+window (hour, day, week), in a count-min sketch with a small top-k table of heavy hitters
+beside it, so charts are read from memory by sorting k candidates.
+
+Counts decay exponentially with the window as time constant: a play adds weight
+e^((t - landmark) / tau) instead of every counter being decayed over time. The landmark
+moves in fixed steps of LANDMARK_STEP * tau (rescaling the counters), so every process
+uses the same landmark and snapshots stay comparable.
+
+Each process counts the plays it serves, which with a load balancer is a fair sample of
+all plays; the charts rank by relative score. Every TRENDING_SNAPSHOT_SECONDS the
+counters are saved to the `trending` collection, and a starting process restores the
+latest snapshot so charts survive restarts.
+"""
+import atexit
+import hashlib
+import heapq
+import math
+import os
+import threading
+import time
+from array import array
+from bson import Binary, ObjectId
+from search_index import search_index
+
+WINDOWS = {'hour': 3600, 'day': 24 * 3600, 'week': 7 * 24 * 3600}
+DIMENSIONS = ('songs', 'artists', 'genres')
+# Landmark step in time constants; the largest weight is e^LANDMARK_STEP
+LANDMARK_STEP = 64
+
+
+def sketch_indices(key, width, depth):
+    """The key's counter in each row of a width x depth sketch (stable across processes)."""
+    # Two independent halves of one digest (double hashing); CRCs of a key are correlated
+    digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+    h1, h2 = digest & 0xFFFFFFFF, digest >> 32 | 1
+    return [row * width + (h1 + row * h2) % width for row in range(depth)]
+
+
+class DecayedTopK:
+    """A count-min sketch (conservative update) with the top `capacity` keys it has seen."""
+
+    def __init__(self, width, depth, capacity):
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity
+        self.table = array('d', bytes(8 * width * depth))
+        self.candidates = {}  # key -> estimated weight
+        self._heap = []       # (weight, key) per candidate; weights may lag behind and are refreshed lazily
+
+    def add(self, key, indices, weight):
+        table = self.table
+        estimate = min(map(table.__getitem__, indices)) + weight
+        for i in indices:
+            if table[i] < estimate:
+                table[i] = estimate
+        candidates = self.candidates
+        if key in candidates:
+            # Most plays are of keys already in the chart: no heap work
+            candidates[key] = estimate
+            return
+        if len(candidates) >= self.capacity:
+            if estimate <= self._floor():
+                return
+            del candidates[heapq.heappop(self._heap)[1]]
+        candidates[key] = estimate
+        heapq.heappush(self._heap, (estimate, key))
+
+    def _floor(self):
+        """The smallest candidate weight."""
+        heap = self._heap
+        # Weights only grow, so an outdated root is pushed back with its current weight
+        while True:
+            weight, key = heap[0]
+            current = self.candidates[key]
+            if current == weight:
+                return weight
+            heapq.heapreplace(heap, (current, key))
+
+    def _rebuild_heap(self):
+        self._heap = [(weight, key) for key, weight in self.candidates.items()]
+        heapq.heapify(self._heap)
+
+    def scale(self, factor):
+        self.table = array('d', (value * factor for value in self.table))
+        self.candidates = {key: weight * factor for key, weight in self.candidates.items()}
+        self._rebuild_heap()
+
+    def top(self, limit):
+        return heapq.nlargest(limit, self.candidates.items(), key=lambda item: item[1])
+
+    def discard(self, key):
+        """Drops a key from the chart (e.g. a deleted song); its counters are left to decay."""
+        if self.candidates.pop(key, None) is not None:
+            self._rebuild_heap()
+
+
+class Trending:
+    def __init__(self):
+        self.collection = None
+        self.songs = None
+        self.width = 2048
+        self.depth = 4
+        self.capacity = 100
+        self.snapshot_seconds = 60
+        self.landmarks = {}
+        self.charts = {}
+        self._next_landmark = 0  # When the first landmark moves again
+        self._thread_pid = None
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        now = time.time()
+        self.landmarks = {window: self._landmark(window, now) for window in WINDOWS}
+        self._next_landmark = min(self.landmarks[window] + LANDMARK_STEP * tau for window, tau in WINDOWS.items())
+        self.charts = {(window, dimension): DecayedTopK(self.width, self.depth, self.capacity)
+                       for window in WINDOWS for dimension in DIMENSIONS}
+
+    def init_app(self, app, collection, songs_collection):
+        self.collection = collection
+        self.songs = songs_collection
+        self.width = app.config.get('TRENDING_SKETCH_WIDTH', 2048)
+        self.depth = app.config.get('TRENDING_SKETCH_DEPTH', 4)
+        self.capacity = app.config.get('TRENDING_TOP_K', 100)
+        self.snapshot_seconds = app.config.get('TRENDING_SNAPSHOT_SECONDS', 60)
+        self._reset()
+        self.restore()
+        atexit.register(self.snapshot)
+
+    @staticmethod
+    def _landmark(window, now):
+        step = LANDMARK_STEP * WINDOWS[window]
+        return now // step * step
+
+    def _advance(self, now):
+        """Moves landmarks that have fallen a step behind, rescaling their counters."""
+        if self._next_landmark > now:
+            return
+        for window, tau in WINDOWS.items():
+            landmark = self._landmark(window, now)
+            if landmark != self.landmarks[window]:
+                factor = math.exp((self.landmarks[window] - landmark) / tau)
+                for dimension in DIMENSIONS:
+                    self.charts[window, dimension].scale(factor)
+                self.landmarks[window] = landmark
+        self._next_landmark = min(self.landmarks[window] + LANDMARK_STEP * tau for window, tau in WINDOWS.items())
+
+    def record(self, song_id, artist, genre, now=None):
+        """Counts one play in every window."""
+        now = now if now is not None else time.time()
+        keys = {'songs': song_id, 'artists': artist, 'genres': (genre or '').strip().casefold()}
+        with self._lock:
+            self._advance(now)
+            # Every chart has the same shape, so a key's counters are found once
+            indices = {dimension: sketch_indices(key, self.width, self.depth) for dimension, key in keys.items() if key}
+            for window, tau in WINDOWS.items():
+                weight = math.exp((now - self.landmarks[window]) / tau)
+                for dimension, key_indices in indices.items():
+                    self.charts[window, dimension].add(keys[dimension], key_indices, weight)
+        self._ensure_thread()
+
+    def record_play(self, song_id):
+        """Counts a play of a song, looking up its artist and genre."""
+        doc = search_index.song(song_id)
+        if doc:
+            _, artist, _, genre, _ = doc
+        else:
+            # The search index is still building
+            song_doc = self.songs.find_one({'_id': ObjectId(song_id)}, {'artist': 1, 'genre': 1}) \
+                if self.songs is not None else None
+            if not song_doc:
+                return
+            artist, genre = song_doc.get('artist'), song_doc.get('genre')
+        self.record(str(song_id), artist, genre)
+
+    def top(self, dimension, window, limit=10):
+        """[(key, score)] most played first; score is the decayed play count."""
+        now = time.time()
+        with self._lock:
+            self._advance(now)
+            decay = math.exp(-(now - self.landmarks[window]) / WINDOWS[window])
+            return [(key, round(weight * decay, 2)) for key, weight in self.charts[window, dimension].top(limit)]
+
+    def discard(self, dimension, key):
+        with self._lock:
+            for window in WINDOWS:
+                self.charts[window, dimension].discard(key)
+
+    def _ensure_thread(self):
+        # One snapshot thread per process, started with the first play
+        if self.collection is not None and self._thread_pid != os.getpid():
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.snapshot_seconds)
+            self.snapshot()
+
+    def snapshot(self):
+        """Saves every chart to the `trending` collection (the latest writer wins)."""
+        if self.collection is None:
+            return
+        with self._lock:
+            docs = [{
+                '_id': f'{window}:{dimension}', 'landmark': self.landmarks[window],
+                'width': chart.width, 'depth': chart.depth,
+                'table': Binary(chart.table.tobytes()),
+                'candidates': [[key, weight] for key, weight in chart.candidates.items()],
+                'saved_at': time.time()
+            } for (window, dimension), chart in self.charts.items()]
+        try:
+            for doc in docs:
+                self.collection.replace_one({'_id': doc['_id']}, doc, upsert=True)
+        except Exception as e:
+            print(f"Error saving trending snapshot: {e}")
+
+    def restore(self):
+        """Loads the latest snapshot, if it matches the configured sketch size."""
+        try:
+            docs = {doc['_id']: doc for doc in self.collection.find()}
+        except Exception as e:
+            print(f"Error loading trending snapshot: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for (window, dimension), chart in self.charts.items():
+                doc = docs.get(f'{window}:{dimension}')
+                if not doc or doc['width'] != self.width or doc['depth'] != self.depth:
+                    continue
+                chart.table = array('d', bytes(doc['table']))
+                chart.candidates = {key: weight for key, weight in doc['candidates']}
+                chart._rebuild_heap()
+                # A snapshot from an earlier landmark step is rescaled to the current one
+                landmark = self._landmark(window, now)
+                if doc['landmark'] != landmark:
+                    chart.scale(math.exp((doc['landmark'] - landmark) / WINDOWS[window]))
+
+
+trending = Trending()